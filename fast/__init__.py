@@ -21,8 +21,9 @@ from electric_field import PlaneWave, MotField
 from electric_field import electric_field_amplitude_gaussian
 from electric_field import electric_field_amplitude_top
 from electric_field import electric_field_amplitude_intensity
-from misc import Mu, IJ, find_phase_transformation
-from misc import formatLij, convolve_with_gaussian, read_result, fprint
+from misc import Mu, IJ, MuTable, mu_table, find_phase_transformation
+from misc import formatLij, SparseLij, convolve_with_gaussian, read_result, Result, fprint
+from misc import polarization_parameters, decay_parameters, decay_manifolds, hyperfine_blocks
 
 from graphic import complex_matrix_plot, plot_Lij
 from graphic import Arrow3D, bar_chart_mf, draw_atom3d, draw_mot_field_3d
@@ -31,15 +32,17 @@ from graphic import draw_state, excitation, decay, draw_multiplet
 from graphic import fancy_matrix_plot, fancy_r_plot, plot_populations
 
 from evolution import write_evolution, run_evolution
-from stationary import write_stationary, run_stationary
+from stationary import write_stationary, run_stationary, iterate_stationary, adaptive_stationary
+from stationary import affine_operator, AffineOperator
 from misc import compile_code
 
-from atomic_structure import Atom, State, Transition
+from atomic_structure import Atom, State, Transition, TransitionGraph
 from atomic_structure import split_fine_to_hyperfine, split_fine_to_magnetic
 from atomic_structure import split_hyperfine_to_magnetic
 from atomic_structure import calculate_matrices, make_list_of_states
 from atomic_structure import calculate_gamma_matrix, calculate_omega_matrix
 from atomic_structure import calculate_r_matrices, calculate_boundaries
+from atomic_structure import StateIndex, state_index
 from atomic_structure import vapour_pressure, vapour_number_density
 from atomic_structure import vapour_density
 from atomic_structure import speed_likely, speed_average, collision_rate
@@ -34,6 +34,8 @@ This inclures routines to calculate the necessary matrices.
 from sympy.core.numbers import Rational as Integer
 from math import sqrt, pi
 from sympy.physics.wigner import wigner_3j, wigner_6j
+import numpy as np
+import os
 
 # Physical constants (SI units):
 from scipy.constants import physical_constants
@@ -258,23 +260,28 @@ class Atom(object):
 
 
         """
-        # We generate all possible quantum numbers for N<=Nmax.
-
-        S = 1/Integer(2)  # The spin of the electron.
-        available = []
-        not_available = []
-        for N in range(1, Nmax+1):
-            for L in range(N):
-                Jmin = abs(L-S)
-                Jmax = L+S
-                Jpos = [Jmin+i for i in range(Jmax-Jmin+1)]
-                for J in Jpos:
-                    try:
-                        state = State(self.element, self.isotope, N, L, J)
-                        available += [state]
-                    except:
-                        not_available += [(self.element, self.isotope,
-                                           N, L, J)]
+        # The states available are those in the database with N<=Nmax.
+        if self.isotope is None:
+            table = {}
+        else:
+            table = fine_structure_table(self.element, self.isotope)
+        available = [State(self.element, self.isotope, N, L, J)
+                     for N, L, J in [level[:3] for level in table.values()]
+                     if N <= Nmax]
+
+        if return_missing:
+            # We generate all possible quantum numbers for N<=Nmax.
+            S = 1/Integer(2)  # The spin of the electron.
+            not_available = []
+            for N in range(1, Nmax+1):
+                for L in range(N):
+                    Jmin = abs(L-S)
+                    Jmax = L+S
+                    Jpos = [Jmin+i for i in range(Jmax-Jmin+1)]
+                    for J in Jpos:
+                        if (N, L, int(2*J)) not in table:
+                            not_available += [(self.element, self.isotope,
+                                               N, L, J)]
 
         if omega_min is not None:
             available = [s for s in available if s.omega >= omega_min]
@@ -319,25 +326,30 @@ class Atom(object):
         775.978619616 85Rb 5P_3/2 -----> 85Rb 5D_5/2
 
         """
-        states = self.states()
-        transitions = states
-        transitions = []
-        for i in range(len(states)):
-            si = states[i]
-            for j in range(i):
-                sj = states[j]
-                t = Transition(sj, si, verbose=0)
-                if t.allowed:
-                    transitions += [t]
-
+        graph = self.transition_graph()
+        selected = np.ones(len(graph.transitions), bool)
         if omega_min is not None:
-            transitions = [ti for ti in transitions
-                           if abs(ti.omega) >= omega_min]
+            selected &= abs(graph.omega) >= omega_min
         if omega_max is not None:
-            transitions = [ti for ti in transitions
-                           if abs(ti.omega) <= omega_max]
+            selected &= abs(graph.omega) <= omega_max
 
-        return transitions
+        return [graph.transitions[k] for k in np.flatnonzero(selected)]
+
+    def transition_graph(self):
+        r"""Return the graph of allowed transitions between the fine states.
+
+        The graph is built the first time it is needed for each isotope and
+        shared afterwards (see TransitionGraph).
+
+        >>> graph=Atom("Rb",85).transition_graph()
+        >>> print len(graph.states), len(graph.transitions)
+        52 270
+
+        """
+        key = (self.element, self.isotope)
+        if key not in transition_graphs:
+            transition_graphs[key] = TransitionGraph(self.states())
+        return transition_graphs[key]
 
     def find_decays(self, fine_state):
         r"""Find all possible decays from a given fine state.
@@ -355,32 +367,445 @@ class Atom(object):
         [133Cs 6D_5/2, 133Cs 6P_3/2, 133Cs 7P_3/2, 133Cs 6S_1/2, 133Cs 5D_3/2, 133Cs 5D_5/2, 133Cs 7S_1/2, 133Cs 6P_1/2]
 
         """
-        def decays_from(fine_state, transitions):
-            states_below = []
-            for t in transitions:
-                if t.e2 == fine_state:
-                    states_below += [t.e1]
-            return states_below
-
-        def iterate(states, transitions):
-            new_and_old_states = states[:]
-            for state in states:
-                new_states = decays_from(state, transitions)
-                for new_state in new_states:
-                    if new_state not in new_and_old_states:
-                        new_and_old_states += [new_state]
-
-            if states == new_and_old_states:
-                return states
-            else:
-                return iterate(new_and_old_states, transitions)
-
-        transitions = self.transitions()
-        states = iterate([fine_state], transitions)
+        graph = self.transition_graph()
+        states = [fine_state]
+        key = tuple(fine_state.quantum_numbers)
+        if key in graph.index:
+            # We do a breadth first search in the graph.
+            reached = [graph.index[key]]
+            for k in reached:
+                for kk in graph.decays[k]:
+                    if kk not in reached:
+                        reached += [kk]
+                        states += [graph.states[kk]]
 
         return states
 
 
+# The graphs of allowed transitions of each isotope.
+transition_graphs = {}
+
+
+class TransitionGraph(object):
+    r"""This class describes the allowed transitions between fine states.
+
+    The transitions are those between pairs of states (ordered by energy)
+    that are allowed by electric dipole selection rules. Their properties
+    are stored as arrays with one element per transition.
+
+    >>> g=State("Rb",87,5,0,1/Integer(2))
+    >>> e1=State("Rb",87,5,1,1/Integer(2))
+    >>> e2=State("Rb",87,5,1,3/Integer(2))
+    >>> graph=TransitionGraph([g,e1,e2])
+    >>> graph.transitions
+    [87Rb 5S_1/2 -----> 87Rb 5P_1/2, 87Rb 5S_1/2 -----> 87Rb 5P_3/2]
+    >>> graph.lower, graph.upper
+    (array([0, 0]), array([1, 2]))
+    >>> print graph.wavelength
+    [-7.94978913e-07 -7.80241477e-07]
+    >>> graph.decays
+    [[], [0], [0]]
+
+    """
+
+    def __init__(self, states):
+        self.states = states
+        self.index = dict([(tuple(states[i].quantum_numbers), i)
+                           for i in range(len(states))])
+
+        # We apply the selection rules to all pairs of states at once.
+        l = np.array([si.l for si in states])
+        j2 = np.array([int(2*si.j) for si in states])
+        lower, upper = [], []
+        for i in range(len(states)):
+            allowed = (abs(l[:i]-l[i]) == 1) & (abs(j2[:i]-j2[i]) <= 2)
+            lower += list(np.flatnonzero(allowed))
+            upper += [i]*int(allowed.sum())
+
+        self.lower = np.array(lower, int)
+        self.upper = np.array(upper, int)
+        self.transitions = [Transition(states[lower[k]], states[upper[k]],
+                                       verbose=0) for k in range(len(lower))]
+
+        self.nu = np.array([t.nu for t in self.transitions])
+        self.omega = np.array([t.omega for t in self.transitions])
+        self.wavelength = np.array([t.wavelength for t in self.transitions])
+        self.einsteinA = np.array([t.einsteinA if t.einsteinA is not None
+                                   else np.nan for t in self.transitions])
+
+        # The states to which each state can decay.
+        self.decays = [[] for si in states]
+        for k in range(len(lower)):
+            self.decays[upper[k]] += [lower[k]]
+
+
+# The fine structure levels of each isotope, indexed by (n, l, 2j). They are
+# built the first time they are needed and shared by all states.
+fine_structure_tables = {}
+
+
+def fine_structure_table(element, isotope):
+    r"""Return the database of fine structure levels of an isotope.
+
+    This function returns a dictionary whose keys are the tuples (n, l, 2j)
+    and whose values are the lists [n, l, j, nu, A, B, C] with the quantum
+    numbers, the frequency and the hyperfine constants (in Hz) of each level.
+
+    >>> table = fine_structure_table("Rb", 87)
+    >>> print table[(5, 1, 3)][:3], table[(5, 1, 3)][3]
+    [5, 1, 3/2] 3.84230352862e+14
+
+    """
+    if (element, isotope) in fine_structure_tables:
+        return fine_structure_tables[(element, isotope)]
+
+    ################################################################
+    # the l values of letters in
+    S = 0
+    P = 1
+    D = 2
+    F = 3
+    G = 4
+    H = 5
+    I = 6
+    from scipy.constants import c
+    # All tables are given in (cm^-1).
+    if element == "Rb":
+        if isotope==85:
+            #        N, L,     K       , E (cm^-1),      A (cm^-1)      B (cm^-1)    C (cm^-1)
+            nivfin=[[ 5, S, 1/Integer(2), 0.0000000  , 0.033753721     , 0.0       , 0.0],
+                    [ 5, P, 1/Integer(2), 12578.950  , 0.004026        , 0.0       , 0.0],
+                    [ 5, P, 3/Integer(2), 12816.545  , 0.0008352       , 0.0008676 , 0.0],
+
+                    [ 4, D, 5/Integer(2), 19355.203  , 0.000168        , 0.0       , 0.0],
+                    [ 4, D, 3/Integer(2), 19355.649  , 0.000244        , 0.0       , 0.0],
+
+                    [ 6, S, 1/Integer(2), 20132.460  , 239.18e6/(c*100), 0.0       , 0.0],
+
+                    [ 6, P, 1/Integer(2), 23715.081  , 0.001305        , 0.0       , 0.0],
+                    [ 6, P, 3/Integer(2), 23792.591  , 0.0002723       , 0.0002732 , 0.0],
+
+                    [ 5, D, 3/Integer(2), 25700.536  , 0.000140834     , 0.00006373, 0.0],
+                    [ 5, D, 5/Integer(2), 25703.498  ,-0.00007309      , 0.0000894 , 0.0],
+
+                    [ 7, S, 1/Integer(2), 26311.437  , 0.003159        , 0.0       , 0.0],
+
+                    [ 7, P, 1/Integer(2), 27835.02   , 0.000590        , 0.0       , 0.0],
+                    [ 7, P, 3/Integer(2), 27870.11   , 0.0001238       , 0.000123  , 0.0],
+
+                    [ 6, D, 3/Integer(2), 28687.127  , 0.000077        , 0.000054  , 0.0],
+                    [ 7, D, 3/Integer(2), 30280.113  , 0.0000472       , 0.000010  , 0.0],
+                    [14, S, 1/Integer(2), 32761.60069, 0.0             , 0.0       , 0.0],
+
+                    [15, S, 1/Integer(2), 32911.63322, 0.0             , 0.0       , 0.0],
+                    [16, S, 1/Integer(2), 33028.05246, 0.0             , 0.0       , 0.0],
+                    [17, S, 1/Integer(2), 33120.19975, 0.0             , 0.0       , 0.0],
+                    [18, S, 1/Integer(2), 33194.38247, 0.0             , 0.0       , 0.0],
+                    [19, S, 1/Integer(2), 33254.98464, 0.0             , 0.0       , 0.0],
+                    [20, S, 1/Integer(2), 33305.12986, 0.0             , 0.0       , 0.0],
+                    [21, S, 1/Integer(2), 33347.09244, 0.0             , 0.0       , 0.0],
+                    [22, S, 1/Integer(2), 33382.56103, 0.0             , 0.0       , 0.0],
+                    [23, S, 1/Integer(2), 33412.80991, 0.0             , 0.0       , 0.0],
+                    [24, S, 1/Integer(2), 33438.81426, 0.0             , 0.0       , 0.0],
+                    [25, S, 1/Integer(2), 33461.33387, 0.0             , 0.0       , 0.0],
+
+                    [26, S, 1/Integer(2), 33480.96379, 0.0             , 0.0       , 0.0],
+                    [27, S, 1/Integer(2), 33498.17857, 0.0             , 0.0       , 0.0],
+                    [28, S, 1/Integer(2), 33513.35849, 0.0             , 0.0       , 0.0],
+                    [29, S, 1/Integer(2), 33526.81233, 0.0             , 0.0       , 0.0],
+                    [30, S, 1/Integer(2), 33538.79178, 0.0             , 0.0       , 0.0],
+                    [31, S, 1/Integer(2), 33549.50518, 0.0             , 0.0       , 0.0],
+                    [32, S, 1/Integer(2), 33559.12441, 0.0             , 0.0       , 0.0],
+                    [33, S, 1/Integer(2), 33567.79401, 0.0             , 0.0       , 0.0],
+                    [34, S, 1/Integer(2), 33575.63464, 0.0             , 0.0       , 0.0],
+                    [35, S, 1/Integer(2), 33582.74865, 0.0             , 0.0       , 0.0],
+
+                    [36, S, 1/Integer(2), 33589.22335, 0.0             , 0.0       , 0.0],
+                    [37, S, 1/Integer(2), 33595.13297, 0.0             , 0.0       , 0.0],
+                    [38, S, 1/Integer(2), 33600.54153, 0.0             , 0.0       , 0.0],
+                    [39, S, 1/Integer(2), 33605.50403, 0.0             , 0.0       , 0.0],
+                    [40, S, 1/Integer(2), 33610.06832, 0.0             , 0.0       , 0.0],
+                    [41, S, 1/Integer(2), 33614.27566, 0.0             , 0.0       , 0.0],
+                    [42, S, 1/Integer(2), 33618.16244, 0.0             , 0.0       , 0.0],
+                    [43, S, 1/Integer(2), 33621.76072, 0.0             , 0.0       , 0.0],
+                    [44, S, 1/Integer(2), 33625.09801, 0.0             , 0.0       , 0.0],
+                    [45, S, 1/Integer(2), 33628.19886, 0.0             , 0.0       , 0.0],
+
+                    [46, S, 1/Integer(2), 33631.08524, 0.0             , 0.0       , 0.0],
+                    [47, S, 1/Integer(2), 33633.77664, 0.0             , 0.0       , 0.0],
+                    [48, S, 1/Integer(2), 33636.29016, 0.0             , 0.0       , 0.0],
+                    [49, S, 1/Integer(2), 33638.64086, 0.0             , 0.0       , 0.0],
+                    [50, S, 1/Integer(2), 33640.84283, 0.0             , 0.0       , 0.0],
+                    ]
+
+        elif isotope == 87:
+            #        N, L,     K       , E (cm^-1),      A (cm^-1)      B (cm^-1)      C (cm^-1)
+            nivfin=[[5, S, 1/Integer(2), 0.0000000, 0.113990236053642, 0.0            , 0.0],
+                    [5, P, 1/Integer(2), 12578.950, 0.01365          , 0.0            , 0.0],
+                    [5, P, 3/Integer(2), 12816.545, 0.0028259        , 0.00041684     , 0.0],
+
+                    [4, D, 5/Integer(2), 19355.203,-16.801e6/(c*100) , 3.645e6/(c*100), 0.0],# Not Sansonetti.
+                    [4, D, 3/Integer(2), 19355.649, 24.750e6/(c*100) , 2.190e6/(c*100), 0.0],# Not Sansonetti.
+
+                    [6, S, 1/Integer(2), 20132.460, 807.66e6/(c*100) , 0.0            , 0.0],# Not Sansonetti.
+
+                    [6, P, 1/Integer(2), 23715.081, 0.0044217        , 0.0            , 0.0],
+                    [6, P, 3/Integer(2), 23792.591, 0.000924         , 0.000132       , 0.0],
+
+                    [5, D, 3/Integer(2), 25700.536, 0.00048134       , 0.00003109     , 0.0],
+                    [5, D, 5/Integer(2), 25703.498, -0.00024886      , 0.00004241     , 0.0],
+
+                    [7, S, 1/Integer(2), 26311.437, 0.010664         , 0.0            , 0.0],
+
+                    [7, P, 1/Integer(2), 27835.020, 0.001999         , 0.0            , 0.0],
+                    [7, P, 3/Integer(2), 27870.110, 0.0004193        , 0.00005700     , 0.0]
+                    ]
+
+        else:
+            s = "The isotope "+str(isotope)+str(element)+" is not in the database."
+            raise ValueError, s
+        # We rewrite the table in Hz
+        nivfin=[ nivfin[ii][:3] + [nivfin[ii][3]*c*100 ] +[nivfin[ii][4]*c*100 ] +[nivfin[ii][5]*c*100 ]
+                                + [nivfin[ii][6]*c*100 ] for ii in range(len(nivfin)) ]
+
+    elif element == "Cs":
+        if isotope == 133:
+            # Reference [1], others not used yet [2]:
+            #        N, L,     K       , E (cm^-1),       A (MHz)      B (MHz)   C (MHz)
+
+            nivfin=[[ 6, S, 1/Integer(2),     0         , 2298.1579425, 0     , 1.0     ],# This is exact.
+
+                    [ 6, P, 1/Integer(2), 11178.26815870,  291.9309   , 0.0   , 0.0     ],
+                    [ 6, P, 3/Integer(2), 11732.3071041 ,  50.28825   ,-0.4940, 0.000560],# C: 0.000560 Steck
+
+                    [ 5, D, 3/Integer(2), 14499.2568    ,  48.78      , 0.1   , 0.0     ],
+                    [ 5, D, 5/Integer(2), 14596.84232   , -21.24      , 0.2   , 0.0     ],
+
+                    [ 7, S, 1/Integer(2), 18535.5286    , 545.90      , 0.0   , 0.0     ],
+
+                    [ 7, P, 1/Integer(2), 21765.348     ,  94.35      , 0.0   , 0.0     ],
+                    [ 7, P, 3/Integer(2), 21946.397     ,  16.609     , 0.0   , 0.0     ],
+
+                    [ 6, D, 3/Integer(2), 22588.8210    ,  16.34      ,-0.1   , 0.0     ],
+                    [ 6, D, 5/Integer(2), 22631.6863    ,  -4.66      , 0.9   , 0.0     ],
+
+                    [ 8, S, 1/Integer(2), 24317.149400  , 219.12      , 0.0   , 0.0     ],
+                    [ 4, F, 7/Integer(2), 24472.0455    ,   0.0       , 0.0   , 0.0     ],
+                    [ 4, F, 5/Integer(2), 24472.2269    ,   0.0       , 0.0   , 0.0     ],
+                    [ 8, P, 1/Integer(2), 25708.85473   ,  42.97      , 0.0   , 0.0     ],
+                    [ 8, P, 3/Integer(2), 25791.508     ,   7.626     , 0.0   , 0.0     ],
+                    [ 7, D, 3/Integer(2), 26047.8342    ,   7.4       , 0.0   , 0.0     ],
+                    [ 7, D, 5/Integer(2), 26068.7730    ,  -1.7       , 0.0   , 0.0     ],
+
+                    [ 9, S, 1/Integer(2), 26910.6627    , 110.1       , 0.0   , 0.0     ],
+                    [ 5, F, 7/Integer(2), 26971.1535    ,   0.0       , 0.0   , 0.0     ],
+                    [ 5, F, 5/Integer(2), 26971.3030    ,   0.0       , 0.0   , 0.0     ],
+                    [ 5, G, 7/Integer(2), 27008.0541    ,   0.0       , 0.0   , 0.0     ],
+                    [ 5, G, 9/Integer(2), 27008.0569    ,   0.0       , 0.0   , 0.0     ],
+                    [ 9, P, 1/Integer(2), 27636.9966    ,   0.0       , 0.0   , 0.0     ],
+                    [ 9, P, 3/Integer(2), 27681.6782    ,  23.19      , 0.0   , 0.0     ],
+                    [ 8, D, 3/Integer(2), 27811.2400    ,   4.129     , 0.0   , 0.0     ],
+                    [ 8, D, 5/Integer(2), 27822.8802    ,   3.95      , 0.0   , 0.0     ],
+                    [10, S, 1/Integer(2), 28300.2287    ,  -0.85      , 0.0   , 0.0     ],
+                    [ 6, F, 7/Integer(2), 28329.4075    ,  63.2       , 0.0   , 0.0     ],
+                    [ 6, F, 5/Integer(2), 28329.5133    ,   0.0       , 0.0   , 0.0     ],
+                    [ 6, G, 7/Integer(2), 28352.4444    ,   0.0       , 0.0   , 0.0     ],
+                    [ 6, G, 9/Integer(2), 28352.4460    ,   0.0       , 0.0   , 0.0     ],
+                    [10, P, 1/Integer(2), 28726.8123    ,  13.9       , 0.0   , 0.0     ],
+                    [10, P, 3/Integer(2), 28753.6769    ,   2.485     , 0.0   , 0.0     ],
+
+                    [ 9, D, 3/Integer(2), 28828.6820    ,   2.38      , 0.0   , 0.0     ],
+                    [ 9, D, 5/Integer(2), 28835.79192   ,  -0.45      , 0.0   , 0.0     ],
+                    [11, S, 1/Integer(2), 29131.73004   ,  39.4       , 0.0   , 0.0     ],
+                    [ 7, F, 7/Integer(2), 29147.90818   ,   0.0       , 0.0   , 0.0     ],
+                    [ 7, F, 5/Integer(2), 29147.98188   ,   0.0       , 0.0   , 0.0     ],
+                    [ 7, G, 7/Integer(2), 29163.07206   ,   0.0       , 0.0   , 0.0     ],
+                    [ 7, G, 9/Integer(2), 29163.0731    ,   0.0       , 0.0   , 0.0     ],
+                    [11, P, 1/Integer(2), 29403.42310   ,   0.0       , 0.0   , 0.0     ],
+                    [11, P, 3/Integer(2), 29420.824     ,   1.600     , 0.0   , 0.0     ],
+                    [10, D, 3/Integer(2), 29468.2878    ,   1.54      , 0.0   , 0.0     ],
+                    [10, D, 5/Integer(2), 29472.93995   ,  -0.35      , 0.0   , 0.0     ],
+                    [12, S, 1/Integer(2), 29668.80336   ,  26.31      , 0.0   , 0.0     ],
+
+                    [ 8, F, 7/Integer(2), 29678.68970   ,   0.0       , 0.0   , 0.0     ],
+                    [ 8, F, 5/Integer(2), 29678.74280   ,   0.0       , 0.0   , 0.0     ],
+                    [ 8, G, 7/Integer(2), 29689.13795   ,   0.0       , 0.0   , 0.0     ],
+                    [ 8, G, 9/Integer(2), 29689.1388    ,   0.0       , 0.0   , 0.0     ],
+                    [12, P, 1/Integer(2), 29852.43153   ,   0.0       , 0.0   , 0.0     ],
+                    [12, P, 3/Integer(2), 29864.345     ,   1.10      , 0.0   , 0.0     ],
+                    [11, D, 3/Integer(2), 29896.3399    ,   1.055     , 0.0   , 0.0     ],
+                    [11, D, 5/Integer(2), 29899.54646   ,   0.24      , 0.0   , 0.0     ],
+                    [13, S, 1/Integer(2), 30035.78836   ,  18.4       , 0.0   , 0.0     ],
+                    [ 9, F, 7/Integer(2), 30042.27515   ,   0.0       , 0.0   , 0.0     ],
+                    [ 9, F, 5/Integer(2), 30042.31405   ,   0.0       , 0.0   , 0.0     ],
+                    [ 9, G, 7/Integer(2), 30049.75317   ,   0.0       , 0.0   , 0.0     ],
+                    [ 9, G, 9/Integer(2), 30049.7545    ,   0.0       , 0.0   , 0.0     ],
+                    [13, P, 1/Integer(2), 30165.66826   ,   0.0       , 0.0   , 0.0     ],
+                    [13, P, 3/Integer(2), 30174.178     ,   0.77      , 0.0   , 0.0     ],
+
+                    [12, D, 3/Integer(2), 30196.7963    ,   0.758     , 0.0   , 0.0     ],
+                    [12, D, 5/Integer(2), 30199.09821   ,   0.19      , 0.0   , 0.0     ],
+                    [14, S, 1/Integer(2), 30297.64510   ,   13.4      , 0.0   , 0.0     ],
+                    [14, F, 7/Integer(2), 30302.13624   ,   0.0       , 0.0   , 0.0     ],
+                    [10, F, 5/Integer(2), 30302.16537   ,   0.0       , 0.0   , 0.0     ],
+                    [10, G, 7/Integer(2), 30307.66076   ,   0.0       , 0.0   , 0.0     ],
+                    [10, G, 9/Integer(2), 30307.6617    ,   0.0       , 0.0   , 0.0     ],
+                    [10, P, 1/Integer(2), 30392.8718    ,   0.0       , 0.0   , 0.0     ],
+                    [14, P, 3/Integer(2), 30399.163     ,   0.0       , 0.0   , 0.0     ],
+
+                    [13, D, 3/Integer(2), 30415.7533    ,   0.556     , 0.0   , 0.0     ],
+                    [13, D, 5/Integer(2), 30417.46075   ,   0.14      , 0.0   , 0.0     ],
+                    [15, S, 1/Integer(2), 30491.02346   ,  10.1       , 0.0   , 0.0     ],
+                    [11, F, 7/Integer(2), 30494.26583   ,   0.0       , 0.0   , 0.0     ],
+                    [11, F, 5/Integer(2), 30494.28809   ,   0.0       , 0.0   , 0.0     ],
+                    [11, G, 9/Integer(2), 30498.4556    ,   0.0       , 0.0   , 0.0     ],
+                    [11, G, 7/Integer(2), 30498.45695   ,   0.0       , 0.0   , 0.0     ],
+                    [15, P, 1/Integer(2), 30562.90893   ,   0.0       , 0.0   , 0.0     ],
+                    [15, P, 3/Integer(2), 30567.688     ,   0.0       , 0.0   , 0.0     ],
+                    [14, D, 3/Integer(2), 30580.2267    ,   0.425     , 0.0   , 0.0     ],
+                    [14, D, 5/Integer(2), 30581.52758   ,   0.0       , 0.0   , 0.0     ],
+                    [16, S, 1/Integer(2), 30637.88276   ,   7.73      , 0.0   , 0.0     ],
+
+                    [12, F, 7/Integer(2), 30640.30287   ,   0.0       , 0.0   , 0.0     ],
+                    [12, F, 5/Integer(2), 30640.32028   ,   0.0       , 0.0   , 0.0     ],
+                    [12, G, 7/Integer(2), 30643.55484   ,   0.0       , 0.0   , 0.0     ],
+                    [16, P, 1/Integer(2), 30693.47416   ,   0.0       , 0.0   , 0.0     ],
+                    [16, P, 3/Integer(2), 30697.191     ,   0.0       , 0.0   , 0.0     ],
+                    [15, D, 3/Integer(2), 30706.9003    ,   0.325     , 0.0   , 0.0     ],
+                    [15, D, 5/Integer(2), 30707.91378   ,   0.0       , 0.0   , 0.0     ],
+                    [17, S, 1/Integer(2), 30752.03412   ,   6.06      , 0.0   , 0.0     ],
+
+                    [13, F, 7/Integer(2), 30753.89018   ,   0.0       , 0.0   , 0.0     ],
+                    [13, F, 5/Integer(2), 30753.90406   ,   0.0       , 0.0   , 0.0     ],
+                    [13, G, 7/Integer(2), 30756.46241   ,   0.0       , 0.0   , 0.0     ],
+                    [17, P, 1/Integer(2), 30795.90702   ,   0.0       , 0.0   , 0.0     ],
+                    [17, P, 3/Integer(2), 30798.852     ,   0.0       , 0.0   , 0.0     ],
+                    [16, D, 3/Integer(2), 30806.5283    ,   0.255     , 0.0   , 0.0     ],
+                    [16, D, 5/Integer(2), 30807.33297   ,   0.0       , 0.0   , 0.0     ],
+                    [18, S, 1/Integer(2), 30842.51775   ,   0.0       , 0.0   , 0.0     ],
+                    [14, F, 7/Integer(2), 30843.97365   ,   0.0       , 0.0   , 0.0     ],
+                    [14, F, 5/Integer(2), 30843.98488   ,   0.0       , 0.0   , 0.0     ],
+                    [14, G, 7/Integer(2), 30846.04223   ,   0.0       , 0.0   , 0.0     ],
+
+                    [18, P, 1/Integer(2), 30877.74761   ,   0.0       , 0.0   , 0.0     ],
+                    [18, P, 3/Integer(2), 30880.1228    ,   0.0       , 0.0   , 0.0     ],
+                    [17, D, 3/Integer(2), 30886.2959    ,   0.190     , 0.0   , 0.0     ],
+                    [17, D, 5/Integer(2), 30886.94513   ,   0.0       , 0.0   , 0.0     ],
+                    [19, S, 1/Integer(2), 30915.45262   ,   0.0       , 0.0   , 0.0     ],
+                    [15, F, 7/Integer(2), 30916.61661   ,   0.0       , 0.0   , 0.0     ],
+                    [15, F, 5/Integer(2), 30916.62583   ,   0.0       , 0.0   , 0.0     ],
+                    [15, G, 7/Integer(2), 30918.30448   ,   0.0       , 0.0   , 0.0     ],
+                    [19, P, 1/Integer(2), 30944.16859   ,   0.0       , 0.0   , 0.0     ],
+                    [19, P, 3/Integer(2), 30946.113     ,   0.0       , 0.0   , 0.0     ],
+                    [18, D, 5/Integer(2), 30951.1511    ,   0.160     , 0.0   , 0.0     ],
+                    [18, D, 3/Integer(2), 30951.68259   ,   0.0       , 0.0   , 0.0     ],
+                    [20, S, 1/Integer(2), 30975.10034   ,   0.0       , 0.0   , 0.0     ],
+
+                    [16, F, 7/Integer(2), 30976.04620   ,   0.0       , 0.0   , 0.0     ],
+                    [16, F, 5/Integer(2), 30976.05385   ,   0.0       , 0.0   , 0.0     ],
+                    [16, G, 7/Integer(2), 30977.44090   ,   0.0       , 0.0   , 0.0     ],
+                    [20, P, 1/Integer(2), 30998.79      ,   0.0       , 0.0   , 0.0     ],
+                    [20, P, 3/Integer(2), 31000.40      ,   0.0       , 0.0   , 0.0     ],
+                    [19, D, 3/Integer(2), 31004.5900    ,   0.0       , 0.0   , 0.0     ],
+                    [19, D, 5/Integer(2), 31005.03231   ,   0.0       , 0.0   , 0.0     ],
+                    [21, S, 1/Integer(2), 31024.50355   ,   0.0       , 0.0   , 0.0     ],
+
+                    [17, F, 7/Integer(2), 31025.28272   ,   0.0       , 0.0   , 0.0     ],
+                    [17, F, 5/Integer(2), 31025.28907   ,   0.0       , 0.0   , 0.0     ],
+                    [17, G, 7/Integer(2), 31026.44832   ,   0.0       , 0.0   , 0.0     ],
+                    [21, P, 1/Integer(2), 31044.31315   ,   0.0       , 0.0   , 0.0     ],
+                    [21, P, 3/Integer(2), 31045.664     ,   0.0       , 0.0   , 0.0     ],
+                    [20, D, 3/Integer(2), 31049.1456    ,   0.0       , 0.0   , 0.0     ],
+                    [20, D, 5/Integer(2), 31049.51701   ,   0.0       , 0.0   , 0.0     ],
+                    [22, S, 1/Integer(2), 31065.88056   ,   0.0       , 0.0   , 0.0     ],
+
+                    [18, F, 7/Integer(2), 31066.53042   ,   0.0       , 0.0   , 0.0     ],
+                    [18, F, 5/Integer(2), 31066.53582   ,   0.0       , 0.0   , 0.0     ],
+                    [18, G, 7/Integer(2), 31067.51435   ,   0.0       , 0.0   , 0.0     ],
+                    [22, P, 1/Integer(2), 31082.5979    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [22, P, 3/Integer(2), 31083.77      ,   0.0       , 0.0   , 0.0     ],
+                    [21, D, 3/Integer(2), 31086.6824    ,   0.0       , 0.0   , 0.0     ],
+                    [21, D, 5/Integer(2), 31086.99717   ,   0.0       , 0.0   , 0.0     ],
+                    [23, S, 1/Integer(2), 31100.88052   ,   2.4       , 0.0   , 0.0     ],
+                    [19, F, 7/Integer(2), 31101.42859   ,   0.0       , 0.0   , 0.0     ],
+                    [19, F, 5/Integer(2), 31101.43321   ,   0.0       , 0.0   , 0.0     ],
+                    [19, G, 7/Integer(2), 31102.26518   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [23, P, 1/Integer(2), 31115.11733   ,   0.56      , 0.0   , 0.0     ],
+                    [23, P, 3/Integer(2), 31116.0904    ,   0.0       , 0.0   , 0.0     ],
+                    [22, D, 3/Integer(2), 31118.60105   ,   0.0       , 0.0   , 0.0     ],
+                    [22, D, 5/Integer(2), 31118.86983   ,   0.0       , 0.0   , 0.0     ],
+                    [24, S, 1/Integer(2), 31130.74987   ,   0.0       , 0.0   , 0.0     ],
+
+                    [20, F, 7/Integer(2), 31131.21615   ,   0.0       , 0.0   , 0.0     ],
+                    [20, F, 5/Integer(2), 31131.22012   ,   0.0       , 0.0   , 0.0     ],
+                    [20, G, 7/Integer(2), 31131.93570   ,   0.0       , 0.0   , 0.0     ],
+                    [24, P, 1/Integer(2), 31142.9734    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [24, P, 3/Integer(2), 31143.84      ,   0.0       , 0.0   , 0.0     ],
+                    [23, D, 3/Integer(2), 31145.9690    ,   0.0       , 0.0   , 0.0     ],
+                    [23, D, 5/Integer(2), 31146.20007   ,   0.0       , 0.0   , 0.0     ],
+                    [25, S, 1/Integer(2), 31156.44439   ,   1.4       , 0.0   , 0.0     ],
+
+                    [21, F, 7/Integer(2), 31156.8447    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [21, F, 5/Integer(2), 31156.8482    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [21, G, 7/Integer(2), 31157.46595   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [25, P, 1/Integer(2), 31167.01727   ,   0.40      , 0.0   , 0.0     ],
+                    [25, P, 3/Integer(2), 31167.74257   ,   0.0       , 0.0   , 0.0     ],
+                    [24, D, 3/Integer(2), 31169.6144    ,   0.0       , 0.0   , 0.0     ],
+                    [24, D, 5/Integer(2), 31169.81187   ,   0.0       , 0.0   , 0.0     ],
+                    [22, F, 7/Integer(2), 31179.05392   ,   0.0       , 0.0   , 0.0     ],
+                    [22, F, 5/Integer(2), 31179.05692   ,   0.0       , 0.0   , 0.0     ],
+                    [22, G, 7/Integer(2), 31179.59567   ,   0.0       , 0.0   , 0.0     ],
+                    [25, D, 3/Integer(2), 31190.17569   ,   0.0       , 0.0   , 0.0     ],
+                    [25, D, 5/Integer(2), 31190.35063   ,   0.0       , 0.0   , 0.0     ],
+                    [23, F, 7/Integer(2), 31198.4257    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [23, F, 5/Integer(2), 31198.4283    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [23, G, 7/Integer(2), 31198.89936   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [24, F, 7/Integer(2), 31215.42383   ,   0.0       , 0.0   , 0.0     ],
+                    [24, F, 5/Integer(2), 31215.42620   ,   0.0       , 0.0   , 0.0     ],
+                    [24, G, 7/Integer(2), 31215.84176   ,   0.0       , 0.0   , 0.0     ],
+                    [25, F, 7/Integer(2), 31230.4208    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [25, F, 5/Integer(2), 31230.4229    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    [25, G, 7/Integer(2), 31230.79013   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
+                    ]
+
+        else:
+            s = "The isotope "+str(isotope)+str(element)
+            s += " is not in the database."
+            raise ValueError, s
+        # We rewrite the table in Hz
+        nivfin=[ nivfin[ii][:3] + [nivfin[ii][3]*c*100 ] +[nivfin[ii][4]*1e6 ]
+                                + [nivfin[ii][5]*1e6   ] +[nivfin[ii][6]*1e6 ] for ii in range(len(nivfin)) ]
+
+    else:
+        s = "The element "+str(element)+" is not in the database."
+        raise ValueError, s
+
+    table = {}
+    for level in nivfin:
+        key = (level[0], level[1], int(2*level[2]))
+        if key not in table: table[key] = level
+    fine_structure_tables[(element, isotope)] = table
+    return table
+
+
+
+# The states already created, indexed by their arguments, and the atoms they
+# share (one per isotope).
+interned_states = {}
+shared_atoms = {}
+
+
+def orbital_quantum_number(l):
+    r"""Go from chemical notation to the orbital quantum number l.
+
+    >>> orbital_quantum_number('P'), orbital_quantum_number(2)
+    (1, 2)
+    """
+    letters = ['S', 'P', 'D', 'F', 'G', 'H', 'I']
+    if str(l).upper() in letters: return letters.index(str(l).upper())
+    return l
+
+
 class State(object):
     r"""This class implements specific eigenstates of the atomic hamiltonian.
 
@@ -435,16 +860,43 @@ class State(object):
     A latex representation:
     >>> print g2._latex_()
     ^{133}\mathrm{Cs}\ 6S_{1/2}^{4,4}
+
+    States are immutable values: a state is only created once, and it can be
+    used in sets and as a key of dictionaries.
+    >>> State("Cs", 133, 6, 0, 1/Integer(2), 4, 4) is g2
+    True
+    >>> g2 in set([e, g2])
+    True
     """
 
+    __slots__ = ['atom', 'element', 'isotope', 'Z', 'neutrons', 'abundance',
+                 'mass', 'n', 'l', 'j', 'f', 'm', 'quantum_numbers', 'i',
+                 'Ahfs', 'Bhfs', 'Chfs', 'mperm', 'fperm',
+                 'hyperfine_structure', 'nu', 'omega', '_hash']
+
+    def __new__(cls, element, isotope, n, l=None, j=None, f=None, m=None):
+        r"""Return the state if it was already created."""
+        key = (State, element, isotope, n, orbital_quantum_number(l), j, f, m)
+        if key in interned_states:
+            return interned_states[key]
+        return object.__new__(cls)
+
     def __init__(self, element, isotope, n, l=None, j=None, f=None, m=None):
         r"""Initialize states.
 
         >>> State("Rb",85,5,0,1/Integer(2))
         85Rb 5S_1/2
         """
-        # We declare the atom to which this state belongs.
-        atom = Atom(element, isotope)
+        # Interned states are already initialized.
+        if hasattr(self, '_hash'): return
+        intern_key = (State, element, isotope, n, orbital_quantum_number(l),
+                      j, f, m)
+
+        # We declare the atom to which this state belongs, which is shared by
+        # all the states of the same isotope.
+        if (element, isotope) not in shared_atoms:
+            shared_atoms[(element, isotope)] = Atom(element, isotope)
+        atom = shared_atoms[(element, isotope)]
         self.atom = atom
         self.element = element
         self.isotope = isotope
@@ -465,13 +917,7 @@ class State(object):
             raise NotImplementedError, s
 
         # We go from chemical notation to quantum numbers.
-        if str(l) in ['S', 's']: l = 0
-        if str(l) in ['P', 'p']: l = 1
-        if str(l) in ['D', 'd']: l = 2
-        if str(l) in ['F', 'f']: l = 3
-        if str(l) in ['G', 'g']: l = 4
-        if str(l) in ['H', 'h']: l = 5
-        if str(l) in ['I', 'i']: l = 6
+        l = orbital_quantum_number(l)
 
         # We check the value of l.
         lperm = range(0, n)
@@ -492,346 +938,19 @@ class State(object):
         self.m = m
         self.quantum_numbers = [isotope, n, l, j]
 
-        # We calculate the energy of the state.
-        ################################################################
-        # the l values of letters in
-        S = 0
-        P = 1
-        D = 2
-        F = 3
-        G = 4
-        H = 5
-        I = 6
-        from scipy.constants import c
-        # All tables are given in (cm^-1).
+        # We find the energy of the state up to fine structure and the
+        # hyperfine constants in the database.
         i = atom.nuclear_spin
-        if element == "Rb":
-            if isotope==85:
-                #        N, L,     K       , E (cm^-1),      A (cm^-1)      B (cm^-1)    C (cm^-1)
-                nivfin=[[ 5, S, 1/Integer(2), 0.0000000  , 0.033753721     , 0.0       , 0.0],
-                        [ 5, P, 1/Integer(2), 12578.950  , 0.004026        , 0.0       , 0.0],
-                        [ 5, P, 3/Integer(2), 12816.545  , 0.0008352       , 0.0008676 , 0.0],
-
-                        [ 4, D, 5/Integer(2), 19355.203  , 0.000168        , 0.0       , 0.0],
-                        [ 4, D, 3/Integer(2), 19355.649  , 0.000244        , 0.0       , 0.0],
-
-                        [ 6, S, 1/Integer(2), 20132.460  , 239.18e6/(c*100), 0.0       , 0.0],
-
-                        [ 6, P, 1/Integer(2), 23715.081  , 0.001305        , 0.0       , 0.0],
-                        [ 6, P, 3/Integer(2), 23792.591  , 0.0002723       , 0.0002732 , 0.0],
-
-                        [ 5, D, 3/Integer(2), 25700.536  , 0.000140834     , 0.00006373, 0.0],
-                        [ 5, D, 5/Integer(2), 25703.498  ,-0.00007309      , 0.0000894 , 0.0],
-
-                        [ 7, S, 1/Integer(2), 26311.437  , 0.003159        , 0.0       , 0.0],
-
-                        [ 7, P, 1/Integer(2), 27835.02   , 0.000590        , 0.0       , 0.0],
-                        [ 7, P, 3/Integer(2), 27870.11   , 0.0001238       , 0.000123  , 0.0],
-
-                        [ 6, D, 3/Integer(2), 28687.127  , 0.000077        , 0.000054  , 0.0],
-                        [ 7, D, 3/Integer(2), 30280.113  , 0.0000472       , 0.000010  , 0.0],
-                        [14, S, 1/Integer(2), 32761.60069, 0.0             , 0.0       , 0.0],
-
-                        [15, S, 1/Integer(2), 32911.63322, 0.0             , 0.0       , 0.0],
-                        [16, S, 1/Integer(2), 33028.05246, 0.0             , 0.0       , 0.0],
-                        [17, S, 1/Integer(2), 33120.19975, 0.0             , 0.0       , 0.0],
-                        [18, S, 1/Integer(2), 33194.38247, 0.0             , 0.0       , 0.0],
-                        [19, S, 1/Integer(2), 33254.98464, 0.0             , 0.0       , 0.0],
-                        [20, S, 1/Integer(2), 33305.12986, 0.0             , 0.0       , 0.0],
-                        [21, S, 1/Integer(2), 33347.09244, 0.0             , 0.0       , 0.0],
-                        [22, S, 1/Integer(2), 33382.56103, 0.0             , 0.0       , 0.0],
-                        [23, S, 1/Integer(2), 33412.80991, 0.0             , 0.0       , 0.0],
-                        [24, S, 1/Integer(2), 33438.81426, 0.0             , 0.0       , 0.0],
-                        [25, S, 1/Integer(2), 33461.33387, 0.0             , 0.0       , 0.0],
-
-                        [26, S, 1/Integer(2), 33480.96379, 0.0             , 0.0       , 0.0],
-                        [27, S, 1/Integer(2), 33498.17857, 0.0             , 0.0       , 0.0],
-                        [28, S, 1/Integer(2), 33513.35849, 0.0             , 0.0       , 0.0],
-                        [29, S, 1/Integer(2), 33526.81233, 0.0             , 0.0       , 0.0],
-                        [30, S, 1/Integer(2), 33538.79178, 0.0             , 0.0       , 0.0],
-                        [31, S, 1/Integer(2), 33549.50518, 0.0             , 0.0       , 0.0],
-                        [32, S, 1/Integer(2), 33559.12441, 0.0             , 0.0       , 0.0],
-                        [33, S, 1/Integer(2), 33567.79401, 0.0             , 0.0       , 0.0],
-                        [34, S, 1/Integer(2), 33575.63464, 0.0             , 0.0       , 0.0],
-                        [35, S, 1/Integer(2), 33582.74865, 0.0             , 0.0       , 0.0],
-
-                        [36, S, 1/Integer(2), 33589.22335, 0.0             , 0.0       , 0.0],
-                        [37, S, 1/Integer(2), 33595.13297, 0.0             , 0.0       , 0.0],
-                        [38, S, 1/Integer(2), 33600.54153, 0.0             , 0.0       , 0.0],
-                        [39, S, 1/Integer(2), 33605.50403, 0.0             , 0.0       , 0.0],
-                        [40, S, 1/Integer(2), 33610.06832, 0.0             , 0.0       , 0.0],
-                        [41, S, 1/Integer(2), 33614.27566, 0.0             , 0.0       , 0.0],
-                        [42, S, 1/Integer(2), 33618.16244, 0.0             , 0.0       , 0.0],
-                        [43, S, 1/Integer(2), 33621.76072, 0.0             , 0.0       , 0.0],
-                        [44, S, 1/Integer(2), 33625.09801, 0.0             , 0.0       , 0.0],
-                        [45, S, 1/Integer(2), 33628.19886, 0.0             , 0.0       , 0.0],
-
-                        [46, S, 1/Integer(2), 33631.08524, 0.0             , 0.0       , 0.0],
-                        [47, S, 1/Integer(2), 33633.77664, 0.0             , 0.0       , 0.0],
-                        [48, S, 1/Integer(2), 33636.29016, 0.0             , 0.0       , 0.0],
-                        [49, S, 1/Integer(2), 33638.64086, 0.0             , 0.0       , 0.0],
-                        [50, S, 1/Integer(2), 33640.84283, 0.0             , 0.0       , 0.0],
-                        ]
-
-            elif isotope == 87:
-                #        N, L,     K       , E (cm^-1),      A (cm^-1)      B (cm^-1)      C (cm^-1)
-                nivfin=[[5, S, 1/Integer(2), 0.0000000, 0.113990236053642, 0.0            , 0.0],
-                        [5, P, 1/Integer(2), 12578.950, 0.01365          , 0.0            , 0.0],
-                        [5, P, 3/Integer(2), 12816.545, 0.0028259        , 0.00041684     , 0.0],
-
-                        [4, D, 5/Integer(2), 19355.203,-16.801e6/(c*100) , 3.645e6/(c*100), 0.0],# Not Sansonetti.
-                        [4, D, 3/Integer(2), 19355.649, 24.750e6/(c*100) , 2.190e6/(c*100), 0.0],# Not Sansonetti.
-
-                        [6, S, 1/Integer(2), 20132.460, 807.66e6/(c*100) , 0.0            , 0.0],# Not Sansonetti.
-
-                        [6, P, 1/Integer(2), 23715.081, 0.0044217        , 0.0            , 0.0],
-                        [6, P, 3/Integer(2), 23792.591, 0.000924         , 0.000132       , 0.0],
-
-                        [5, D, 3/Integer(2), 25700.536, 0.00048134       , 0.00003109     , 0.0],
-                        [5, D, 5/Integer(2), 25703.498, -0.00024886      , 0.00004241     , 0.0],
-
-                        [7, S, 1/Integer(2), 26311.437, 0.010664         , 0.0            , 0.0],
-
-                        [7, P, 1/Integer(2), 27835.020, 0.001999         , 0.0            , 0.0],
-                        [7, P, 3/Integer(2), 27870.110, 0.0004193        , 0.00005700     , 0.0]
-                        ]
-
-            else:
-                s = "The isotope "+str(isotope)+str(element)+" is not in the database."
-                raise ValueError, s
-            # We rewrite the table in Hz
-            nivfin=[ nivfin[ii][:3] + [nivfin[ii][3]*c*100 ] +[nivfin[ii][4]*c*100 ] +[nivfin[ii][5]*c*100 ]
-                                    + [nivfin[ii][6]*c*100 ] for ii in range(len(nivfin)) ]
-
-        elif element == "Cs":
-            if isotope == 133:
-                # Reference [1], others not used yet [2]:
-                #        N, L,     K       , E (cm^-1),       A (MHz)      B (MHz)   C (MHz)
-
-                nivfin=[[ 6, S, 1/Integer(2),     0         , 2298.1579425, 0     , 1.0     ],# This is exact.
-
-                        [ 6, P, 1/Integer(2), 11178.26815870,  291.9309   , 0.0   , 0.0     ],
-                        [ 6, P, 3/Integer(2), 11732.3071041 ,  50.28825   ,-0.4940, 0.000560],# C: 0.000560 Steck
-
-                        [ 5, D, 3/Integer(2), 14499.2568    ,  48.78      , 0.1   , 0.0     ],
-                        [ 5, D, 5/Integer(2), 14596.84232   , -21.24      , 0.2   , 0.0     ],
-
-                        [ 7, S, 1/Integer(2), 18535.5286    , 545.90      , 0.0   , 0.0     ],
-
-                        [ 7, P, 1/Integer(2), 21765.348     ,  94.35      , 0.0   , 0.0     ],
-                        [ 7, P, 3/Integer(2), 21946.397     ,  16.609     , 0.0   , 0.0     ],
-
-                        [ 6, D, 3/Integer(2), 22588.8210    ,  16.34      ,-0.1   , 0.0     ],
-                        [ 6, D, 5/Integer(2), 22631.6863    ,  -4.66      , 0.9   , 0.0     ],
-
-                        [ 8, S, 1/Integer(2), 24317.149400  , 219.12      , 0.0   , 0.0     ],
-                        [ 4, F, 7/Integer(2), 24472.0455    ,   0.0       , 0.0   , 0.0     ],
-                        [ 4, F, 5/Integer(2), 24472.2269    ,   0.0       , 0.0   , 0.0     ],
-                        [ 8, P, 1/Integer(2), 25708.85473   ,  42.97      , 0.0   , 0.0     ],
-                        [ 8, P, 3/Integer(2), 25791.508     ,   7.626     , 0.0   , 0.0     ],
-                        [ 7, D, 3/Integer(2), 26047.8342    ,   7.4       , 0.0   , 0.0     ],
-                        [ 7, D, 5/Integer(2), 26068.7730    ,  -1.7       , 0.0   , 0.0     ],
-
-                        [ 9, S, 1/Integer(2), 26910.6627    , 110.1       , 0.0   , 0.0     ],
-                        [ 5, F, 7/Integer(2), 26971.1535    ,   0.0       , 0.0   , 0.0     ],
-                        [ 5, F, 5/Integer(2), 26971.3030    ,   0.0       , 0.0   , 0.0     ],
-                        [ 5, G, 7/Integer(2), 27008.0541    ,   0.0       , 0.0   , 0.0     ],
-                        [ 5, G, 9/Integer(2), 27008.0569    ,   0.0       , 0.0   , 0.0     ],
-                        [ 9, P, 1/Integer(2), 27636.9966    ,   0.0       , 0.0   , 0.0     ],
-                        [ 9, P, 3/Integer(2), 27681.6782    ,  23.19      , 0.0   , 0.0     ],
-                        [ 8, D, 3/Integer(2), 27811.2400    ,   4.129     , 0.0   , 0.0     ],
-                        [ 8, D, 5/Integer(2), 27822.8802    ,   3.95      , 0.0   , 0.0     ],
-                        [10, S, 1/Integer(2), 28300.2287    ,  -0.85      , 0.0   , 0.0     ],
-                        [ 6, F, 7/Integer(2), 28329.4075    ,  63.2       , 0.0   , 0.0     ],
-                        [ 6, F, 5/Integer(2), 28329.5133    ,   0.0       , 0.0   , 0.0     ],
-                        [ 6, G, 7/Integer(2), 28352.4444    ,   0.0       , 0.0   , 0.0     ],
-                        [ 6, G, 9/Integer(2), 28352.4460    ,   0.0       , 0.0   , 0.0     ],
-                        [10, P, 1/Integer(2), 28726.8123    ,  13.9       , 0.0   , 0.0     ],
-                        [10, P, 3/Integer(2), 28753.6769    ,   2.485     , 0.0   , 0.0     ],
-
-                        [ 9, D, 3/Integer(2), 28828.6820    ,   2.38      , 0.0   , 0.0     ],
-                        [ 9, D, 5/Integer(2), 28835.79192   ,  -0.45      , 0.0   , 0.0     ],
-                        [11, S, 1/Integer(2), 29131.73004   ,  39.4       , 0.0   , 0.0     ],
-                        [ 7, F, 7/Integer(2), 29147.90818   ,   0.0       , 0.0   , 0.0     ],
-                        [ 7, F, 5/Integer(2), 29147.98188   ,   0.0       , 0.0   , 0.0     ],
-                        [ 7, G, 7/Integer(2), 29163.07206   ,   0.0       , 0.0   , 0.0     ],
-                        [ 7, G, 9/Integer(2), 29163.0731    ,   0.0       , 0.0   , 0.0     ],
-                        [11, P, 1/Integer(2), 29403.42310   ,   0.0       , 0.0   , 0.0     ],
-                        [11, P, 3/Integer(2), 29420.824     ,   1.600     , 0.0   , 0.0     ],
-                        [10, D, 3/Integer(2), 29468.2878    ,   1.54      , 0.0   , 0.0     ],
-                        [10, D, 5/Integer(2), 29472.93995   ,  -0.35      , 0.0   , 0.0     ],
-                        [12, S, 1/Integer(2), 29668.80336   ,  26.31      , 0.0   , 0.0     ],
-
-                        [ 8, F, 7/Integer(2), 29678.68970   ,   0.0       , 0.0   , 0.0     ],
-                        [ 8, F, 5/Integer(2), 29678.74280   ,   0.0       , 0.0   , 0.0     ],
-                        [ 8, G, 7/Integer(2), 29689.13795   ,   0.0       , 0.0   , 0.0     ],
-                        [ 8, G, 9/Integer(2), 29689.1388    ,   0.0       , 0.0   , 0.0     ],
-                        [12, P, 1/Integer(2), 29852.43153   ,   0.0       , 0.0   , 0.0     ],
-                        [12, P, 3/Integer(2), 29864.345     ,   1.10      , 0.0   , 0.0     ],
-                        [11, D, 3/Integer(2), 29896.3399    ,   1.055     , 0.0   , 0.0     ],
-                        [11, D, 5/Integer(2), 29899.54646   ,   0.24      , 0.0   , 0.0     ],
-                        [13, S, 1/Integer(2), 30035.78836   ,  18.4       , 0.0   , 0.0     ],
-                        [ 9, F, 7/Integer(2), 30042.27515   ,   0.0       , 0.0   , 0.0     ],
-                        [ 9, F, 5/Integer(2), 30042.31405   ,   0.0       , 0.0   , 0.0     ],
-                        [ 9, G, 7/Integer(2), 30049.75317   ,   0.0       , 0.0   , 0.0     ],
-                        [ 9, G, 9/Integer(2), 30049.7545    ,   0.0       , 0.0   , 0.0     ],
-                        [13, P, 1/Integer(2), 30165.66826   ,   0.0       , 0.0   , 0.0     ],
-                        [13, P, 3/Integer(2), 30174.178     ,   0.77      , 0.0   , 0.0     ],
-
-                        [12, D, 3/Integer(2), 30196.7963    ,   0.758     , 0.0   , 0.0     ],
-                        [12, D, 5/Integer(2), 30199.09821   ,   0.19      , 0.0   , 0.0     ],
-                        [14, S, 1/Integer(2), 30297.64510   ,   13.4      , 0.0   , 0.0     ],
-                        [14, F, 7/Integer(2), 30302.13624   ,   0.0       , 0.0   , 0.0     ],
-                        [10, F, 5/Integer(2), 30302.16537   ,   0.0       , 0.0   , 0.0     ],
-                        [10, G, 7/Integer(2), 30307.66076   ,   0.0       , 0.0   , 0.0     ],
-                        [10, G, 9/Integer(2), 30307.6617    ,   0.0       , 0.0   , 0.0     ],
-                        [10, P, 1/Integer(2), 30392.8718    ,   0.0       , 0.0   , 0.0     ],
-                        [14, P, 3/Integer(2), 30399.163     ,   0.0       , 0.0   , 0.0     ],
-
-                        [13, D, 3/Integer(2), 30415.7533    ,   0.556     , 0.0   , 0.0     ],
-                        [13, D, 5/Integer(2), 30417.46075   ,   0.14      , 0.0   , 0.0     ],
-                        [15, S, 1/Integer(2), 30491.02346   ,  10.1       , 0.0   , 0.0     ],
-                        [11, F, 7/Integer(2), 30494.26583   ,   0.0       , 0.0   , 0.0     ],
-                        [11, F, 5/Integer(2), 30494.28809   ,   0.0       , 0.0   , 0.0     ],
-                        [11, G, 9/Integer(2), 30498.4556    ,   0.0       , 0.0   , 0.0     ],
-                        [11, G, 7/Integer(2), 30498.45695   ,   0.0       , 0.0   , 0.0     ],
-                        [15, P, 1/Integer(2), 30562.90893   ,   0.0       , 0.0   , 0.0     ],
-                        [15, P, 3/Integer(2), 30567.688     ,   0.0       , 0.0   , 0.0     ],
-                        [14, D, 3/Integer(2), 30580.2267    ,   0.425     , 0.0   , 0.0     ],
-                        [14, D, 5/Integer(2), 30581.52758   ,   0.0       , 0.0   , 0.0     ],
-                        [16, S, 1/Integer(2), 30637.88276   ,   7.73      , 0.0   , 0.0     ],
-
-                        [12, F, 7/Integer(2), 30640.30287   ,   0.0       , 0.0   , 0.0     ],
-                        [12, F, 5/Integer(2), 30640.32028   ,   0.0       , 0.0   , 0.0     ],
-                        [12, G, 7/Integer(2), 30643.55484   ,   0.0       , 0.0   , 0.0     ],
-                        [16, P, 1/Integer(2), 30693.47416   ,   0.0       , 0.0   , 0.0     ],
-                        [16, P, 3/Integer(2), 30697.191     ,   0.0       , 0.0   , 0.0     ],
-                        [15, D, 3/Integer(2), 30706.9003    ,   0.325     , 0.0   , 0.0     ],
-                        [15, D, 5/Integer(2), 30707.91378   ,   0.0       , 0.0   , 0.0     ],
-                        [17, S, 1/Integer(2), 30752.03412   ,   6.06      , 0.0   , 0.0     ],
-
-                        [13, F, 7/Integer(2), 30753.89018   ,   0.0       , 0.0   , 0.0     ],
-                        [13, F, 5/Integer(2), 30753.90406   ,   0.0       , 0.0   , 0.0     ],
-                        [13, G, 7/Integer(2), 30756.46241   ,   0.0       , 0.0   , 0.0     ],
-                        [17, P, 1/Integer(2), 30795.90702   ,   0.0       , 0.0   , 0.0     ],
-                        [17, P, 3/Integer(2), 30798.852     ,   0.0       , 0.0   , 0.0     ],
-                        [16, D, 3/Integer(2), 30806.5283    ,   0.255     , 0.0   , 0.0     ],
-                        [16, D, 5/Integer(2), 30807.33297   ,   0.0       , 0.0   , 0.0     ],
-                        [18, S, 1/Integer(2), 30842.51775   ,   0.0       , 0.0   , 0.0     ],
-                        [14, F, 7/Integer(2), 30843.97365   ,   0.0       , 0.0   , 0.0     ],
-                        [14, F, 5/Integer(2), 30843.98488   ,   0.0       , 0.0   , 0.0     ],
-                        [14, G, 7/Integer(2), 30846.04223   ,   0.0       , 0.0   , 0.0     ],
-
-                        [18, P, 1/Integer(2), 30877.74761   ,   0.0       , 0.0   , 0.0     ],
-                        [18, P, 3/Integer(2), 30880.1228    ,   0.0       , 0.0   , 0.0     ],
-                        [17, D, 3/Integer(2), 30886.2959    ,   0.190     , 0.0   , 0.0     ],
-                        [17, D, 5/Integer(2), 30886.94513   ,   0.0       , 0.0   , 0.0     ],
-                        [19, S, 1/Integer(2), 30915.45262   ,   0.0       , 0.0   , 0.0     ],
-                        [15, F, 7/Integer(2), 30916.61661   ,   0.0       , 0.0   , 0.0     ],
-                        [15, F, 5/Integer(2), 30916.62583   ,   0.0       , 0.0   , 0.0     ],
-                        [15, G, 7/Integer(2), 30918.30448   ,   0.0       , 0.0   , 0.0     ],
-                        [19, P, 1/Integer(2), 30944.16859   ,   0.0       , 0.0   , 0.0     ],
-                        [19, P, 3/Integer(2), 30946.113     ,   0.0       , 0.0   , 0.0     ],
-                        [18, D, 5/Integer(2), 30951.1511    ,   0.160     , 0.0   , 0.0     ],
-                        [18, D, 3/Integer(2), 30951.68259   ,   0.0       , 0.0   , 0.0     ],
-                        [20, S, 1/Integer(2), 30975.10034   ,   0.0       , 0.0   , 0.0     ],
-
-                        [16, F, 7/Integer(2), 30976.04620   ,   0.0       , 0.0   , 0.0     ],
-                        [16, F, 5/Integer(2), 30976.05385   ,   0.0       , 0.0   , 0.0     ],
-                        [16, G, 7/Integer(2), 30977.44090   ,   0.0       , 0.0   , 0.0     ],
-                        [20, P, 1/Integer(2), 30998.79      ,   0.0       , 0.0   , 0.0     ],
-                        [20, P, 3/Integer(2), 31000.40      ,   0.0       , 0.0   , 0.0     ],
-                        [19, D, 3/Integer(2), 31004.5900    ,   0.0       , 0.0   , 0.0     ],
-                        [19, D, 5/Integer(2), 31005.03231   ,   0.0       , 0.0   , 0.0     ],
-                        [21, S, 1/Integer(2), 31024.50355   ,   0.0       , 0.0   , 0.0     ],
-
-                        [17, F, 7/Integer(2), 31025.28272   ,   0.0       , 0.0   , 0.0     ],
-                        [17, F, 5/Integer(2), 31025.28907   ,   0.0       , 0.0   , 0.0     ],
-                        [17, G, 7/Integer(2), 31026.44832   ,   0.0       , 0.0   , 0.0     ],
-                        [21, P, 1/Integer(2), 31044.31315   ,   0.0       , 0.0   , 0.0     ],
-                        [21, P, 3/Integer(2), 31045.664     ,   0.0       , 0.0   , 0.0     ],
-                        [20, D, 3/Integer(2), 31049.1456    ,   0.0       , 0.0   , 0.0     ],
-                        [20, D, 5/Integer(2), 31049.51701   ,   0.0       , 0.0   , 0.0     ],
-                        [22, S, 1/Integer(2), 31065.88056   ,   0.0       , 0.0   , 0.0     ],
-
-                        [18, F, 7/Integer(2), 31066.53042   ,   0.0       , 0.0   , 0.0     ],
-                        [18, F, 5/Integer(2), 31066.53582   ,   0.0       , 0.0   , 0.0     ],
-                        [18, G, 7/Integer(2), 31067.51435   ,   0.0       , 0.0   , 0.0     ],
-                        [22, P, 1/Integer(2), 31082.5979    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [22, P, 3/Integer(2), 31083.77      ,   0.0       , 0.0   , 0.0     ],
-                        [21, D, 3/Integer(2), 31086.6824    ,   0.0       , 0.0   , 0.0     ],
-                        [21, D, 5/Integer(2), 31086.99717   ,   0.0       , 0.0   , 0.0     ],
-                        [23, S, 1/Integer(2), 31100.88052   ,   2.4       , 0.0   , 0.0     ],
-                        [19, F, 7/Integer(2), 31101.42859   ,   0.0       , 0.0   , 0.0     ],
-                        [19, F, 5/Integer(2), 31101.43321   ,   0.0       , 0.0   , 0.0     ],
-                        [19, G, 7/Integer(2), 31102.26518   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [23, P, 1/Integer(2), 31115.11733   ,   0.56      , 0.0   , 0.0     ],
-                        [23, P, 3/Integer(2), 31116.0904    ,   0.0       , 0.0   , 0.0     ],
-                        [22, D, 3/Integer(2), 31118.60105   ,   0.0       , 0.0   , 0.0     ],
-                        [22, D, 5/Integer(2), 31118.86983   ,   0.0       , 0.0   , 0.0     ],
-                        [24, S, 1/Integer(2), 31130.74987   ,   0.0       , 0.0   , 0.0     ],
-
-                        [20, F, 7/Integer(2), 31131.21615   ,   0.0       , 0.0   , 0.0     ],
-                        [20, F, 5/Integer(2), 31131.22012   ,   0.0       , 0.0   , 0.0     ],
-                        [20, G, 7/Integer(2), 31131.93570   ,   0.0       , 0.0   , 0.0     ],
-                        [24, P, 1/Integer(2), 31142.9734    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [24, P, 3/Integer(2), 31143.84      ,   0.0       , 0.0   , 0.0     ],
-                        [23, D, 3/Integer(2), 31145.9690    ,   0.0       , 0.0   , 0.0     ],
-                        [23, D, 5/Integer(2), 31146.20007   ,   0.0       , 0.0   , 0.0     ],
-                        [25, S, 1/Integer(2), 31156.44439   ,   1.4       , 0.0   , 0.0     ],
-
-                        [21, F, 7/Integer(2), 31156.8447    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [21, F, 5/Integer(2), 31156.8482    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [21, G, 7/Integer(2), 31157.46595   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [25, P, 1/Integer(2), 31167.01727   ,   0.40      , 0.0   , 0.0     ],
-                        [25, P, 3/Integer(2), 31167.74257   ,   0.0       , 0.0   , 0.0     ],
-                        [24, D, 3/Integer(2), 31169.6144    ,   0.0       , 0.0   , 0.0     ],
-                        [24, D, 5/Integer(2), 31169.81187   ,   0.0       , 0.0   , 0.0     ],
-                        [22, F, 7/Integer(2), 31179.05392   ,   0.0       , 0.0   , 0.0     ],
-                        [22, F, 5/Integer(2), 31179.05692   ,   0.0       , 0.0   , 0.0     ],
-                        [22, G, 7/Integer(2), 31179.59567   ,   0.0       , 0.0   , 0.0     ],
-                        [25, D, 3/Integer(2), 31190.17569   ,   0.0       , 0.0   , 0.0     ],
-                        [25, D, 5/Integer(2), 31190.35063   ,   0.0       , 0.0   , 0.0     ],
-                        [23, F, 7/Integer(2), 31198.4257    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [23, F, 5/Integer(2), 31198.4283    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [23, G, 7/Integer(2), 31198.89936   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [24, F, 7/Integer(2), 31215.42383   ,   0.0       , 0.0   , 0.0     ],
-                        [24, F, 5/Integer(2), 31215.42620   ,   0.0       , 0.0   , 0.0     ],
-                        [24, G, 7/Integer(2), 31215.84176   ,   0.0       , 0.0   , 0.0     ],
-                        [25, F, 7/Integer(2), 31230.4208    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [25, F, 5/Integer(2), 31230.4229    ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        [25, G, 7/Integer(2), 31230.79013   ,   0.0       , 0.0   , 0.0     ],# not experimental (isoelectronic fitting).
-                        ]
-
-            else:
-                s = "The isotope "+str(isotope)+str(element)
-                s += " is not in the database."
-                raise ValueError, s
-            # We rewrite the table in Hz
-            nivfin=[ nivfin[ii][:3] + [nivfin[ii][3]*c*100 ] +[nivfin[ii][4]*1e6 ]
-                                    + [nivfin[ii][5]*1e6   ] +[nivfin[ii][6]*1e6 ] for ii in range(len(nivfin)) ]
-
-        else:
-            s = "The element "+str(element)+" is not in the database."
-            raise ValueError, s
-
         self.i = i
 
-        # We check whether the quantum numbers given are in the database.
-        # We find the energy of the state up to fine structure.
-        in_database = False
-        for ii in range(len(nivfin)):
-            # print [n,l,j],nivfin[ii][:3]
-            if [n, l, j] == nivfin[ii][:3]:
-                nufin = nivfin[ii][3]
-                A = nivfin[ii][4]; B = nivfin[ii][5]; C = nivfin[ii][6]
-                self.Ahfs = A; self.Bhfs = B; self.Chfs = C
-                in_database = True
-                break
-        if not in_database:
+        table = fine_structure_table(element, isotope)
+        key = (n, l, int(2*j))
+        if key not in table:
             s = "The values of n,l,k: "+str(n)+", "+str(l)+", "+str(j)
             s += " are not in the database for "+str(isotope)+str(element)+"."
             raise ValueError, s
+        nufin, A, B, C = table[key][3:]
+        self.Ahfs = A; self.Bhfs = B; self.Chfs = C
 
         # We check the value of f.
         fmin = int(abs(j-i)); nf = int(2*min(j, i)+1)
@@ -890,6 +1009,37 @@ class State(object):
             self.nu = nufin
             self.omega = 2*pi*self.nu
 
+        # The state is hashed by its quantum numbers, which makes it
+        # immutable from now on.
+        self._hash = hash(tuple([float(q) for q in self.quantum_numbers]))
+        interned_states[intern_key] = self
+
+    def __setattr__(self, name, value):
+        r"""States can not be changed once they are created.
+
+        >>> State("Rb",85,5,0,1/Integer(2)).n = 6
+        Traceback (most recent call last):
+        ...
+        AttributeError: States are immutable.
+        """
+        if hasattr(self, '_hash'):
+            raise AttributeError, 'States are immutable.'
+        object.__setattr__(self, name, value)
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        r"""States are pickled by their arguments only.
+
+        >>> import pickle
+        >>> s = State("Rb",87,5,1,3/Integer(2),2,1)
+        >>> pickle.loads(pickle.dumps(s)) is s
+        True
+        """
+        return (State, (self.element, self.isotope, self.n, self.l, self.j,
+                        self.f, self.m))
+
     def __repr__(self):
         r"""The representation routine for states.
 
@@ -962,8 +1112,12 @@ class State(object):
         >>> g1 == g2
         False
         """
+        if not isinstance(other, State): return False
         return self.quantum_numbers == other.quantum_numbers
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
 
 class Transition(object):
     r"""This class describes a transition between different atomic states.
@@ -1276,18 +1430,21 @@ def make_list_of_states(states, structure=None, verbose=1):
         return l4
 
 
-def calculate_omega_matrix(states, Omega=1):
+def calculate_omega_matrix(states, Omega=1, use_numpy=False):
     """Calculate the matrix of transition frequencies.
 
     This function recieves a list of states and returns the corresponding
     omega_ij matrix, rescaled to units of Omega. These are understood to be
     absolute frequencies (as opposed angular frequencies).
+
+    If use_numpy=True the matrix is returned as a numpy array instead of a
+    list of lists.
     """
-    N = len(states)
-    omega = [[2*Pi*(states[i].nu-states[j].nu)/Omega
-              for j in range(N)] for i in range(N)]
+    nu = np.array([state.nu for state in states], dtype=float)
+    omega = 2*Pi*(nu.reshape(-1, 1)-nu.reshape(1, -1))/Omega
 
-    return omega
+    if use_numpy: return omega
+    return omega.tolist()
 
 
 def get_einstein_A_matrix(fine_states,Omega=1):
@@ -1313,11 +1470,12 @@ def get_einstein_A_matrix(fine_states,Omega=1):
     return einsteinA
 
 
-def calculate_gamma_matrix(magnetic_states, Omega=1):
+def calculate_gamma_matrix(magnetic_states, Omega=1, use_numpy=False):
     r"""Calculate the matrix of decay between states.
 
     This function calculates the matrix $\gamma_{ij}$ of decay rates between
-    states |i> and |j> (in the units specified by the Omega argument).
+    states |i> and |j> (in the units specified by the Omega argument). If
+    use_numpy=True it is returned as a numpy array.
 
     >>> g=State("Rb",87,5,0,1/Integer(2))
     >>> e=State("Rb",87,5,1,3/Integer(2))
@@ -1357,33 +1515,32 @@ def calculate_gamma_matrix(magnetic_states, Omega=1):
 
     II = magnetic_states[0].i
 
-    gamma = [[0.0 for j in range(Ne)] for i in range(Ne)]
-    for i in range(Ne):
-        for j in range(i):
-            ei = magnetic_states[i]
-            ej = magnetic_states[j]
-            einsteinAij = Transition(ei, ej).einsteinA
+    # We look up the Einstein A coefficients once for each pair of fine
+    # states.
+    index = state_index(magnetic_states)
+    einsteinA = get_einstein_A_matrix(index.fine_states, Omega)
+    bounds = index.hyperfine_bounds
+
+    gamma = np.zeros((Ne, Ne))
+    # We fill the matrix one pair of hyperfine blocks at a time.
+    for hi in range(len(bounds)-1):
+        ai, bi = bounds[hi], bounds[hi+1]
+        ei = magnetic_states[ai]
+        ii = index.fine_of_hyperfine[hi]
+        for hj in range(hi):
+            aj, bj = bounds[hj], bounds[hj+1]
+            ej = magnetic_states[aj]
+            jj = index.fine_of_hyperfine[hj]
+            einsteinAij = einsteinA[max(ii, jj)][min(ii, jj)]
 
             if einsteinAij != 0:
-                ji = ei.j; jj = ej.j
-                fi = ei.f; fj = ej.f
-                mi = ei.m; mj = ej.m
+                gammaij = branching_block(ei.j, ej.j, ei.f, ej.f, II)*einsteinAij
 
-                gammaij = (2.0*ji+1)
-                gammaij *= (2.0*fi+1)
-                gammaij *= (2.0*fj+1)
+                gamma[ai:bi, aj:bj] = gammaij
+                gamma[aj:bj, ai:bi] = -gammaij.transpose()
 
-                gammaij *= float(wigner_6j(ji, fi, II, fj, jj, 1)**2)
-                gammaij *= sum([float(wigner_3j(fj, 1, fi, -mj, q, mi)**2)
-                                for q in [-1, 0, 1]])
-
-                gammaij *= einsteinAij/Omega
-                gammaij = float(gammaij)
-
-                gamma[i][j] = gammaij
-                gamma[j][i] = -gammaij
-
-    return gamma
+    if use_numpy: return gamma
+    return gamma.tolist()
 
 
 def calculate_reduced_matrix_elements(fine_states):
@@ -1437,52 +1594,173 @@ def calculate_reduced_matrix_elements(fine_states):
     return reduced_matrix_elements
 
 
-def calculate_r_matrices(fine_states, reduced_matrix_elements):
+def calculate_r_matrices(fine_states, reduced_matrix_elements,
+                         use_numpy=False):
     magnetic_states = make_list_of_states(fine_states, 'magnetic', verbose=0)
-    index_list_fine, index_list_hyperfine = calculate_boundaries(fine_states, magnetic_states)
+    index = state_index(magnetic_states)
+    bounds = index.hyperfine_bounds
 
     Ne = len(magnetic_states)
 
-    r = [[[0.0 for j in range(Ne)] for i in range(Ne)] for p in range(3)]
+    r = np.zeros((3, Ne, Ne))
 
     II = fine_states[0].i
 
-    for p in [-1, 0, 1]:
-        for i in range(Ne):
-            ei = magnetic_states[i]
-            ii = fine_index(i, index_list_fine)
+    # We fill the matrices one pair of hyperfine blocks at a time.
+    for hi in range(len(bounds)-1):
+        ai, bi = bounds[hi], bounds[hi+1]
+        ei = magnetic_states[ai]
+        ii = index.fine_of_hyperfine[hi]
+        for hj in range(len(bounds)-1):
+            aj, bj = bounds[hj], bounds[hj+1]
+            ej = magnetic_states[aj]
+            jj = index.fine_of_hyperfine[hj]
+
+            reduced_matrix_elementij = reduced_matrix_elements[ii][jj]
+            if reduced_matrix_elementij != 0:
+
+                ji = ei.j; jj = ej.j
+                fi = ei.f; fj = ej.f
+
+                rij = (-1)**int(fj+ji+1+II)
+                rij *= sqrt(2*fj+1)
+                rij *= sqrt(2*fi+1)
+                rij *= wigner_6j_float(ji, jj, 1, fj, fi, II)
 
-            for j in range(Ne):
-                ej = magnetic_states[j]
-                jj = fine_index(j, index_list_fine)
+                rij *= reduced_matrix_elementij
 
-                reduced_matrix_elementij = reduced_matrix_elements[ii][jj]
-                if reduced_matrix_elementij != 0:
+                for p in [-1, 0, 1]:
+                    r[p+1, ai:bi, aj:bj] = angular_block(fi, fj, p)*rij
 
-                    ji = ei.j; jj = ej.j
-                    fi = ei.f; fj = ej.f
-                    mi = ei.m; mj = ej.m
+    if use_numpy: return r
+    return r.tolist()
 
-                    rpij = (-1)**(fi-mi)
-                    rpij *= wigner_3j(fi, 1, fj, -mi, p, mj)
 
-                    rpij *= (-1)**(fj+ji+1+II)
-                    rpij *= sqrt(2*fj+1)
-                    rpij *= sqrt(2*fi+1)
-                    rpij *= wigner_6j(ji, jj, 1, fj, fi, II)
+# The version of the atomic data. It is part of the keys of the cache of
+# matrices, so it must be increased whenever the database changes.
+database_version = 1
 
-                    rpij *= reduced_matrix_elementij
 
-                    r[p+1][i][j] = float(rpij)
-    return r
+def matrices_cache_dir():
+    r"""Return the default directory of the cache of matrices."""
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'fast')
 
 
-def calculate_matrices(states, Omega=1):
+def calculate_matrices_block(fine_states, Omega=1, cache_dir=None):
+    r"""Calculate the matrices omega_ij, gamma_ij, r_pij for one or two fine
+    states, or load them from the cache.
+
+    The matrices are saved as .npz files in cache_dir (by default
+    matrices_cache_dir()) under a name made of the isotope, the quantum
+    numbers of the fine states, Omega and the version of the database.
+    """
+    if cache_dir is None: cache_dir = matrices_cache_dir()
+    fine_states = order_by_energy(fine_states)
+
+    name = fine_states[0].element+str(fine_states[0].isotope)
+    for state in fine_states:
+        name += '_'+str(state.n)+str(state.l)+str(int(2*state.j))
+    name += '_Omega'+repr(float(Omega))+'_v'+str(database_version)+'.npz'
+    file_name = os.path.join(cache_dir, name)
+
+    if os.path.exists(file_name):
+        with np.load(file_name) as data:
+            return data['omega'].copy(), data['gamma'].copy(), data['r'].copy()
+
+    magnetic_states = make_list_of_states(fine_states, 'magnetic', verbose=0)
+    omega = calculate_omega_matrix(magnetic_states, Omega, use_numpy=True)
+    gamma = calculate_gamma_matrix(magnetic_states, Omega, use_numpy=True)
+    reduced_matrix_elements = calculate_reduced_matrix_elements(fine_states)
+    r = calculate_r_matrices(fine_states, reduced_matrix_elements,
+                             use_numpy=True)
+
+    # We write to a temporary file first, so that other processes never
+    # read an incomplete file.
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+    temporary_name = file_name+'.'+str(os.getpid())+'.tmp'
+    f = file(temporary_name, 'wb')
+    np.savez(f, omega=omega, gamma=gamma, r=r)
+    f.close()
+    os.rename(temporary_name, file_name)
+    return omega, gamma, r
+
+
+def calculate_matrices_from_blocks(fine_states, Omega=1, cache_dir=None,
+                                   use_numpy=False):
+    r"""Calculate the matrices omega_ij, gamma_ij, r_pij for a list of fine
+    states by blocks of one and two fine states, each of which is calculated
+    only once and then loaded from the cache (see calculate_matrices_block).
+    """
+    Nf = len(fine_states)
+
+    # The diagonal blocks.
+    blocks = [calculate_matrices_block([fine_states[ii]], Omega, cache_dir)
+              for ii in range(Nf)]
+    sizes = [len(block[0]) for block in blocks]
+    bounds = [sum(sizes[:ii]) for ii in range(Nf+1)]
+    Ne = bounds[-1]
+
+    omega = np.zeros((Ne, Ne)); gamma = np.zeros((Ne, Ne))
+    r = np.zeros((3, Ne, Ne))
+    for ii in range(Nf):
+        a, b = bounds[ii], bounds[ii+1]
+        omega[a:b, a:b], gamma[a:b, a:b], r[:, a:b, a:b] = blocks[ii]
+
+    # The blocks between pairs of fine states. In the cache the lower state
+    # of each pair comes first.
+    for ii in range(Nf):
+        for jj in range(ii):
+            if fine_states[ii].nu < fine_states[jj].nu:
+                lower, upper = ii, jj
+            else:
+                lower, upper = jj, ii
+            omega_p, gamma_p, r_p = calculate_matrices_block(
+                [fine_states[lower], fine_states[upper]], Omega, cache_dir)
+
+            n = sizes[lower]
+            al, bl = bounds[lower], bounds[lower+1]
+            au, bu = bounds[upper], bounds[upper+1]
+            omega[au:bu, al:bl] = omega_p[n:, :n]
+            omega[al:bl, au:bu] = omega_p[:n, n:]
+            gamma[au:bu, al:bl] = gamma_p[n:, :n]
+            gamma[al:bl, au:bu] = gamma_p[:n, n:]
+            r[:, au:bu, al:bl] = r_p[:, n:, :n]
+            r[:, al:bl, au:bu] = r_p[:, :n, n:]
+
+    if use_numpy: return omega, gamma, r
+    return omega.tolist(), gamma.tolist(), r.tolist()
+
+
+def calculate_matrices(states, Omega=1, use_cache=False, cache_dir=None,
+                       use_numpy=False):
     r"""Calculate the matrices omega_ij, gamma_ij, r_pij.
 
     This function calculates the matrices omega_ij, gamma_ij and r_pij given a
     list of atomic states. The states can be arbitrarily in their fine,
     hyperfine or magnetic detail.
+
+    If use_cache=True the matrices are put together from blocks of one and two
+    fine states that are saved on disk the first time they are calculated
+    (see calculate_matrices_from_blocks).
+
+    If use_numpy=True the matrices are returned as numpy arrays of shapes
+    (Ne, Ne), (Ne, Ne) and (3, Ne, Ne).
+
+    >>> import tempfile
+    >>> g = State("Rb", 87, 5, 0, 1/Integer(2))
+    >>> e = State("Rb", 87, 5, 1, 1/Integer(2))
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> matrices = calculate_matrices([g, e], use_numpy=True)
+    >>> for calculation in range(2):
+    ...     cached = calculate_matrices([g, e], use_cache=True,
+    ...                                 cache_dir=cache_dir, use_numpy=True)
+    ...     print [np.allclose(a, b) for a, b in zip(matrices, cached)]
+    [True, True, True]
+    [True, True, True]
+    >>> len([f for f in os.listdir(cache_dir) if f.endswith('.npz')])
+    3
     """
     # We check that all states belong to the same element and the same isotope.
     iso = states[0].isotope
@@ -1496,6 +1774,10 @@ def calculate_matrices(states, Omega=1):
     # We find the fine states involved in the problem.
     fine_states = find_fine_states(states)
 
+    if use_cache:
+        return calculate_matrices_from_blocks(fine_states, Omega, cache_dir,
+                                              use_numpy)
+
     # We find the full magnetic states. The matrices will be first calculated
     # for the complete problem and later reduced to include only the states of
     # interest.
@@ -1506,15 +1788,18 @@ def calculate_matrices(states, Omega=1):
     # hyperfine levels.
 
     # We calculate the frequency differences between states.
-    omega_full = calculate_omega_matrix(full_magnetic_states, Omega)
+    omega_full = calculate_omega_matrix(full_magnetic_states, Omega,
+                                        use_numpy)
     # We calculate the matrix gamma.
 
-    gamma_full = calculate_gamma_matrix(full_magnetic_states, Omega)
+    gamma_full = calculate_gamma_matrix(full_magnetic_states, Omega,
+                                        use_numpy)
     # We calculate the reduced matrix elements
     reduced_matrix_elements = calculate_reduced_matrix_elements(fine_states)
 
     # We calculate the matrices r_-1, r_0, r_1
-    r_full = calculate_r_matrices(fine_states, reduced_matrix_elements)
+    r_full = calculate_r_matrices(fine_states, reduced_matrix_elements,
+                                  use_numpy)
 
     # Reduction to be implemented
     omega = omega_full
@@ -1523,6 +1808,224 @@ def calculate_matrices(states, Omega=1):
     return omega, gamma, r
 
 
+# The Wigner 3j and 6j symbols already calculated, as floats. They are indexed
+# by their arguments doubled, so that the keys are tuples of integers.
+wigner_3j_cache = {}
+wigner_6j_cache = {}
+angular_block_cache = {}
+branching_block_cache = {}
+
+
+def wigner_3j_float(j1, j2, j3, m1, m2, m3, squared=False):
+    r"""Calculate a Wigner 3j symbol (or its square) as a float, remembering
+    the result.
+
+    >>> print wigner_3j_float(1, 1, 1, -1, 0, 1)
+    0.408248290464
+    >>> print wigner_3j_float(1, 1, 1, -1, 0, 1, squared=True)
+    0.166666666667
+    >>> print wigner_3j_float(1, 1, 1, -1, 1, 1)
+    0.0
+
+    """
+    key = tuple([int(round(2*x)) for x in (j1, j2, j3, m1, m2, m3)])
+    # The selection rule for the magnetic numbers.
+    if key[3]+key[4]+key[5] != 0: return 0.0
+    key += (squared,)
+    if key not in wigner_3j_cache:
+        symbol = wigner_3j(*[Integer(k, 2) for k in key[:-1]])
+        if squared: symbol = symbol**2
+        wigner_3j_cache[key] = float(symbol)
+    return wigner_3j_cache[key]
+
+
+def wigner_6j_float(j1, j2, j3, j4, j5, j6, squared=False):
+    r"""Calculate a Wigner 6j symbol (or its square) as a float, remembering
+    the result.
+
+    >>> print wigner_6j_float(1/Integer(2), 1/Integer(2), 1, 1, 2, 3/Integer(2))
+    0.288675134595
+
+    """
+    key = tuple([int(round(2*x)) for x in (j1, j2, j3, j4, j5, j6)])
+    key += (squared,)
+    if key not in wigner_6j_cache:
+        symbol = wigner_6j(*[Integer(k, 2) for k in key[:-1]])
+        if squared: symbol = symbol**2
+        wigner_6j_cache[key] = float(symbol)
+    return wigner_6j_cache[key]
+
+
+def angular_block(fi, fj, p):
+    r"""Calculate the angular factors between two hyperfine levels.
+
+    This function returns the (2fi+1)x(2fj+1) array of the factors
+        (-1)^(fi-mi) (fi 1 fj; -mi p mj)
+    between the magnetic states of hyperfine levels fi and fj for light of
+    polarization p. Only the elements with mj = mi - p can be different from
+    zero. The arrays are remembered, so they should not be modified.
+
+    >>> print angular_block(1, 2, 0)
+    [[ 0.         -0.31622777  0.          0.          0.        ]
+     [ 0.          0.         -0.36514837  0.          0.        ]
+     [ 0.          0.          0.         -0.31622777  0.        ]]
+
+    """
+    key = (int(round(2*fi)), int(round(2*fj)), p)
+    if key not in angular_block_cache:
+        block = np.zeros((int(2*fi+1), int(2*fj+1)))
+        for k in range(int(2*fi+1)):
+            mi = -fi+k
+            mj = mi-p
+            if abs(mj) <= fj:
+                block[k, int(mj+fj)] = (-1)**int(fi-mi)*wigner_3j_float(fi, 1, fj, -mi, p, mj)
+        angular_block_cache[key] = block
+    return angular_block_cache[key]
+
+
+def branching_block(ji, jj, fi, fj, II):
+    r"""Calculate the branching factors between two hyperfine levels.
+
+    This function returns the (2fi+1)x(2fj+1) array of the fractions of the
+    Einstein A coefficient of the fine transition ji -> jj that correspond to
+    the decay from each magnetic state of hyperfine level fi to each magnetic
+    state of hyperfine level fj. The arrays are remembered, so they should not
+    be modified.
+
+    >>> print branching_block(3/Integer(2), 1/Integer(2), 3, 2, 3/Integer(2))
+    [[1.         0.         0.         0.         0.        ]
+     [0.33333333 0.66666667 0.         0.         0.        ]
+     [0.06666667 0.53333333 0.4        0.         0.        ]
+     [0.         0.2        0.6        0.2        0.        ]
+     [0.         0.         0.4        0.53333333 0.06666667]
+     [0.         0.         0.         0.66666667 0.33333333]
+     [0.         0.         0.         0.         1.        ]]
+
+    """
+    key = tuple([int(round(2*x)) for x in (ji, jj, fi, fj, II)])
+    if key not in branching_block_cache:
+        factor = (2.0*float(ji)+1)
+        factor *= (2.0*fi+1)
+        factor *= (2.0*fj+1)
+        factor *= wigner_6j_float(ji, fi, II, fj, jj, 1, squared=True)
+
+        block = np.zeros((int(2*fi+1), int(2*fj+1)))
+        for k in range(int(2*fi+1)):
+            mi = -fi+k
+            for l in range(int(2*fj+1)):
+                mj = -fj+l
+                if abs(mi-mj) <= 1:
+                    block[k, l] = sum([wigner_3j_float(fj, 1, fi, -mj, q, mi, squared=True)
+                                       for q in [-1, 0, 1]])
+        branching_block_cache[key] = factor*block
+    return branching_block_cache[key]
+
+
+class StateIndex(object):
+    r"""Index maps between a list of magnetic states and the hyperfine and
+    fine states they belong to.
+
+    >>> g=State("Rb", 87, 5, 0, 1/Integer(2))
+    >>> e=State("Rb", 87, 5, 1, 3/Integer(2))
+    >>> index=StateIndex(make_list_of_states([g, e], "magnetic", verbose=0))
+    >>> index.fine_states
+    [87Rb 5S_1/2, 87Rb 5P_3/2]
+    >>> index.fine_bounds
+    array([ 0,  8, 24])
+    >>> index.hyperfine_bounds
+    array([ 0,  3,  8,  9, 12, 17, 24])
+
+    The hyperfine and fine state of each magnetic state, and the fine state
+    of each hyperfine state:
+    >>> index.hyperfine_of[10], index.fine_of[10], index.fine_of_hyperfine[3]
+    (3, 1, 1)
+    >>> index.hyperfine_states[3]
+    87Rb 5P_3/2^1
+
+    And the position of each state in its list:
+    >>> index.magnetic_index(State("Rb", 87, 5, 1, 3/Integer(2), 1, 0))
+    10
+    >>> index.hyperfine_index(index.hyperfine_states[3])
+    3
+    >>> index.fine_index(e)
+    1
+    """
+
+    def __init__(self, magnetic_states):
+        r"""Build the index maps of a list of magnetic states."""
+        self.magnetic_states = list(magnetic_states)
+        Ne = len(self.magnetic_states)
+
+        # We find where each fine and hyperfine state begins.
+        fine_starts = []; hyperfine_starts = []
+        fq = None; hq = None
+        for i in range(Ne):
+            qn = self.magnetic_states[i].quantum_numbers
+            if qn[:4] != fq:
+                fine_starts += [i]; fq = qn[:4]
+            if qn[:5] != hq:
+                hyperfine_starts += [i]; hq = qn[:5]
+
+        self.fine_bounds = np.array(fine_starts+[Ne])
+        self.hyperfine_bounds = np.array(hyperfine_starts+[Ne])
+        self.fine_of = np.repeat(np.arange(len(fine_starts)),
+                                 np.diff(self.fine_bounds))
+        self.hyperfine_of = np.repeat(np.arange(len(hyperfine_starts)),
+                                      np.diff(self.hyperfine_bounds))
+        self.fine_of_hyperfine = self.fine_of[self.hyperfine_bounds[:-1]]
+
+        def state(i, depth):
+            qn = self.magnetic_states[i].quantum_numbers[:depth]
+            return State(self.magnetic_states[i].element, *qn)
+        self.fine_states = [state(i, 4) for i in fine_starts]
+        self.hyperfine_states = [state(i, 5) for i in hyperfine_starts]
+
+        self._magnetic_index = dict([(self.magnetic_states[i], i)
+                                     for i in range(Ne)])
+        self._hyperfine_index = dict([(self.hyperfine_states[i], i)
+                                      for i in range(len(hyperfine_starts))])
+        self._fine_index = dict([(self.fine_states[i], i)
+                                 for i in range(len(fine_starts))])
+
+    def magnetic_index(self, state):
+        r"""The index of a magnetic state."""
+        return self._magnetic_index[state]
+
+    def hyperfine_index(self, state):
+        r"""The index of a hyperfine state."""
+        return self._hyperfine_index[state]
+
+    def fine_index(self, state):
+        r"""The index of a fine state."""
+        return self._fine_index[state]
+
+    def boundaries(self):
+        r"""The boundaries as given by calculate_boundaries."""
+        def pairs(bounds):
+            return [(int(bounds[k]), int(bounds[k+1]))
+                    for k in range(len(bounds)-1)]
+        return pairs(self.fine_bounds), pairs(self.hyperfine_bounds)
+
+
+# The index maps already built, indexed by the tuple of magnetic states.
+state_indices = {}
+
+
+def state_index(magnetic_states):
+    r"""Return the StateIndex of a list of magnetic states, which is built
+    only once for each list.
+
+    >>> g=State("Rb", 87, 5, 0, 1/Integer(2))
+    >>> magnetic_states=make_list_of_states([g], "magnetic", verbose=0)
+    >>> state_index(magnetic_states) is state_index(magnetic_states)
+    True
+    """
+    key = tuple(magnetic_states)
+    if key not in state_indices:
+        state_indices[key] = StateIndex(magnetic_states)
+    return state_indices[key]
+
+
 def calculate_boundaries(fine_states, full_magnetic_states):
     r"""Calculate the boundary indices within a list of magnetic states.
 
@@ -1536,35 +2039,9 @@ def calculate_boundaries(fine_states, full_magnetic_states):
     >>> calculate_boundaries([g], full_magnetic_states)
     ([(0, 8)], [(0, 3), (3, 8)])
 
+    The boundaries are taken from the StateIndex of the magnetic states.
     """
-    N_magnetic = len(full_magnetic_states)
-
-    # We calculate the boundaries of the various detail levels
-    # First we will make a list of indices of that will tell where each fine
-    # level begins and ends.
-    fq = full_magnetic_states[0].quantum_numbers[:4]
-    index_list_fine = []; start_fine = 0
-    # And another list of indices that will tell where each hyperfine level
-    # begins and ends.
-    hq = full_magnetic_states[0].quantum_numbers[:5]
-    index_list_hyperfine = []; start_hyperfine = 0
-
-    for i in range(N_magnetic):
-        magnetic = full_magnetic_states[i]
-        if magnetic.quantum_numbers[:4] != fq:
-            index_list_fine += [(start_fine, i)]
-            start_fine = i
-            fq = magnetic.quantum_numbers[:4]
-
-        if magnetic.quantum_numbers[:5] != hq:
-            index_list_hyperfine += [(start_hyperfine, i)]
-            start_hyperfine = i
-            hq = magnetic.quantum_numbers[:5]
-
-        if i == N_magnetic-1:
-            index_list_fine += [(start_fine, i+1)]
-            index_list_hyperfine += [(start_hyperfine, i+1)]
-    return index_list_fine, index_list_hyperfine
+    return state_index(full_magnetic_states).boundaries()
 
 def fine_index(magnetic_index,index_list_fine):
 	""""""
@@ -1593,11 +2070,12 @@ def quaver(isotope, p, J, F, M, Jp, Fp, Mp, numeric=False, verbose=False):
 
 
 def find_fine_states(magnetic_states):
-    fine_states = []
+    fine_states = []; found = set()
     for state in magnetic_states:
         fq = state.quantum_numbers[:4]
         fine_state = State(state.element, fq[0], fq[1], fq[2], fq[3])
-        if fine_state not in fine_states: fine_states += [fine_state]
+        if fine_state not in found:
+            fine_states += [fine_state]; found.add(fine_state)
     return fine_states
 
 
@@ -1605,131 +2083,149 @@ def exclude_states(omega, gamma, r, Lij, states, excluded_states):
     """Exclude states from matrices.
 
     This function takes the matrices and excludes the states listed in
-    excluded_states.
+    excluded_states. The matrices can be lists or numpy arrays and Lij can be
+    a list of lists or a SparseLij; the results are of the same kind.
     """
+    from misc import SparseLij
+
     Ne = len(omega)
-    excluded_indices = [i for i in range(Ne) if states[i] in excluded_states]
-
-    omega_new = []; gamma_new = []; r_new = [[], [], []]; Lij_new = []
-    for i in range(Ne):
-        row_om = []; row_ga = []; row_L = []
-        for j in range(Ne):
-            if j not in excluded_indices:
-                row_om += [omega[i][j]]
-                row_ga += [gamma[i][j]]
-                row_L += [Lij[i][j]]
-        if i not in excluded_indices:
-            omega_new += [row_om]
-            gamma_new += [row_ga]
-            Lij_new += [row_L]
-
-    for p in range(3):
-        for i in range(Ne):
-            row_r = []
-            for j in range(Ne):
-                if j not in excluded_indices:
-                    row_r += [r[p][i][j]]
-            if i not in excluded_indices:
-                r_new[p] += [row_r]
+    excluded_states = set(excluded_states)
+    keep = np.array([states[i] not in excluded_states for i in range(Ne)],
+                    dtype=bool)
+    kept = np.flatnonzero(keep)
+
+    omega_new = np.asarray(omega)[np.ix_(kept, kept)]
+    gamma_new = np.asarray(gamma)[np.ix_(kept, kept)]
+    r_new = np.asarray(r)[:, kept][:, :, kept]
+
+    if isinstance(Lij, SparseLij):
+        new_index = np.cumsum(keep)-1
+        couplings = dict([((int(new_index[i]), int(new_index[j])), lasers)
+                          for i, j, lasers in Lij.pairs()
+                          if keep[i] and keep[j]])
+        Lij_new = SparseLij.from_couplings(couplings, len(kept))
+    else:
+        Lij_new = [[Lij[i][j] for j in kept] for i in kept]
 
-    states_new = [states[i] for i in range(Ne) if i not in excluded_indices]
+    states_new = [states[i] for i in kept]
 
+    if not isinstance(omega, np.ndarray): omega_new = omega_new.tolist()
+    if not isinstance(gamma, np.ndarray): gamma_new = gamma_new.tolist()
+    if not isinstance(r, np.ndarray): r_new = r_new.tolist()
     return omega_new, gamma_new, r_new, Lij_new, states_new
 
-def reduce_magnetic_to_hyperfine(omega,gamma,r,Lij,magnetic_states,hyperfine_states,isotropic_r=False):
-	#We find the fine states involved in the problem.
-	fine_states=find_fine_states(magnetic_states)
-
-	#We calculate the indices corresponding to each sub matrix of fine and hyperfine levels.
-	index_list_fine,index_list_hyperfine=calculate_boundaries(fine_states,magnetic_states)
-
-	#We determine which indices will be reduced
-	index_list_to_reduce0=[]
-	for a,b in index_list_hyperfine:
-		qn = magnetic_states[a].quantum_numbers[:5]
-		for hs in hyperfine_states:
-			if hs.quantum_numbers == qn:
-				index_list_to_reduce0+=[(a,b)]
-
-	Ne_magnetic=len(magnetic_states)
-	index_list_to_reduce=[]
-	for i in range(Ne_magnetic):
-		band=True
-		for a,b in index_list_to_reduce0:
-			if a <= i < b:
-				if (a,b) not in index_list_to_reduce:
-					index_list_to_reduce+=[(a,b)]
-				band=False
-				break
-		if band:
-			index_list_to_reduce+=[(i,i+1)]
-
-	#We calculate the x,y,z matrices in order to reduce them.
-	x=[[   (r[0][i][j]-r[2][i][j])/sqrt(2.0) for j in range(Ne_magnetic)] for i in range(Ne_magnetic)]
-	y=[[1j*(r[0][i][j]+r[2][i][j])/sqrt(2.0) for j in range(Ne_magnetic)] for i in range(Ne_magnetic)]
-	z=[[r[1][i][j]                           for j in range(Ne_magnetic)] for i in range(Ne_magnetic)]
-
-	#We make the reduction
-	Ne_reduced = len(index_list_to_reduce)
-	omega_red=[]; gamma_red=[]; xyz=[[],[],[]]; Lij_red=[]; states_red=[]
-	for ii in range(Ne_reduced):
-		aii,bii=index_list_to_reduce[ii]
-		omega_row=[]; gamma_row=[]; x_row,y_row,z_row=[],[],[]; Lij_row=[]
-		for jj in range(Ne_reduced):
-			ajj,bjj=index_list_to_reduce[jj]
-
-			giijj=0; xiijj,yiijj,ziijj=0,0,0; Liijj=[]
-			for i in range(aii,bii):
-				for j in range(ajj,bjj):
-					#We can simply take whichever submatrix element for omega.
-					oiijj=omega[i][j]
-					#We sum the elements of gamma.
-					giijj+=gamma[i][j]
-					#We make the quadrature sum the elements of x,y,z.
-					xiijj+=x[i][j].conjugate()*x[i][j]
-					yiijj+=y[i][j].conjugate()*y[i][j]
-					ziijj+=z[i][j].conjugate()*z[i][j]
-					#For Lij we include whichever l exists in the submatrix in the reduced Lij.
-					for l in Lij[i][j]:
-						if l not in Liijj: Liijj+=[l]
-
-			omega_row+=[oiijj]
-			gamma_row+=[giijj]
-			x_row+=[sqrt(xiijj.real)]
-			y_row+=[sqrt(yiijj.real)]
-			z_row+=[sqrt(ziijj.real)]
-			Lij_row+=[Liijj]
-		#For the states we check wether there is a reduction, and add the apropiate states.
-		element_n=magnetic_states[aii].element
-        qn=magnetic_states[aii].quantum_numbers[:5]
-        hs=State(element_n,qn[0], qn[1], qn[2], qn[3], qn[4])
-        if bii-aii==1:
-			if split_hyperfine_to_magnetic([hs])==[magnetic_states[aii]]:
-				if hs in hyperfine_states:
-					states_red+=[hs]
-				else:
-					states_red+=[magnetic_states[aii]]
-			else:
-				states_red+=[magnetic_states[aii]]
+
+def reduce_magnetic_to_hyperfine(omega, gamma, r, Lij, magnetic_states,
+                                 hyperfine_states, isotropic_r=False):
+    r"""Reduce the magnetic states of some hyperfine states to one state.
+
+    The magnetic states of each of the hyperfine_states are merged into a
+    single state: omega is taken from any element of the block, gamma is
+    summed over it, the cartesian components of r are added in quadrature,
+    and Lij gets every laser that couples some pair of states in it. The
+    matrices can be lists or numpy arrays and Lij can be a list of lists or
+    a SparseLij; the results are of the same kind.
+
+    >>> g=State("Rb",87,5,0,1/Integer(2)); e=State("Rb",87,5,1,3/Integer(2))
+    >>> magnetic_states=make_list_of_states([g,e],"magnetic",verbose=0)
+    >>> hyperfine_states=make_list_of_states([e],"hyperfine",verbose=0)
+    >>> omega,gamma,r=calculate_matrices(magnetic_states,1e6)
+    >>> Lij=[[[1] if magnetic_states[i].l!=magnetic_states[j].l else []
+    ...       for j in range(24)] for i in range(24)]
+    >>> reduced=reduce_magnetic_to_hyperfine(omega,gamma,r,Lij,
+    ...                               magnetic_states,hyperfine_states)
+    >>> omega,gamma,r,Lij,states=reduced
+    >>> print states
+    [87Rb 5S_1/2^1,-1, 87Rb 5S_1/2^1,0, 87Rb 5S_1/2^1,1, 87Rb 5S_1/2^2,-2, 87Rb 5S_1/2^2,-1, 87Rb 5S_1/2^2,0, 87Rb 5S_1/2^2,1, 87Rb 5S_1/2^2,2, 87Rb 5P_3/2^0, 87Rb 5P_3/2^1, 87Rb 5P_3/2^2, 87Rb 5P_3/2^3]
+    >>> print [round(sum(gamma[i][:8])/2/pi, 3) for i in range(8,12)]
+    [6.065, 18.195, 30.325, 42.455]
+
+    """
+    from misc import SparseLij, coupled_indices
+
+    # We calculate the indices corresponding to each sub matrix of
+    # hyperfine levels.
+    index = state_index(magnetic_states)
+    bounds = index.hyperfine_bounds
+
+    # We determine which blocks of indices will be reduced. Every other
+    # magnetic state is a block of its own.
+    to_reduce_states = set(hyperfine_states)
+    blocks = dict([(bounds[h], bounds[h+1])
+                   for h in range(len(bounds)-1)
+                   if index.hyperfine_states[h] in to_reduce_states])
+
+    Ne_magnetic = len(magnetic_states)
+    starts = []; i = 0
+    while i < Ne_magnetic:
+        starts += [i]
+        i = blocks.get(i, i+1)
+    starts = np.array(starts)
+    ends = np.append(starts[1:], Ne_magnetic)
+    Ne_reduced = len(starts)
+
+    # We can simply take whichever submatrix element for omega.
+    omega_red = np.asarray(omega)[np.ix_(ends-1, ends-1)]
+
+    # We sum the elements of gamma.
+    def block_sum(matrix):
+        return np.add.reduceat(np.add.reduceat(matrix, starts, 0), starts, 1)
+    gamma_red = block_sum(np.asarray(gamma))
+
+    # We make the quadrature sum of the elements of x, y, z.
+    r_array = np.asarray(r)
+    x = (r_array[0]-r_array[2])/sqrt(2.0)
+    y = 1j*(r_array[0]+r_array[2])/sqrt(2.0)
+    z = r_array[1]
+    xyz = [np.sqrt(block_sum((u.conjugate()*u).real)) for u in [x, y, z]]
+
+    # For Lij we include whichever l exists in the block in the reduced Lij.
+    block = np.repeat(np.arange(Ne_reduced), ends-starts)
+    rows = coupled_indices(Lij)[0]
+    couplings = {}
+    for i in range(Ne_magnetic):
+        for j in rows[i]:
+            lasers = couplings.setdefault((int(block[i]), int(block[j])), [])
+            for l in Lij[i][j]:
+                if l not in lasers: lasers += [l]
+    if isinstance(Lij, SparseLij):
+        Lij_red = SparseLij.from_couplings(couplings, Ne_reduced)
+    else:
+        Lij_red = [[couplings.get((ii, jj), []) for jj in range(Ne_reduced)]
+                   for ii in range(Ne_reduced)]
+
+    # For the states we check wether there is a reduction, and add the
+    # apropiate states.
+    states_red = []
+    for a, b in zip(starts, ends):
+        qn = magnetic_states[a].quantum_numbers[:5]
+        hs = State(magnetic_states[a].element,
+                   qn[0], qn[1], qn[2], qn[3], qn[4])
+        if b-a == 1:
+            if (split_hyperfine_to_magnetic([hs]) == [magnetic_states[a]]
+                    and hs in to_reduce_states):
+                states_red += [hs]
+            else:
+                states_red += [magnetic_states[a]]
         else:
-			qn=magnetic_states[aii].quantum_numbers[:5]
-			element_n=magnetic_states[aii].element
-			states_red+=[State(element_n,qn[0], qn[1], qn[2], qn[3], qn[4])]
-        omega_red+=[omega_row]
-        gamma_red+=[gamma_row]
-        xyz[0]+=[x_row]; xyz[1]+=[y_row]; xyz[2]+=[z_row]
-        Lij_red+=[Lij_row]
-
-	#We calculate the reduced r from xyz
-	if isotropic_r:
-		#We can impose the isotropy of r
-		xyz[0]=xyz[2][:]; xyz[1]=xyz[2][:]
-	rm1_red=[[ ( xyz[0][i][j]-1j*xyz[1][i][j])/sqrt(2.0) for j in range(Ne_reduced)] for i in range(Ne_reduced)]
-	r0_red = xyz[2]
-	rp1_red=[[ (-xyz[0][i][j]-1j*xyz[1][i][j])/sqrt(2.0) for j in range(Ne_reduced)] for i in range(Ne_reduced)]
-	r_red=[rm1_red, r0_red, rp1_red]
-
-	return omega_red,gamma_red,r_red,Lij_red,states_red
+            states_red += [hs]
+
+    # We calculate the reduced r from xyz.
+    if isotropic_r:
+        # We can impose the isotropy of r.
+        xyz[0] = xyz[2]; xyz[1] = xyz[2]
+    rm1_red = (xyz[0]-1j*xyz[1])/sqrt(2.0)
+    r0_red = xyz[2]
+    rp1_red = (-xyz[0]-1j*xyz[1])/sqrt(2.0)
+
+    if isinstance(r, np.ndarray):
+        r_red = np.array([rm1_red, r0_red, rp1_red])
+    else:
+        r_red = [rm1_red.tolist(), r0_red.tolist(), rp1_red.tolist()]
+    if not isinstance(omega, np.ndarray): omega_red = omega_red.tolist()
+    if not isinstance(gamma, np.ndarray): gamma_red = gamma_red.tolist()
+
+    return omega_red, gamma_red, r_red, Lij_red, states_red
 
 def calculate_reduced_matrix_elements_0(fine_states):
 	'''This function calculates the reduced matrix elments <N,L,J||T^1(r)||N',L',J'> given a list of fine states.'''
@@ -25,7 +25,10 @@ sage_included = 'sage' in globals().keys()
 if not sage_included:
 	from math import sqrt,log,pi
 	from misc import Mu,IJ,find_phase_transformation, format_double
-	from misc import write_equations_code
+	from misc import write_equations_code, npy_subroutine_code, netcdf_subroutine_code
+	from misc import npy_chunks_subroutine_code, netcdf_chunks_subroutine_code
+	from misc import runtime_code, polarization_parameters
+	from misc import decay_manifolds, decay_parameters
 	from rk4 import write_rk4, run_rk4
 
 	from stationary import analyze_zeros
@@ -34,12 +37,86 @@ if not sage_included:
 else:
 	from time import time
 
+def chunked_evolution_code(file_name,Nrho,use_npy,use_netcdf):
+	r"""This function returns the Fortran code that calculates the time evolution and saves it in
+	chunks of nchunk points, to be used inside the loop over detunings of write_evolution."""
+	if use_npy:
+		open_code="call open_npy_chunks('"+file_name+".npy',"+str(Nrho)+")"
+		append_code="call append_npy_chunk(nc,"+str(Nrho)+",n_written,real(rho(1:nc,:)),t(1:nc))"
+		close_code="close(7)"
+	elif use_netcdf:
+		open_code="call open_netcdf_chunks('"+file_name+".nc',"+str(Nrho)+",ncid,varid_matrix,varid_vector)"
+		append_code="call append_netcdf_chunk(ncid,varid_matrix,varid_vector,nc,"+str(Nrho)
+		append_code+=",n_written,&\n\t\t\t\t\t&real(rho(1:nc,:)),t(1:nc))"
+		close_code="call check( nf90_close(ncid) )"
+	else:
+		open_code="open(unit=1,file='"+file_name+".dat',status='unknown')"
+		append_code="do i=1,nc\n\t\t\t\t\tWRITE(1,*) t(i),real(rho(i,:))\n\t\t\t\tend do"
+		close_code="close(1)"
+
+	code='''
+		!We calculate the time evolution with the solution just computed, saving
+		!it in chunks of nchunk points. For a spectrum only the last point is needed.
+		n_written=0
+		if (.not. run_spectrum ) '''+open_code+'''
+		i0=1
+		if (run_spectrum) i0=n-mod(n-1,nchunk)
+		do while (i0<=n)
+			nc=min(nchunk,n-i0+1)
+			do i=1,nc
+				t(i)=(i0+i-2)*dt
+				do mu=1,'''+str(Nrho)+'''
+					rho(i,mu)=r_amp(mu)*cdexp(lam(mu)*t(i))
+				end do
+				rho(i,:)= matmul(U , rho(i,:)) + rho_inf
+
+				if (isnan(real(rho(i,1)))) stop 1
+			end do
+			if (i0==1) rho(1,:)=rho0
+
+			if (.not. run_spectrum ) then
+				if (print_steps) print*,'t=',t(nc),'delta=',delta(j)
+				'''+append_code+'''
+			end if
+			i0=i0+nc
+		end do
+
+		if (print_steps) print*, 'delta=',delta(j),'percentage=',100*(delta(j)-delta0)/(ddelta*ndelta)
+
+		if (.not. run_spectrum ) then
+			'''+close_code+'''
+		else
+			rho_spectrum(j,:)=rho(nc,:)
+		end if
+'''
+	return code
+
 def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
-                    excluded_mu=[],rk4=False,verbose=1):
-	
+                    excluded_mu=[],rk4=False,verbose=1,use_npy=False,chunk_size=None,
+                    runtime_polarization=False,runtime_decay=False,manifolds=None):
+	r"""This function writes the Fortran code to calculate the time evolution of the density matrix
+	by diagonalization of the equations.
+
+	If chunk_size is given, the evolution is calculated and saved chunk_size points at a time, so
+	that the memory used does not grow with the number of time steps. The results can then be read
+	while the program is still running, or in chunks with read_result(...,chunk_size=...).
+
+	If runtime_polarization=True, the polarizations of the lasers are read by the program
+	instead of being written into it (see the polarization argument of run_evolution).
+
+	If runtime_decay=True, the decay rates of each manifold of states are scaled, and pure
+	dephasing rates between manifolds are added, by parameters read by the program (see the
+	decay_factors argument of run_evolution).
+
+	The programs written with rk4=True always save their results as text, so they cannot be
+	combined with use_npy=True or chunk_size."""
+
 	if rk4:
+		if use_npy or chunk_size!=None:
+			raise ValueError,'use_npy and chunk_size are not supported with rk4=True.'
 		return write_rk4(path,name,laser,omega,gamma,r,Lij,
-						 states=states,verbose=verbose)
+						 states=states,verbose=verbose,runtime_polarization=runtime_polarization,
+						 runtime_decay=runtime_decay,manifolds=manifolds)
 
 	t0=time()
 	Ne=len(omega[0])
@@ -47,9 +124,14 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 	N_excluded_mu=len(excluded_mu)
 	Nrho=Ne**2-1
 	print_times=False
+	Nm=0
+	if runtime_decay: Nm=max(decay_manifolds(states,Ne,manifolds))
+	E0_args,runtime_declaration,runtime_argument,runtime_read=runtime_code(Nl,runtime_polarization,Nm)
 
 	dummy=write_equations_code(path,name,laser,omega,gamma,r,Lij,
-				states=states,excluded_mu=excluded_mu,verbose=verbose)
+				states=states,excluded_mu=excluded_mu,verbose=verbose,
+				runtime_polarization=runtime_polarization,
+				runtime_decay=runtime_decay,manifolds=manifolds)
 	
 	code,Nd,row_check,col_check,rhs_check,Ne,N_excluded_mu,states,omega_min,detuningsij,omega_rescaled=dummy
 
@@ -62,6 +144,7 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 
 	logical :: print_steps,run_spectrum,save_systems,save_eigenvalues,integrate,use_netcdf\n'''
 	code0+='    real*8, dimension('+str(Nl)+') :: E0,detuning_knob\n'
+	code0+=runtime_declaration
 	code0+='    real*8, dimension('+str(Nd)+') :: detuning\n\n'
 	
 	code0+="	complex*16, dimension("+str(Nrho)+") :: r_amp,rho0\n"
@@ -71,6 +154,11 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 	code0+="	complex*16, dimension("+str(Nrho)+") :: lam\n\n"
 
 	if print_times: code0+="	real*8 :: t7,t8\n\n"
+	if chunk_size!=None:
+		code0+="	integer :: i0,nc,nchunk,n_written,ncid,varid_matrix,varid_vector\n\n"
+		rows='nchunk'
+	else:
+		rows='n'
 
 	code0+='    !We load the parameters\n'
 	code0+='    n_aprox=1500\n'
@@ -85,6 +173,7 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
     read(2,*) print_steps
     read(2,*) rho0
     read(2,*) E0\n'''
+	code0+=runtime_read
 
 	code0+='    read(2,*) detuning_knob\n'
 	code0+='    read(2,*) run_spectrum\n'
@@ -92,6 +181,8 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 	code0+='    read(2,*) save_eigenvalues\n'
 	code0+='    read(2,*) use_netcdf\n'
 	code0+='    read(2,*) integrate\n\n'
+	if chunk_size!=None:
+		code0+='    nchunk=min(n,'+str(chunk_size)+')\n\n'
 	
 	code0+='''    if (run_spectrum) then
 		read(2,*) ldelta
@@ -99,13 +190,13 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 		read(2,*) ddelta
 		
 		
-		allocate(rho(n,'''+str(Nrho)+'''),stat=info)
+		allocate(rho('''+rows+''','''+str(Nrho)+'''),stat=info)
 		allocate(rho_spectrum(ndelta,'''+str(Nrho)+'''),stat=info)
 		rho(1,:)=rho0
     else
 		ldelta=1; ndelta=1; ddelta=0
 		
-		allocate(rho(n,'''+str(Nrho)+'''),stat=info)
+		allocate(rho('''+rows+''','''+str(Nrho)+'''),stat=info)
 		rho(1,:)=rho0
     end if
     close(2)
@@ -113,9 +204,9 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
     delta0=detuning_knob(ldelta)
     
     !We build the time and delta axis
-    allocate(t(n),stat=info)
+    allocate(t('''+rows+'''),stat=info)
     allocate(delta(ndelta),stat=info)
-    do i=1,n
+    do i=1,'''+rows+'''
 		t(i)=(i-1)*dt
     end do
 
@@ -157,21 +248,27 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 		!this returns U, r_amp, rho_inf, lam.
 		detuning_knob(ldelta)=delta(j)
 
-		call solve(E0,detuning_knob, rho0,U,r_amp,rho_inf,lam,save_systems)
+		call solve('''+E0_args+''',detuning_knob, rho0,U,r_amp,rho_inf,lam,save_systems)
 		
 		if (save_eigenvalues) then
 			write(3,*) delta,real(lam)
 			write(3,*) delta,imag(lam)
 		end if\n\n'''
 	
-	if print_times:
-		code0+="		call cpu_time(t7)\n"
-	code0+='''
+	#We decide whether to use netcdf.
+	from config import use_netcdf
+
+	if chunk_size!=None:
+		code0+=chunked_evolution_code(path+name,Nrho,use_npy,use_netcdf)
+	else:
+		if print_times:
+			code0+="		call cpu_time(t7)\n"
+		code0+='''
 		!We calculate the time evolution with the solution just computed.
 		do i=2,n\n'''
 
 
-	code0+='''
+		code0+='''
 			if (print_steps.and. .not. run_spectrum) print*,'t=',t,'delta=',delta
 			
 			do mu=1,'''+str(Nrho)+'''
@@ -182,34 +279,38 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 			if (isnan(real(rho(i,1)))) stop 1
 			!if (.not. run_spectrum ) WRITE(1,*) t,real(rho(i,:))
 		end do\n'''
-	if print_times:
-		code0+='''
+		if print_times:
+			code0+='''
 		call cpu_time(t8)
 		print*,'time to calculate the n points of time:',t8-t7\n'''
 	
-	code0+='''
+		code0+='''
 		if (print_steps) print*, 'delta=',delta,'percentage=',100*(delta-delta0)/(ddelta*ndelta)
 		
 		!We save the time evolution.
 		if (.not. run_spectrum ) then'''
-	#We decide whether to use netcdf.
-	from config import use_netcdf
-	
-	if use_netcdf:
-		code0+='''
+		if use_npy:
+			code0+='''
+			call save_matrix_and_vector_npy("'''+path+name+'''.npy",n,'''+str(Ne**2-1)+''',real(rho),t)
+		else
+			rho_spectrum(j,:)=rho(n,:)
+        end if
+'''
+		elif use_netcdf:
+			code0+='''
 			call save_matrix_and_vector("'''+path+name+'''.nc",n,'''+str(Ne**2-1)+''',real(rho),t)
 		else
 			rho_spectrum(j,:)=rho(n,:)
         end if
 '''
-	else:
-		code0+="\n"
-		long_line="			open(unit=1,file='"+path+name+".dat',status='unknown')\n" 
-		if len(long_line)>=72:
-			long_line=long_line[:72]+"&\n&"+long_line[72:]
-		code0+=long_line
+		else:
+			code0+="\n"
+			long_line="			open(unit=1,file='"+path+name+".dat',status='unknown')\n" 
+			if len(long_line)>=72:
+				long_line=long_line[:72]+"&\n&"+long_line[72:]
+			code0+=long_line
 
-		code0+='''
+			code0+='''
 			do i=1,n
 				WRITE(1,*) t(i),real(rho(i,:))
 			end do
@@ -224,7 +325,10 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 
 	!We save a spectrum.
 	if (run_spectrum) then\n'''
-	if use_netcdf:
+	if use_npy:
+		code0+='''
+        call save_matrix_and_vector_npy("'''+path+name+'''.npy",ndelta,'''+str(Ne**2-1)+''',real(rho_spectrum),delta)'''
+	elif use_netcdf:
 		code0+='''
         call save_matrix_and_vector("'''+path+name+'''.nc",ndelta,'''+str(Ne**2-1)+''',real(rho_spectrum),delta)'''
 	else:
@@ -241,50 +345,18 @@ def write_evolution(path,name,laser,omega,gamma,r,Lij,states=None,
 end program
 '''
 	
-	if use_netcdf:
-		code0+='''
-subroutine save_matrix_and_vector(file_name,m,n,matrix,vector)
-	use netcdf
-	implicit none
-	character (len = *), intent(in) :: file_name
-	integer, intent(in) :: m,n
-	real*8, dimension(m,n), intent(in) :: matrix
-	real*8, dimension(m), intent(in) :: vector
-	
-	integer :: ncid, varid_matrix, varid_vector, dimids(2)
-	integer :: x_dimid, y_dimid
-	
-	call check( nf90_create(file_name, NF90_CLOBBER, ncid) )
-	call check( nf90_def_dim(ncid, "x", n, x_dimid) )
-	call check( nf90_def_dim(ncid, "y", m, y_dimid) )
-	dimids =  (/ y_dimid, x_dimid /)
-	call check( nf90_def_var(ncid, "matrix", NF90_DOUBLE, dimids,  varid_matrix) )
-	call check( nf90_def_var(ncid, "vector", NF90_DOUBLE, y_dimid, varid_vector) )
-	call check( nf90_enddef(ncid) )
-	
-	call check( nf90_put_var(ncid, varid_matrix, matrix) )
-	call check( nf90_put_var(ncid, varid_vector, vector) )
-	call check( nf90_close(ncid) )
-end subroutine
-
-subroutine check(status)
-	use netcdf
-	implicit none
-	integer, intent ( in) :: status
-
-	if(status /= nf90_noerr) then 
-		print *, trim(nf90_strerror(status))
-		stop "Stopped"
-	end if
-end subroutine check  
-
-\n\n'''
+	if use_npy:
+		code0+=npy_subroutine_code+'\n\n'
+		if chunk_size!=None: code0+=npy_chunks_subroutine_code+'\n\n'
+	elif use_netcdf:
+		if chunk_size!=None: code0+=netcdf_chunks_subroutine_code+'\n\n'
+		code0+=netcdf_subroutine_code+'\n\n'
 		
-	code0+=r"""subroutine solve(E0,detuning_knob,rho0,U,r_amp,rho_inf,lam,save_systems)
+	code0+=r"""subroutine solve("""+E0_args+""",detuning_knob,rho0,U,r_amp,rho_inf,lam,save_systems)
 	implicit none
     integer :: i,j,k,mu,nu,alpha	
 	real*8, dimension("""+str(Nl)+"""), intent(in) :: E0,detuning_knob
-	complex*16, dimension("""+str(Nrho)+""",1), intent(in) :: rho0
+"""+runtime_argument+r"""	complex*16, dimension("""+str(Nrho)+""",1), intent(in) :: rho0
 	complex*16, dimension("""+str(Nrho)+""","""+str(Nrho)+"""), intent(out) :: U
 	complex*16, dimension("""+str(Nrho)+""",1), intent(out) :: r_amp
 	real*8, dimension("""+str(Nrho)+""",1), intent(out) :: rho_inf
@@ -364,7 +436,9 @@ end subroutine check
 	if excluded_mu!=[]:
 		t0=time()-t0
 		t_extra=write_stationary(path,name,laser,omega,gamma,r,Lij,
-				use_symbolic_phase_transformation=True,states=states,excluded_mu=excluded_mu)
+				use_symbolic_phase_transformation=True,states=states,excluded_mu=excluded_mu,
+				use_npy=use_npy,runtime_polarization=runtime_polarization,
+				runtime_decay=runtime_decay,manifolds=manifolds)
 		
 		return t_extra+t0
 	else:		
@@ -479,8 +553,14 @@ def run_evolution(path,name,E0,laser_frequencies,  N_iter,dt,N_states,
 				spectrum_of_laser=None,N_delta=None,frequency_step=None,frequency_end=None,
 				rho0=None,print_steps=False,
 				integrate=False,
-				save_systems=False,save_eigenvalues=False,rk4=False,use_netcdf=True):
-	"""This function runs the Runge-Kutta method compiled in path+name..."""
+				save_systems=False,save_eigenvalues=False,rk4=False,use_netcdf=True,
+				polarization=None,decay_factors=None,decay_scale=1.0,dephasing=None):
+	"""This function runs the Runge-Kutta method compiled in path+name...
+
+	The programs written with runtime_polarization=True also need the polarization of each laser
+	(see polarization_parameters). The programs written with runtime_decay=True also need the
+	factors that scale the decay rates of each manifold, and optionally a global scale and the
+	pure dephasing rates between manifolds (see decay_parameters)."""
 	def py2f_bool(bool_var):
 		if bool_var:
 			return ".true.\n"
@@ -492,7 +572,8 @@ def run_evolution(path,name,E0,laser_frequencies,  N_iter,dt,N_states,
 				spectrum_of_laser=spectrum_of_laser,N_delta=N_delta,
 				frequency_step=frequency_step, frequency_end=frequency_end,
 				rho0=rho0,print_steps=print_steps,
-				integrate=integrate,save_systems=save_systems)
+				integrate=integrate,save_systems=save_systems,polarization=polarization,
+				decay_factors=decay_factors,decay_scale=decay_scale,dephasing=dephasing)
 	
 	t0=time()
 	params =str(N_iter)+'\n'
@@ -518,6 +599,10 @@ def run_evolution(path,name,E0,laser_frequencies,  N_iter,dt,N_states,
 	params+='\n'
 	#We give the amplitude of the electrical fields.
 	params+=''.join([str(i)+' ' for i in E0])+'\n'
+	if polarization!=None:
+		params+=''.join([str(i)+' ' for i in polarization_parameters(polarization)])+'\n'
+	if decay_factors is not None:
+		params+=decay_parameters(decay_factors,decay_scale,dephasing)
 	
 	#We give the detuning of each laser (taken from the lowest frequency transition).
 	params+=''.join([str(i)+' ' for i in laser_frequencies])+'\n'
@@ -26,8 +26,8 @@ sage_included = 'sage' in globals().keys()
 if not sage_included:
 	from math import atan2,sqrt,pi,cos,sin,exp
 	from atomic_structure import find_fine_states, split_hyperfine_to_magnetic, make_list_of_states
-	from atomic_structure import calculate_boundaries
-	from misc import read_result
+	from atomic_structure import state_index
+	from misc import read_result, mu_table
 
 from math import pi
 from colorsys import hls_to_rgb,hsv_to_rgb
@@ -203,22 +203,19 @@ def fmt_log(x, pos):
 def fancy_matrix_plot(ax,mat,states=None,path='',name='default.png',y_labels=True,
 		complex_matrix=False,take_abs=False,take_log=False,colorbar=False,hyperfine_labels=False,center_on_zero=False,**kwds):
 			
-	rmat=[mat[i] for i in reversed(range(len(mat[0])))]
+	rmat=np.asarray(mat)[::-1]
 	
-	smallest=min([min([j for j in i ]) for i in rmat])
-	largest =max([max([j for j in i ]) for i in rmat])
+	smallest=rmat.min()
+	largest =rmat.max()
 	
 	if take_abs:
 		#We make the matrix all positive.
-		rmat=[[abs(i) for i in row] for row in rmat]
+		rmat=abs(rmat)
 		if take_log:
 			#We make zeros into the smallest.
-			smallest=min([min([j for j in i if j != 0.0]) for i in rmat])
-			largest =max([max([j for j in i if j != 0.0]) for i in rmat])
-			for i in range(len(rmat)):
-				for j in range(len(rmat[0])):
-					if rmat[i][j]==0.0:
-						rmat[i][j]=smallest
+			smallest=rmat[rmat!=0.0].min()
+			largest =rmat[rmat!=0.0].max()
+			rmat=np.where(rmat==0.0,smallest,rmat)
 		
 	if complex_matrix:
 		rmat=complex_matrix_plot(rmat,normalize=True,plot=False)
@@ -238,10 +235,11 @@ def fancy_matrix_plot(ax,mat,states=None,path='',name='default.png',y_labels=Tru
 	ax.set_ylim([-0.5,Ne-0.5])
 
 	if states != None:
-		fine_states=find_fine_states(states)
-		hyperfine_states    =make_list_of_states(fine_states   ,'hyperfine',verbose=0)#split_fine_to_hyperfine(fine_states)
-		full_magnetic_states=make_list_of_states(fine_states   ,'magnetic',verbose=0)#split_fine_to_magnetic(fine_states)
-		index_list_fine,index_list_hyperfine=calculate_boundaries(fine_states,full_magnetic_states)
+		full_magnetic_states=make_list_of_states(find_fine_states(states),'magnetic',verbose=0)
+		index=state_index(full_magnetic_states)
+		fine_states=index.fine_states
+		hyperfine_states=index.hyperfine_states
+		index_list_fine,index_list_hyperfine=index.boundaries()
 		
 		i_fine=[i[0] for i in index_list_fine[1:]]
 		i_hyperfine=[i[0] for i in index_list_hyperfine[1:] if i[0] not in i_fine]
@@ -337,10 +335,11 @@ def fancy_r_plot(r,states,path='',name='default.png',y_labels=True,
 		ax.text(Ne/2.0-1,-0.5,'$p='+str(p-1)+'$',verticalalignment='top')
 
 		if states != None:
-			fine_states=find_fine_states(states)
-			hyperfine_states=make_list_of_states(fine_states,'hyperfine',verbose=0)#split_fine_to_hyperfine(fine_states)
-			full_magnetic_states=make_list_of_states(fine_states,'magnetic',verbose=0)
-			index_list_fine,index_list_hyperfine=calculate_boundaries(fine_states,full_magnetic_states)
+			full_magnetic_states=make_list_of_states(find_fine_states(states),'magnetic',verbose=0)
+			index=state_index(full_magnetic_states)
+			fine_states=index.fine_states
+			hyperfine_states=index.hyperfine_states
+			index_list_fine,index_list_hyperfine=index.boundaries()
 			
 			i_fine=[i[0] for i in index_list_fine[1:]]
 			i_hyperfine=[i[0] for i in index_list_hyperfine[1:] if i[0] not in i_fine]
@@ -374,22 +373,19 @@ def fancy_r_plot(r,states,path='',name='default.png',y_labels=True,
 def make_video(path,name,Ne,states=None,duration=120,fps=6,digs=6,**kwds):
 	data=read_result(path,name)
 	Nt=len(data)
+	#The indices of the real and imaginary parts of the lower triangle.
+	table=mu_table(Ne)
+	ii,jj=np.tril_indices(Ne,-1)
+	mu_re=table.mu(ii+1,jj+1,1); mu_im=table.mu(ii+1,jj+1,-1)
 	for t in range(Nt):
-		dati=data[t]
+		dati=np.asarray(data[t])
 		
-		mati=[[0.0 for j in range(Ne)] for i in range(Ne)]
-		for i in range(2,Ne+1):
-			for j in range(1,i+1):
-				mu=Mu(i,j,1,Ne)
-				rho_mu=dati[mu]
-				mati[i-1][j-1]=rho_mu
-				mati[j-1][i-1]=rho_mu
-				if i!=j:
-					mu=Mu(i,j,-1,Ne)
-					rho_mu=dati[mu]
-					mati[i-1][j-1]=mati[i-1][j-1]+1j*rho_mu
-					mati[j-1][i-1]=mati[j-1][i-1]-1j*rho_mu
-		mati[0][0]=1-sum([mati[i][i] for i in range(1,Ne)])
+		mati=np.zeros((Ne,Ne),complex)
+		mati[range(1,Ne),range(1,Ne)]=dati[1:Ne]
+		mati[ii,jj]=dati[mu_re]+1j*dati[mu_im]
+		mati[jj,ii]=dati[mu_re]-1j*dati[mu_im]
+		mati[0,0]=1-sum(dati[1:Ne])
+		mati=mati.tolist()
 		n=str(t)	
 		fancy_matrix_plot(mati,states=states,path=path,name=name+'0'*(digs-len(n))+n,complex_matrix=True,**kwds)
 		
@@ -621,8 +617,7 @@ def plot_populations(path,name,Ne,states=None,filename='a.png',fontsize=12,absol
 			hyperfine_colors=list(reversed([hsv_to_rgb(m*0.8/(N_plots-1),1.0,1.0) for m in range(N_plots)]))
 			conta=0
 			
-		fine_states=find_fine_states(states)
-		boundaries=list(reversed(calculate_boundaries(fine_states,states)[1]))
+		boundaries=list(reversed(state_index(states).boundaries()[1]))
 
 		for pair in boundaries:
 			f=states[pair[0]].f
@@ -29,15 +29,17 @@ from time import time
 import os
 
 from config import use_netcdf
-if use_netcdf:
+try:
     from netCDF4 import Dataset
+except ImportError:
+    if use_netcdf: raise
 from numpy import arange
 
 
 sage_included = 'sage' in globals().keys()
 
 from math import atan2,sqrt,pi,cos,sin,exp
-from sympy import solve,Symbol,diff,pprint
+from sympy import Symbol,pprint
 from atomic_structure import find_fine_states, split_hyperfine_to_magnetic, make_list_of_states
 from atomic_structure import calculate_boundaries
 
@@ -59,83 +61,931 @@ def fprint(expr,print_ascii=False):
         return expr
 
 def format_double(num):
+	if isinstance(num,PolarizationTerm): return num.code()
+	if isinstance(num,np.generic): num=num.item()
 	num=str(num)
 	if 'e' in num:
 		return num.replace('e','d')
 	else:
 		return num+'d0'
 
-def Mu(i,j,s,N,excluded_mu=[]):
-	'''This function calculates the global index mu for the element i,j. It returns the index for the
-	real part if s=0 and the one for the imaginary part if s=1'''
-	if i==j:
-		if s==-1:
-			if i==1:
-				return 0
-			else:
+class MuTable(object):
+	r"""The index tables relating the global index mu of the density matrix vector
+	to the element i,j and part s (1 for the real part, -1 for the imaginary part) of
+	rho, for Ne states and some excluded mu. Both directions are stored as arrays,
+	so that lookups take constant time and accept arrays of indices.
+
+	>>> table=MuTable(3)
+	>>> table.mu(3,2,-1), table.ij(8)
+	(8, (3, 2, -1))
+	>>> table.mu(np.array([2,3,3]),np.array([1,1,2]),1)
+	array([3, 4, 5])
+	>>> MuTable(3,[4]).mu(3,2,1)
+	4
+	"""
+	def __init__(self,N,excluded_mu=[]):
+		self.N=N
+		self.excluded_mu=sorted(excluded_mu)
+		M=N*(N-1)/2
+
+		#The unreduced mu of each element, -1 where there is none.
+		mu=-np.ones((2,N,N),int)
+		mu[0,range(N),range(N)]=range(N)
+		jj,ii=np.triu_indices(N,1)
+		mu[0,ii,jj]=np.arange(N,N+M)
+		mu[1,ii,jj]=np.arange(N+M,N*N)
+
+		#The inverse tables.
+		self.i=np.ones(N*N,int); self.j=np.ones(N*N,int); self.s=np.ones(N*N,int)
+		self.i[:N]=range(1,N+1); self.j[:N]=range(1,N+1)
+		self.i[N:]=np.concatenate([ii,ii])+1
+		self.j[N:]=np.concatenate([jj,jj])+1
+		self.s[N+M:]=-1
+
+		if self.excluded_mu!=[]:
+			valid=mu>=0
+			mu[valid]-=np.searchsorted(self.excluded_mu,mu[valid])
+		#rho11 has no imaginary part, but it has always been given index 0.
+		mu[1,0,0]=0
+		self.mu_array=mu
+
+		self._mu=mu.tolist()
+		self._ij=zip(self.i.tolist(),self.j.tolist(),self.s.tolist())
+
+	def mu(self,i,j,s):
+		r"""The index of rho_ij (real part for s=1, imaginary for s=-1). The arguments
+		may be integers or arrays."""
+		N=self.N
+		if type(i)==int and type(j)==int and type(s)==int:
+			if 1<=j<=i<=N and (i==j or s in (1,-1)):
+				mu=self._mu[s==-1][i-1][j-1]
+				if mu>=0: return mu
+			if i==j:
 				raise ValueError,'There is no population rhoii with i='+str(i)+'.'
-		mu= i-1
-	elif i>j and s==1:
-		mu= i - j + sum([N-k for k in range(1,j)])+N-1
-	elif i>j and s==-1:
-		mu= i - j + sum([N-k for k in range(1,j)])+N-1 + N*(N-1)/2
-	else:
-		raise ValueError,'i='+str(i)+', j='+str(j)+' Equations for i<j are not calculated.'+str(s)
+			raise ValueError,'i='+str(i)+', j='+str(j)+' Equations for i<j are not calculated.'+str(s)
+
+		i=np.asarray(i); j=np.asarray(j); s=np.asarray(s)
+		if ((i<1)|(i>N)|(j<1)|(j>N)|(i<j)).any() or ((i!=j)&(s!=1)&(s!=-1)).any():
+			raise ValueError,'Equations are only calculated for 1 <= j <= i <= N.'
+		mu=self.mu_array[(s==-1).astype(int),i-1,j-1]
+		if (mu<0).any():
+			raise ValueError,'There are no populations rhoii with s=-1 for i > 1.'
+		if mu.ndim==0: return int(mu)
+		return mu
+
+	def ij(self,mu):
+		r"""The i,j,s of an unreduced index mu, or arrays of them for an array of mu."""
+		if type(mu)==int:
+			if not 0<=mu<self.N**2: raise ValueError,'mu has an invalid value mu='+str(mu)+'.'
+			return self._ij[mu]
+		mu=np.asarray(mu)
+		if ((mu<0)|(mu>=self.N**2)).any():
+			raise ValueError,'mu has an invalid value.'
+		if mu.ndim==0: return self._ij[int(mu)]
+		return self.i[mu],self.j[mu],self.s[mu]
+
+mu_tables={}
+
+def mu_table(N,excluded_mu=[]):
+	r"""Return the MuTable for N states and some excluded mu, which is built only once.
+
+	>>> mu_table(4) is mu_table(4)
+	True
+	"""
+	key=(N,tuple(sorted(excluded_mu)))
+	if key not in mu_tables:
+		mu_tables[key]=MuTable(N,excluded_mu)
+	return mu_tables[key]
 
-	if excluded_mu !=[]:
-		#if mu in excluded_mu:
-		#	print i,j,s
-		#	raise ValueError,'mu = '+str(mu)+' appeared among the excluded mu.'
-		mu=mu-len([i for i in excluded_mu if i<mu])
-	return mu
+def Mu(i,j,s,N,excluded_mu=[]):
+	'''This function calculates the global index mu for the element i,j. It returns the index for the
+	real part if s=1 and the one for the imaginary part if s=-1'''
+	return mu_table(N,excluded_mu).mu(i,j,s)
 
 def IJ(mu,N):
 	"""This function returns i,j,s for any given mu."""
-	if mu==0: return 1,1,1
-
-	if mu not in range(0,N**2): raise ValueError,'mu has an invalid value mu='+str(mu)+'.'
-
-	if 1 <= mu <=N-1:
-		return mu+1,mu+1,1
+	return mu_table(N).ij(mu)
+
+#The Fortran subroutine used by the generated programs to save their results
+#as .npy files. The header is padded to 128 bytes, and the data is stored as a
+#C-ordered array of shape (n+1,m) whose first row is the vector (time or
+#detuning) and whose other rows are the columns of the matrix, so that each
+#density matrix component is contiguous on disk.
+npy_subroutine_code="""
+subroutine save_matrix_and_vector_npy(file_name,m,n,matrix,vector)
+	implicit none
+	character (len = *), intent(in) :: file_name
+	integer, intent(in) :: m,n
+	real*8, dimension(m,n), intent(in) :: matrix
+	real*8, dimension(m), intent(in) :: vector
+
+	character (len = 118) :: header
+
+	header=''
+	write(header,'(A,I0,A,I0,A)') "{'descr': '<f8', 'fortran_order': False, 'shape': (",n+1,", ",m,"), }"
+	header(118:118)=achar(10)
+
+	open(unit=7,file=file_name,access='stream',form='unformatted',status='replace')
+	write(7) achar(147)//'NUMPY'//achar(1)//achar(0)//achar(118)//achar(0)
+	write(7) header
+	write(7) vector
+	write(7) matrix
+	close(7)
+end subroutine
+"""
+
+def netcdf_storage_code(deflate_level=0,shuffle=False,single_precision=False):
+	r"""This function returns the declarations of the storage options used by the netCDF
+	subroutines of the generated code. compile_code replaces the default declarations by the
+	requested ones.
+
+	>>> print netcdf_storage_code(4,True,True).replace('\t','')
+	integer, parameter :: deflate_level=4
+	logical, parameter :: shuffle=.true.
+	integer, parameter :: xtype=NF90_FLOAT
+	<BLANKLINE>
+
+	"""
+	code ='	integer, parameter :: deflate_level='+str(deflate_level)+'\n'
+	code+='	logical, parameter :: shuffle=.'+str(shuffle).lower()+'.\n'
+	if single_precision:
+		code+='	integer, parameter :: xtype=NF90_FLOAT\n'
 	else:
-		m=N-1
-		M=N*(N-1)/2
-		for jj in range(1,N):
-			for ii in range(jj+1,N+1):
-				m+=1
-				if m==mu or m+M==mu:
-					if mu>N*(N+1)/2 -1:
-						return ii,jj,-1
-					else:
-						return ii,jj,1
-
-def read_result(path,name,i=None,j=None,s=0,N=None,excluded_mu=[],use_netcdf=True,clone=None):
-	r"""This function reads the results stored in path under file name.dat returning them as a list
-	of N^2 lists of the form [frequency, rho22, rho33, ... rho_N,N-1]. Alternatively it can return only
-	two lists [frequency, rho_i,j,s] where s must be 1 for the real part and -1 for the imaginary part."""
+		code+='	integer, parameter :: xtype=NF90_DOUBLE\n'
+	return code
+
+#The Fortran subroutines used by the generated programs to save their results
+#as netCDF files. If compression is requested, the file is created in netCDF-4
+#format and each density matrix component is stored as a separate chunk. The
+#time or detuning axis is always stored in double precision.
+netcdf_subroutine_code="""
+subroutine save_matrix_and_vector(file_name,m,n,matrix,vector)
+	use netcdf
+	implicit none
+	character (len = *), intent(in) :: file_name
+	integer, intent(in) :: m,n
+	real*8, dimension(m,n), intent(in) :: matrix
+	real*8, dimension(m), intent(in) :: vector
+"""+netcdf_storage_code()+"""
+	integer :: ncid, varid_matrix, varid_vector, dimids(2)
+	integer :: x_dimid, y_dimid
+
+	if (deflate_level>0 .or. shuffle) then
+		call check( nf90_create(file_name, ior(NF90_CLOBBER,NF90_NETCDF4), ncid) )
+	else
+		call check( nf90_create(file_name, NF90_CLOBBER, ncid) )
+	end if
+	call check( nf90_def_dim(ncid, "x", n, x_dimid) )
+	call check( nf90_def_dim(ncid, "y", m, y_dimid) )
+	dimids =  (/ y_dimid, x_dimid /)
+	if (deflate_level>0 .or. shuffle) then
+		call check( nf90_def_var(ncid, "matrix", xtype, dimids,  varid_matrix, &
+			&chunksizes=(/ m, 1 /), shuffle=shuffle, deflate_level=deflate_level) )
+	else
+		call check( nf90_def_var(ncid, "matrix", xtype, dimids,  varid_matrix) )
+	end if
+	call check( nf90_def_var(ncid, "vector", NF90_DOUBLE, y_dimid, varid_vector) )
+	call check( nf90_enddef(ncid) )
+
+	call check( nf90_put_var(ncid, varid_matrix, matrix) )
+	call check( nf90_put_var(ncid, varid_vector, vector) )
+	call check( nf90_close(ncid) )
+end subroutine
+
+subroutine check(status)
+	use netcdf
+	implicit none
+	integer, intent ( in) :: status
+
+	if(status /= nf90_noerr) then 
+		print *, trim(nf90_strerror(status))
+		stop "Stopped"
+	end if
+end subroutine check
+"""
+
+#The Fortran subroutines used by the generated programs to save their results
+#in chunks as they are calculated. The .npy file is stored in Fortran order with
+#shape (n+1,m), so that each point is contiguous on disk and new points can be
+#appended. The header is rewritten after each chunk, so that the file is always
+#a valid .npy file with the same layout as the ones written all at once.
+npy_chunks_subroutine_code="""
+subroutine write_npy_chunks_header(n,m)
+	implicit none
+	integer, intent(in) :: n,m
+	character (len = 118) :: header
+
+	header=''
+	write(header,'(A,I0,A,I0,A)') "{'descr': '<f8', 'fortran_order': True, 'shape': (",n+1,", ",m,"), }"
+	header(118:118)=achar(10)
+
+	write(7,pos=1) achar(147)//'NUMPY'//achar(1)//achar(0)//achar(118)//achar(0)
+	write(7) header
+end subroutine
+
+subroutine open_npy_chunks(file_name,n)
+	implicit none
+	character (len = *), intent(in) :: file_name
+	integer, intent(in) :: n
+
+	open(unit=7,file=file_name,access='stream',form='unformatted',status='replace')
+	call write_npy_chunks_header(n,0)
+end subroutine
+
+subroutine append_npy_chunk(m,n,m_written,matrix,vector)
+	implicit none
+	integer, intent(in) :: m,n
+	integer, intent(inout) :: m_written
+	real*8, dimension(m,n), intent(in) :: matrix
+	real*8, dimension(m), intent(in) :: vector
+	integer :: i
+	integer*8 :: position
+
+	position=129+8_8*(n+1)*m_written
+	write(7,pos=position) (vector(i),matrix(i,:),i=1,m)
+	m_written=m_written+m
+	call write_npy_chunks_header(n,m_written)
+	flush(7)
+end subroutine
+"""
+
+#The netCDF version of the subroutines above. The points are stored along an
+#unlimited dimension t.
+netcdf_chunks_subroutine_code="""
+subroutine open_netcdf_chunks(file_name,n,ncid,varid_matrix,varid_vector)
+	use netcdf
+	implicit none
+	character (len = *), intent(in) :: file_name
+	integer, intent(in) :: n
+	integer, intent(out) :: ncid,varid_matrix,varid_vector
+"""+netcdf_storage_code()+"""
+	integer :: x_dimid, t_dimid
+
+	if (deflate_level>0 .or. shuffle) then
+		call check( nf90_create(file_name, ior(NF90_CLOBBER,NF90_NETCDF4), ncid) )
+	else
+		call check( nf90_create(file_name, NF90_CLOBBER, ncid) )
+	end if
+	call check( nf90_def_dim(ncid, "x", n, x_dimid) )
+	call check( nf90_def_dim(ncid, "t", NF90_UNLIMITED, t_dimid) )
+	if (deflate_level>0 .or. shuffle) then
+		call check( nf90_def_var(ncid, "matrix", xtype, (/ x_dimid, t_dimid /), varid_matrix, &
+			&chunksizes=(/ n, 256 /), shuffle=shuffle, deflate_level=deflate_level) )
+	else
+		call check( nf90_def_var(ncid, "matrix", xtype, (/ x_dimid, t_dimid /), varid_matrix) )
+	end if
+	call check( nf90_def_var(ncid, "vector", NF90_DOUBLE, t_dimid, varid_vector) )
+	call check( nf90_enddef(ncid) )
+end subroutine
+
+subroutine append_netcdf_chunk(ncid,varid_matrix,varid_vector,m,n,m_written,matrix,vector)
+	use netcdf
+	implicit none
+	integer, intent(in) :: ncid,varid_matrix,varid_vector,m,n
+	integer, intent(inout) :: m_written
+	real*8, dimension(m,n), intent(in) :: matrix
+	real*8, dimension(m), intent(in) :: vector
+
+	call check( nf90_put_var(ncid, varid_matrix, transpose(matrix), start=(/1,m_written+1/), count=(/n,m/)) )
+	call check( nf90_put_var(ncid, varid_vector, vector, start=(/m_written+1/), count=(/m/)) )
+	call check( nf90_sync(ncid) )
+	m_written=m_written+m
+end subroutine
+"""
+
+#The Krylov solvers of the stationary programs written with solver='gmres' or 'bicgstab'.
+#They are contained in the module that holds the nonzero elements of A (see krylov_module_code).
+krylov_subroutine_code="""
+contains
+
+subroutine sparse_product(A,x,y)
+	implicit none
+	real*8, dimension(nnz), intent(in) :: A
+	real*8, dimension(n_mu), intent(in) :: x
+	real*8, dimension(n_mu), intent(out) :: y
+	integer :: k
+
+	y=0
+	do k=1,nnz
+		y(rows(k))=y(rows(k))+A(k)*x(cols(k))
+	end do
+end subroutine
+
+subroutine equilibrate(A_in,b_in,A,b)
+	!We divide each equation by its largest coefficient.
+	implicit none
+	real*8, dimension(nnz), intent(in) :: A_in
+	real*8, dimension(n_mu), intent(in) :: b_in
+	real*8, dimension(nnz), intent(out) :: A
+	real*8, dimension(n_mu), intent(out) :: b
+	real*8, dimension(n_mu) :: scale
+	integer :: k
+
+	scale=0
+	do k=1,nnz
+		scale(rows(k))=max(scale(rows(k)),abs(A_in(k)))
+	end do
+	where (scale==0) scale=1
+	do k=1,nnz
+		A(k)=A_in(k)/scale(rows(k))
+	end do
+	b=b_in/scale
+end subroutine
+
+subroutine block_jacobi_factor(A,P,ipiv)
+	!We factor the diagonal blocks of A, a singular block is left out of the preconditioner.
+	implicit none
+	real*8, dimension(nnz), intent(in) :: A
+	real*8, dimension(block_storage), intent(out) :: P
+	integer, dimension(n_mu), intent(out) :: ipiv
+	integer, dimension(n_mu) :: block,local
+	integer :: b,k,j,nb,info
+
+	do b=1,n_blocks
+		do j=block_start(b),block_start(b+1)-1
+			block(block_mu(j))=b
+			local(block_mu(j))=j-block_start(b)+1
+		end do
+	end do
+
+	P=0
+	do k=1,nnz
+		b=block(rows(k))
+		if (block(cols(k))==b) then
+			nb=block_start(b+1)-block_start(b)
+			P(block_offset(b)+local(rows(k))-1+(local(cols(k))-1)*nb)=A(k)
+		end if
+	end do
+
+	do b=1,n_blocks
+		nb=block_start(b+1)-block_start(b)
+		call dgetrf(nb,nb,P(block_offset(b)),nb,ipiv(block_start(b)),info)
+		if (info/=0) then
+			P(block_offset(b):block_offset(b)+nb*nb-1)=0
+			do j=1,nb
+				P(block_offset(b)+(j-1)*(nb+1))=1
+				ipiv(block_start(b)+j-1)=j
+			end do
+		end if
+	end do
+end subroutine
+
+subroutine block_jacobi_apply(P,ipiv,r,z)
+	implicit none
+	real*8, dimension(block_storage), intent(in) :: P
+	integer, dimension(n_mu), intent(in) :: ipiv
+	real*8, dimension(n_mu), intent(in) :: r
+	real*8, dimension(n_mu), intent(out) :: z
+	real*8, dimension(n_mu) :: w
+	integer :: b,s,nb,info
+
+	do b=1,n_blocks
+		s=block_start(b); nb=block_start(b+1)-s
+		w(1:nb)=r(block_mu(s:s+nb-1))
+		call dgetrs('N',nb,1,P(block_offset(b)),nb,ipiv(s),w,nb,info)
+		z(block_mu(s:s+nb-1))=w(1:nb)
+	end do
+end subroutine
+
+subroutine gmres(A_in,b_in,x,converged)
+	!Restarted GMRES with right block Jacobi preconditioning, starting from x=0. The solver
+	!stops when |b-Ax| <= tolerance*|b| for the equilibrated equations.
+	implicit none
+	real*8, dimension(nnz), intent(in) :: A_in
+	real*8, dimension(n_mu), intent(in) :: b_in
+	real*8, dimension(n_mu), intent(out) :: x
+	logical, intent(out) :: converged
+	real*8, allocatable, dimension(:,:) :: V
+	real*8, allocatable, dimension(:) :: P
+	integer, dimension(n_mu) :: ipiv
+	real*8, dimension(n_mu) :: r,w,z
+	real*8, dimension(restart+1,restart) :: H
+	real*8, dimension(restart+1) :: g
+	real*8, dimension(restart) :: cs,sn,y
+	real*8 :: beta,b_norm,denominator,temp
+	integer :: i,j,k,iterations
+	real*8, allocatable, dimension(:) :: A
+	real*8, dimension(n_mu) :: b
+
+	allocate(A(nnz),V(n_mu,restart+1),P(block_storage))
+	call equilibrate(A_in,b_in,A,b)
+	call block_jacobi_factor(A,P,ipiv)
+
+	x=0; r=b
+	b_norm=sqrt(dot_product(b,b)); beta=b_norm
+	converged=beta<=tolerance*b_norm
+	iterations=0
+	do while (.not. converged .and. iterations<max_iterations)
+		V(:,1)=r/beta
+		g=0; g(1)=beta
+		k=0
+		do j=1,restart
+			iterations=iterations+1
+			call block_jacobi_apply(P,ipiv,V(:,j),z)
+			call sparse_product(A,z,w)
+			do i=1,j
+				H(i,j)=dot_product(w,V(:,i))
+				w=w-H(i,j)*V(:,i)
+			end do
+			H(j+1,j)=sqrt(dot_product(w,w))
+			if (H(j+1,j)/=0) V(:,j+1)=w/H(j+1,j)
+
+			do i=1,j-1
+				temp=cs(i)*H(i,j)+sn(i)*H(i+1,j)
+				H(i+1,j)=-sn(i)*H(i,j)+cs(i)*H(i+1,j)
+				H(i,j)=temp
+			end do
+			denominator=sqrt(H(j,j)**2+H(j+1,j)**2)
+			if (denominator==0) exit
+			cs(j)=H(j,j)/denominator; sn(j)=H(j+1,j)/denominator
+			H(j,j)=denominator; H(j+1,j)=0
+			g(j+1)=-sn(j)*g(j); g(j)=cs(j)*g(j)
+			k=j
+			if (abs(g(j+1))<=tolerance*b_norm .or. iterations>=max_iterations) exit
+		end do
+		if (k==0) exit
+
+		!We update x with the solution of the least squares problem.
+		do i=k,1,-1
+			y(i)=(g(i)-dot_product(H(i,i+1:k),y(i+1:k)))/H(i,i)
+		end do
+		w=matmul(V(:,1:k),y(1:k))
+		call block_jacobi_apply(P,ipiv,w,z)
+		x=x+z
+
+		call sparse_product(A,x,w)
+		r=b-w; beta=sqrt(dot_product(r,r))
+		converged=beta<=tolerance*b_norm
+	end do
+	deallocate(A,V,P)
+end subroutine
+
+subroutine bicgstab(A_in,b_in,x,converged)
+	!BiCGSTAB(ell) with right block Jacobi preconditioning, starting from x=0. Every ell steps the
+	!residual is minimized over a polynomial of degree ell instead of degree one, which keeps it
+	!from stagnating on the complex eigenvalues of the equations. An iteration is one BiCG step.
+	implicit none
+	integer, parameter :: ell=2
+	real*8, dimension(nnz), intent(in) :: A_in
+	real*8, dimension(n_mu), intent(in) :: b_in
+	real*8, dimension(n_mu), intent(out) :: x
+	logical, intent(out) :: converged
+	real*8, allocatable, dimension(:) :: P
+	integer, dimension(n_mu) :: ipiv
+	real*8, dimension(n_mu,0:ell) :: r,u
+	real*8, dimension(n_mu) :: r0,z,t
+	real*8, dimension(ell,ell) :: tau
+	real*8, dimension(ell) :: sigma,g,g1,g2
+	real*8 :: rho0,rho1,alpha,beta,omega,b_norm,temp
+	integer :: i,j,iterations
+	logical :: breakdown
+	real*8, allocatable, dimension(:) :: A
+	real*8, dimension(n_mu) :: b
+
+	allocate(A(nnz),P(block_storage))
+	call equilibrate(A_in,b_in,A,b)
+	call block_jacobi_factor(A,P,ipiv)
+
+	x=0; r=0; u=0
+	r(:,0)=b; r0=b
+	b_norm=sqrt(dot_product(b,b))
+	converged=b_norm==0
+	rho0=1; alpha=0; omega=1
+	breakdown=.false.
+	iterations=0
+	do while (.not. converged .and. .not. breakdown .and. iterations<max_iterations)
+		iterations=iterations+ell
+		rho0=-omega*rho0
+		!The BiCG part.
+		do j=0,ell-1
+			rho1=dot_product(r(:,j),r0)
+			if (rho0==0) then
+				breakdown=.true.
+				exit
+			end if
+			beta=alpha*rho1/rho0; rho0=rho1
+			u(:,0:j)=r(:,0:j)-beta*u(:,0:j)
+			call block_jacobi_apply(P,ipiv,u(:,j),z)
+			call sparse_product(A,z,u(:,j+1))
+			temp=dot_product(u(:,j+1),r0)
+			if (temp==0) then
+				breakdown=.true.
+				exit
+			end if
+			alpha=rho0/temp
+			r(:,0:j)=r(:,0:j)-alpha*u(:,1:j+1)
+			call block_jacobi_apply(P,ipiv,r(:,j),z)
+			call sparse_product(A,z,r(:,j+1))
+			x=x+alpha*u(:,0)
+		end do
+		if (breakdown) exit
+
+		!The minimal residual part, with modified Gram-Schmidt.
+		do j=1,ell
+			do i=1,j-1
+				tau(i,j)=dot_product(r(:,j),r(:,i))/sigma(i)
+				r(:,j)=r(:,j)-tau(i,j)*r(:,i)
+			end do
+			sigma(j)=dot_product(r(:,j),r(:,j))
+			if (.not. sigma(j)>0) then
+				breakdown=.true.
+				exit
+			end if
+			g1(j)=dot_product(r(:,0),r(:,j))/sigma(j)
+		end do
+		if (breakdown) exit
+		g(ell)=g1(ell); omega=g(ell)
+		do j=ell-1,1,-1
+			g(j)=g1(j)-dot_product(tau(j,j+1:ell),g(j+1:ell))
+		end do
+		do j=1,ell-1
+			g2(j)=g(j+1)+dot_product(tau(j,j+1:ell-1),g(j+2:ell))
+		end do
+		x=x+g(1)*r(:,0)
+		r(:,0)=r(:,0)-g1(ell)*r(:,ell)
+		u(:,0)=u(:,0)-g(ell)*u(:,ell)
+		do j=1,ell-1
+			u(:,0)=u(:,0)-g(j)*u(:,j)
+			x=x+g2(j)*r(:,j)
+			r(:,0)=r(:,0)-g1(j)*r(:,j)
+		end do
+		converged=sqrt(dot_product(r(:,0),r(:,0)))<=tolerance*b_norm
+	end do
+
+	!x solves the preconditioned equations, we undo the preconditioning and check the true residual.
+	call block_jacobi_apply(P,ipiv,x,z)
+	x=z
+	call sparse_product(A,x,t)
+	r0=b-t
+	converged=sqrt(dot_product(r0,r0))<=tolerance*b_norm
+	deallocate(A,P)
+end subroutine
+
+end module
+"""
+
+def fortran_data(name,values,per_line=12):
+	r"""Fortran data statements giving the values of an integer array."""
+	code=''
+	for k in range(0,len(values),per_line):
+		chunk=values[k:k+per_line]
+		code+='\tdata '+name+'('+str(k+1)+':'+str(k+len(chunk))+') /'
+		code+=','.join([str(v) for v in chunk])+'/\n'
+	return code
+
+def hyperfine_blocks(states,Ne,excluded_mu=[],boundaries=None):
+	r"""The indices mu of the density matrix vector grouped in diagonal blocks, one for each pair
+	of manifolds of states. The manifolds are given by boundaries, a list of tuples (a,b) with
+	the first and one past the last index of the states of each manifold, as those returned by
+	calculate_boundaries. By default they are the hyperfine manifolds if the states are magnetic
+	states, and single states otherwise.
+
+	>>> hyperfine_blocks(None,3)
+	[[3, 6], [1], [4, 7], [5, 8], [2]]
+	"""
+	if boundaries==None:
+		if states!=None and all([getattr(s,'m',None)!=None for s in states]):
+			boundaries=calculate_boundaries(find_fine_states(states),states)[1]
+		else:
+			boundaries=[(i,i+1) for i in range(Ne)]
+	manifold=[0]*Ne
+	for k,(a,b) in enumerate(boundaries):
+		for i in range(a,b): manifold[i]=k
+
+	table=mu_table(Ne)
+	excluded_mu=sorted(excluded_mu)
+	blocks={}
+	for mu in range(1,Ne**2):
+		if mu in excluded_mu: continue
+		i,j,s=table.ij(mu)
+		key=(manifold[i-1],manifold[j-1])
+		blocks.setdefault(key,[]).append(mu-np.searchsorted(excluded_mu,mu))
+	return [blocks[key] for key in sorted(blocks)]
+
+def krylov_module_code(N,pattern,blocks,tolerance,max_iterations,restart):
+	r"""The Fortran module with the nonzero elements of the N x N matrix A of the stationary
+	programs written with a Krylov solver (pattern is the list of their (mu,nu) in the order in
+	which they are stored), its diagonal blocks (lists of mu) used as block Jacobi preconditioner,
+	and the solvers."""
+	block_mu=sum(blocks,[])
+	block_start=[1]; block_offset=[1]
+	for block in blocks:
+		block_start+=[block_start[-1]+len(block)]
+		block_offset+=[block_offset[-1]+len(block)**2]
+
+	code ='module sparse_pattern\n'
+	code+='\timplicit none\n'
+	code+='\tinteger, parameter :: n_mu='+str(N)+', nnz='+str(len(pattern))
+	code+=', n_blocks='+str(len(blocks))+', block_storage='+str(block_offset[-1]-1)+'\n'
+	code+='\tinteger, parameter :: max_iterations='+str(max_iterations)+', restart='+str(min(restart,N))+'\n'
+	code+='\treal*8, parameter :: tolerance='+format_double(float(tolerance))+'\n'
+	code+='\tinteger, dimension(nnz) :: rows,cols\n'
+	code+='\tinteger, dimension(n_mu) :: block_mu\n'
+	code+='\tinteger, dimension(n_blocks+1) :: block_start\n'
+	code+='\tinteger, dimension(n_blocks) :: block_offset\n'
+	code+=fortran_data('rows',[mu for mu,nu in pattern])
+	code+=fortran_data('cols',[nu for mu,nu in pattern])
+	code+=fortran_data('block_mu',block_mu)
+	code+=fortran_data('block_start',block_start)
+	code+=fortran_data('block_offset',block_offset[:-1])
+	code+=krylov_subroutine_code
+	return code
+
+class NetCDFRows(object):
+	r"""A read-only view of a netCDF result file with the same layout as a .npy result: row 0 is
+	the vector (time or detuning) and row mu is the mu-th column of the matrix. Indexing a row
+	reads only that hyperslab from the file."""
+	def __init__(self,file_name):
+		self.ncfile=Dataset(file_name,'r')
+		self.matrix=self.ncfile.variables['matrix']
+		self.vector=self.ncfile.variables['vector']
+		#Files written in chunks store the points along their first (unlimited) dimension.
+		self.chunked=self.ncfile.dimensions[self.matrix.dimensions[0]].isunlimited()
+		if self.chunked:
+			self.shape=(self.matrix.shape[1]+1,self.matrix.shape[0])
+		else:
+			self.shape=(self.matrix.shape[0]+1,self.matrix.shape[1])
+
+	def __getitem__(self,index):
+		if type(index)==tuple:
+			k,points=index
+		else:
+			k,points=index,slice(None)
+		if k==0:
+			return self.vector[points]
+		if self.chunked:
+			return self.matrix[points,k-1]
+		return self.matrix[k-1,points]
+
+	def block(self,points):
+		r"""All the rows for the given points, read at once."""
+		if self.chunked:
+			matrix=self.matrix[points,:].transpose()
+		else:
+			matrix=self.matrix[:,points]
+		return np.concatenate([[self.vector[points]],matrix])
+
+	def close(self):
+		self.ncfile.close()
+
+class Result(object):
+	r"""The results of a calculation, as returned by read_result.
+
+	A Result behaves like the list [x, rho_1, rho_2, ... rho_{N^2-1}] that read_result used to return,
+	where x is the time or detuning axis and rho_mu are the components of the density matrix
+	(see Mu). Indexing a single row reads only that row, so for .npy and netCDF files the rest of
+	the data is never loaded. It also gives direct access to density matrix elements by (i,j) or by
+	State objects, to manifold populations and to the full complex density matrix.
+
+	>>> data=np.array([[0.0,1.0],[0.25,0.5],[0.1,0.2],[0.05,-0.1]])
+	>>> result=Result(data,2)
+	>>> x,rho22,re_rho21,im_rho21=result
+	>>> print x, rho22
+	[0. 1.] [0.25 0.5 ]
+	>>> print result.rho(2,1), result.rho(1,2)
+	[0.1+0.05j 0.2-0.1j ] [0.1-0.05j 0.2+0.1j ]
+	>>> print result.rho(np.int64(2),np.int64(1),points=1)
+	(0.2-0.1j)
+	>>> print result.population(1)
+	[0.75 0.5 ]
+	>>> print result.density_matrix(points=1)
+	[[0.5+0.j  0.2+0.1j]
+	 [0.2-0.1j 0.5+0.j ]]
+
+	"""
+	def __init__(self,data,Ne=None,excluded_mu=[],states=None):
+		self.data=data
+		if Ne==None:
+			if states!=None:
+				Ne=len(states)
+			else:
+				Ne=int(round(np.sqrt(data.shape[0]+len(excluded_mu))))
+		self.Ne=Ne
+		self.excluded_mu=excluded_mu
+		self.states=states
+
+	def __len__(self):
+		return self.data.shape[0]
+
+	def __getitem__(self,k):
+		if type(k)==slice:
+			return [self.data[kk] for kk in range(*k.indices(len(self)))]
+		return self.data[k]
+
+	def __iter__(self):
+		for k in range(len(self)):
+			yield self.data[k]
+
+	def close(self):
+		r"""Close the file behind this result, if any."""
+		if hasattr(self.data,'close'): self.data.close()
+
+	def chunk(self,points):
+		r"""A Result with only the given points, loaded into memory."""
+		if isinstance(self.data,np.ndarray):
+			data=np.array(self.data[:,points])
+		else:
+			data=self.data.block(points)
+		return Result(data,self.Ne,self.excluded_mu,self.states)
+
+	def _rows(self,mus,points):
+		if points==None: points=slice(None)
+		if isinstance(self.data,np.ndarray):
+			return self.data[:,points][mus]
+		return np.array([self.data[mu,points] for mu in mus])
+
+	def _index(self,i):
+		if isinstance(i,(int,long,np.integer)): return int(i)
+		return self.states.index(i)+1
+
+	def _mu(self,i,j,s):
+		r"""The row holding rho_ij (real part for s=1, imaginary for s=-1), or None if it was excluded."""
+		mu=Mu(i,j,s,self.Ne)
+		if mu in self.excluded_mu: return None
+		return Mu(i,j,s,self.Ne,self.excluded_mu)
+
+	def x(self,points=None):
+		r"""The time or detuning axis."""
+		return self._rows([0],points)[0]
+
+	def component(self,i,j,s,points=None):
+		r"""The real (s=1) or imaginary (s=-1) part of rho_ij. i and j can be indices starting at 1
+		or State objects from the states given to read_result."""
+		i=self._index(i); j=self._index(j)
+		if i==j:
+			if s==-1: return 0*self.x(points)
+			if i==1: return 1-self.populations(points)[1:].sum(0)
+		elif i<j:
+			return s*self.component(j,i,s,points)
+		mu=self._mu(i,j,s)
+		if mu==None: return 0*self.x(points)
+		return self._rows([mu],points)[0]
+
+	def rho(self,i,j,points=None):
+		r"""The complex density matrix element rho_ij."""
+		return self.component(i,j,1,points)+1j*self.component(i,j,-1,points)
+
+	def populations(self,points=None):
+		r"""An array with the populations of all states, with shape (Ne,n)."""
+		Ne=self.Ne
+		mus=[self._mu(i,i,1) for i in range(2,Ne+1)]
+		rows=self._rows([mu for mu in mus if mu!=None],points)
+		pops=np.zeros((Ne,)+rows.shape[1:])
+		pops[[i+1 for i in range(Ne-1) if mus[i]!=None]]=rows
+		pops[0]=1-pops[1:].sum(0)
+		return pops
+
+	def population(self,state,points=None):
+		r"""The population of a state given by its index, or the total population of all the
+		magnetic states that belong to a (fine, hyperfine or magnetic) State."""
+		if isinstance(state,(int,long,np.integer)):
+			return self.populations(points)[state-1]
+		qn=state.quantum_numbers
+		indices=[k for k in range(self.Ne) if self.states[k].quantum_numbers[:len(qn)]==qn]
+		return self.populations(points)[indices].sum(0)
+
+	def density_matrix(self,points=None):
+		r"""The complex density matrix, with shape (n,Ne,Ne), or (Ne,Ne) if points is an integer."""
+		Ne=self.Ne
+		I=[]; J=[]; re=[]; im=[]
+		for i in range(2,Ne+1):
+			for j in range(1,i):
+				mu_re=self._mu(i,j,1); mu_im=self._mu(i,j,-1)
+				if mu_re!=None and mu_im!=None:
+					I+=[i-1]; J+=[j-1]; re+=[mu_re]; im+=[mu_im]
+
+		pops=self.populations(points)
+		rho=np.zeros(pops.shape[1:]+(Ne,Ne),complex)
+		rho[...,range(Ne),range(Ne)]=np.rollaxis(pops,0,pops.ndim)
+		if I!=[]:
+			rows=self._rows(re+im,points)
+			coherences=rows[:len(I)]+1j*rows[len(I):]
+			coherences=np.rollaxis(coherences,0,coherences.ndim)
+			rho[...,I,J]=coherences
+			rho[...,J,I]=coherences.conj()
+		return rho
+
+def read_result_chunks(path,name,chunk_size,N=None,excluded_mu=[],use_netcdf=True,clone=None,
+				use_npy=False,states=None):
+	r"""A generator yielding the results stored in path under name as Results of chunk_size
+	points each, so that long evolutions can be analyzed without loading them at once."""
+	if not use_npy and not use_netcdf:
+		if clone!=None: name=name+'_'+str(clone)
+		f=file(path+name+'.dat','r')
+		ln=[]
+		for li in f:
+			ln+=[[float(num) for num in li.split()]]
+			if len(ln)==chunk_size:
+				yield Result(np.array(ln).transpose(),N,excluded_mu,states)
+				ln=[]
+		f.close()
+		if ln!=[]:
+			yield Result(np.array(ln).transpose(),N,excluded_mu,states)
+		return
+
+	result=read_result(path,name,N=N,excluded_mu=excluded_mu,use_netcdf=use_netcdf,clone=clone,
+						use_npy=use_npy,states=states)
+	n=result.data.shape[1]
+	for k in range(0,n,chunk_size):
+		yield result.chunk(slice(k,k+chunk_size))
+	result.close()
+
+def follow_stream(file_name,process=None,poll_time=0.1):
+	r"""A generator yielding (x,rho) for each point appended to a .npy file written in chunks (see
+	write_evolution and write_stationary), as soon as it is written. If a process is given, the
+	file is followed until the process finishes."""
+	from time import sleep
+	n_read=0
+	while True:
+		finished= process==None or process.poll()!=None
+		if os.path.exists(file_name):
+			f=file(file_name,'rb')
+			try:
+				np.lib.format.read_magic(f)
+				shape,fortran_order,dtype=np.lib.format.read_array_header_1_0(f)
+			except ValueError:
+				#The header is being rewritten.
+				shape=(0,0)
+			f.close()
+			#We only read the points that are completely written.
+			n=shape[1]
+			if n>n_read and 128+8*shape[0]*n<=os.path.getsize(file_name):
+				data=np.memmap(file_name,dtype=float,mode='r',offset=128,shape=shape,order='F')
+				for k in range(n_read,n):
+					yield data[0,k],np.array(data[1:,k])
+				n_read=n
+				del data
+		if finished: break
+		sleep(poll_time)
+
+def read_result(path,name,i=None,j=None,s=0,N=None,excluded_mu=[],use_netcdf=True,clone=None,
+				use_npy=False,states=None,chunk_size=None):
+	r"""This function reads the results stored in path under file name.dat returning them as a
+	Result, which behaves like a list of N^2 rows of the form [frequency, rho22, rho33, ... rho_N,N-1].
+	Alternatively it can return only two lists [frequency, rho_i,j,s] where s must be 1 for the real
+	part and -1 for the imaginary part.
+
+	If use_npy=True the results are read from the file name.npy written by programs generated with
+	use_npy=True. This file is memory-mapped, so the rows of the Result are views of the file, and
+	only the rows that are actually used are read from disk. netCDF files are also read lazily.
+
+	If the list of states is given, the elements of the density matrix can be accessed through them
+	(see Result).
+
+	If chunk_size is given, a generator yielding Results of chunk_size points is returned instead
+	(see read_result_chunks).
+
+	netCDF files written in chunks store the points along their first dimension, as in
+
+	>>> import tempfile
+	>>> path=tempfile.mkdtemp()+'/'
+	>>> ncfile=Dataset(path+'chunks.nc','w')
+	>>> x=ncfile.createDimension('x',3); t=ncfile.createDimension('t',None)
+	>>> matrix=ncfile.createVariable('matrix','f8',('t','x'))
+	>>> vector=ncfile.createVariable('vector','f8',('t',))
+	>>> matrix[0:4,:]=[[0.5,0.1,0.2],[0.4,0.1,0.3],[0.3,0.0,0.4],[0.2,0.0,0.5]]
+	>>> vector[0:4]=[0.0,1.0,2.0,3.0]
+	>>> ncfile.close()
+	>>> t,rho22=read_result(path,'chunks',2,2,N=2)
+	>>> print list(t), list(rho22)
+	[0.0, 1.0, 2.0, 3.0] [0.5, 0.4, 0.3, 0.2]
+	>>> print list(read_result(path,'chunks',2,1,-1,N=2)[1])
+	[0.2, 0.3, 0.4, 0.5]
+	"""
+
+	if chunk_size!=None:
+		return read_result_chunks(path,name,chunk_size,N=N,excluded_mu=excluded_mu,
+				use_netcdf=use_netcdf,clone=clone,use_npy=use_npy,states=states)
 
 	if clone!=None:
 		clone='_'+str(clone)
 	else:
 		clone=''
 
-	if use_netcdf:
-		#print 'reading from',path+name+clone+'.nc'
-		ncfile = Dataset(path+name+clone+'.nc','r')
-		matrix = ncfile.variables['matrix'][:]
-		vector = ncfile.variables['vector'][:]
-		Nrho,n_points=len(matrix),len(matrix[0])
-		ncfile.close()
-
+	if use_npy:
+		data=np.load(path+name+clone+'.npy',mmap_mode='r')
 		if i!=None:
 			mu=Mu(i,j,s,N,excluded_mu)
-			if sage_included:
-				return [ (vector[k],matrix[mu-1][k]) for k in range(n_points)]
-			else:
-				return vector,matrix[mu-1]
+			return data[0],data[mu]
 		else:
-			return [vector] + [ matrix[k] for k in range(Nrho)]
+			return Result(data,N,excluded_mu,states)
+	elif use_netcdf:
+		#print 'reading from',path+name+clone+'.nc'
+		if i==None:
+			return Result(NetCDFRows(path+name+clone+'.nc'),N,excluded_mu,states)
+
+		rows=NetCDFRows(path+name+clone+'.nc')
+		mu=Mu(i,j,s,N,excluded_mu)
+		vector,rho=rows[0],rows[mu]
+		rows.close()
+		if sage_included:
+			return [ (vector[k],rho[k]) for k in range(len(vector))]
+		else:
+			return vector,rho
 		#ln=[for i in range(m)]
+	elif i==None:
+		data=np.loadtxt(path+name+clone+'.dat',ndmin=2).transpose()
+		return Result(data,N,excluded_mu,states)
 	else:
 		r=file(path+name+clone+'.dat','r')
 		l=r.readlines()
@@ -150,16 +1000,13 @@ def read_result(path,name,i=None,j=None,s=0,N=None,excluded_mu=[],use_netcdf=Tru
 			print [l[-1]]
 			raise ValueError
 
-		if i!=None:
-			mu=Mu(i,j,s,N,excluded_mu)
-			if sage_included:
-				return [(li[0],li[mu]) for li in ln]
-			else:
-				x=[li[0] for li in ln]
-				y=[li[mu] for li in ln]
-				return x,y
+		mu=Mu(i,j,s,N,excluded_mu)
+		if sage_included:
+			return [(li[0],li[mu]) for li in ln]
 		else:
-			return [[ ln[i][0] for i in range(len(ln))]] + [[ ln[i][mu+1] for i in range(len(ln))] for mu in range(N**2-1)]
+			x=[li[0] for li in ln]
+			y=[li[mu] for li in ln]
+			return x,y
 
 def dft(s,max_freq=False):
     f=[i[1] for i in s]
@@ -180,32 +1027,177 @@ def dft(s,max_freq=False):
         return sf[im][0]
     return sf
 
-def formatLij(Lij0,Ne):
+def lij_couplings(Lij0,Ne):
+	"""Return a dictionary {(i,j): lasers} (indices starting from 0) with both
+	orders of each pair of states mentioned in a list of laser conections. As in
+	formatLij, the first element of Lij0 that mentions a pair gives its lasers."""
+	couplings={}
+	for tri in Lij0:
+		i=tri[0]-1; j=tri[1]-1
+		if 0<=i<Ne and 0<=j<Ne:
+			if (i,j) not in couplings: couplings[(i,j)]=tri[2]
+			if (j,i) not in couplings: couplings[(j,i)]=tri[2]
+	return couplings
+
+def formatLij(Lij0,Ne,sparse=False):
 	"""This function transforms a list of laser conections of the form
 	[i,j,[l1,l2,...]] between states i and j by lasers l1,l2,... into a
 	Ne x Ne matrix whose elements are the lasers connecting the corresponding
-	indices."""
+	indices. If sparse=True the matrix is returned as a SparseLij."""
+	if sparse: return SparseLij(Lij0,Ne)
 	#We create Lij as a matrix of lists of laser indices
 	global Lij
-	Lij=[]
-	for i in range(Ne):
-		fila=[]
-		for j in range(Ne):
-			band=False
-			for tri in Lij0:
-				if [i+1,j+1] == tri[:2]:
-					band=True
-					break
-				elif [j+1,i+1] == tri[:2]:
-					band=True
-					break
-			if band:
-				fila+=[tri[2]]
-			else:
-				fila+=[[]]
-		Lij+=[fila]
+	Lij=[[[] for j in range(Ne)] for i in range(Ne)]
+	for (i,j),lasers in lij_couplings(Lij0,Ne).items():
+		Lij[i][j]=lasers
 	return Lij
 
+class SparseLij(object):
+	r"""A sparse version of the matrix Lij returned by formatLij. Only the pairs
+	of states coupled by some laser are stored, in compressed sparse row
+	form, but the matrix is indexed just like a list of lists, so that
+	Lij[i][j] is the list of lasers that couple states i+1 and j+1 (an
+	empty list if there are none).
+
+	>>> Lij=SparseLij([[1,2,[1]],[2,3,[2]]],3)
+	>>> print Lij[0][1], Lij[2][1], Lij[2][0]
+	[1] [2] []
+	>>> Lij.tolist()==formatLij([[1,2,[1]],[2,3,[2]]],3)
+	True
+	>>> list(Lij.pairs())
+	[(0, 1, [1]), (1, 0, [1]), (1, 2, [2]), (2, 1, [2])]
+	>>> Lij.laser_pairs(2)
+	(array([2]), array([1]))
+	"""
+	def __init__(self,Lij0,Ne):
+		self._build(lij_couplings(Lij0,Ne),Ne)
+
+	@classmethod
+	def from_matrix(cls,Lij):
+		"""Build a SparseLij from an Ne x Ne matrix of lists of lasers."""
+		Ne=len(Lij)
+		return cls.from_couplings(dict([((i,j),Lij[i][j])
+								for i in range(Ne) for j in range(Ne)
+								if len(Lij[i][j])>0]),Ne)
+
+	@classmethod
+	def from_couplings(cls,couplings,Ne):
+		"""Build a SparseLij from a dictionary {(i,j): lasers} (indices
+		starting from 0)."""
+		new=cls([],Ne)
+		new._build(couplings,Ne)
+		return new
+
+	@classmethod
+	def from_r(cls,r,lasers=[1]):
+		"""Build a SparseLij with the pairs of states that have a nonzero
+		matrix element of r. Each pair is coupled by the given lasers, or by
+		lasers(i,j) if it is a function (with indices starting from 1).
+
+		>>> r=[[[0,1,0],[1,0,0],[0,0,0]],[[0,0,0],[0,0,1],[0,1,0]],[[0,0,0]]*3]
+		>>> SparseLij.from_r(r,lambda i,j: [i-1]).tolist()
+		[[[], [1], []], [[1], [], [2]], [[], [2], []]]
+		"""
+		nonzero=np.zeros(np.shape(r[0]),bool)
+		for p in range(3):
+			nonzero|=np.asarray(r[p])!=0
+		Ne=len(nonzero)
+		couplings={}
+		for i,j in zip(*np.nonzero(np.tril(nonzero|nonzero.T,-1))):
+			i=int(i); j=int(j)
+			if callable(lasers):
+				lasers_ij=lasers(i+1,j+1)
+			else:
+				lasers_ij=lasers
+			if len(lasers_ij)>0:
+				couplings[(i,j)]=lasers_ij; couplings[(j,i)]=lasers_ij
+		return cls.from_couplings(couplings,Ne)
+
+	def _build(self,couplings,Ne):
+		pairs=sorted(couplings.keys())
+		self.Ne=Ne
+		self.couplings=dict(couplings)
+		self.indptr=[0 for i in range(Ne+1)]
+		for i,j in pairs: self.indptr[i+1]+=1
+		for i in range(Ne): self.indptr[i+1]+=self.indptr[i]
+		self.indices=[j for i,j in pairs]
+		self.lasers=[couplings[pair] for pair in pairs]
+
+		#The pairs i>j coupled by each laser.
+		by_laser={}
+		for i,j in pairs:
+			if i>j:
+				for l in couplings[(i,j)]:
+					by_laser.setdefault(l,[]).append((i,j))
+		self.by_laser=dict([(l,(np.array([i for i,j in ij],int),np.array([j for i,j in ij],int)))
+						for l,ij in by_laser.items()])
+
+	def get(self,i,j):
+		"""The list of lasers that couple states i+1 and j+1."""
+		return self.couplings.get((i,j),[])
+
+	def laser_pairs(self,l):
+		"""The arrays of indices i>j (starting from 0) of the pairs of states coupled by laser l."""
+		if l in self.by_laser: return self.by_laser[l]
+		return np.zeros(0,int),np.zeros(0,int)
+
+	def pairs(self):
+		"""Iterate over the coupled pairs as (i,j,lasers), row by row."""
+		for i in range(self.Ne):
+			for k in range(self.indptr[i],self.indptr[i+1]):
+				yield i,self.indices[k],self.lasers[k]
+
+	def tolist(self):
+		"""Return Lij as the Ne x Ne list of lists given by formatLij."""
+		return [[self.get(i,j) for j in range(self.Ne)] for i in range(self.Ne)]
+
+	def __len__(self):
+		return self.Ne
+
+	def __getitem__(self,i):
+		if i<0: i+=self.Ne
+		return SparseLijRow(self,i)
+
+	def __iter__(self):
+		for i in range(self.Ne): yield self[i]
+
+class SparseLijRow(object):
+	"""A row of a SparseLij."""
+	def __init__(self,Lij,i):
+		self.Lij=Lij; self.i=i
+
+	def __len__(self):
+		return self.Lij.Ne
+
+	def __getitem__(self,j):
+		if j<0: j+=self.Lij.Ne
+		return self.Lij.get(self.i,j)
+
+	def __iter__(self):
+		for j in range(self.Lij.Ne): yield self.Lij.get(self.i,j)
+
+def coupled_indices(Lij):
+	"""Return two lists of length Ne: the indices j of the states such that
+	Lij[i][j] is not empty for each state i, and the indices i such that
+	Lij[i][j] is not empty for each state j. Indices start from 0.
+
+	>>> coupled_indices(formatLij([[1,2,[1]],[2,3,[2]]],3))
+	([[1], [0, 2], [1]], [[1], [0, 2], [1]])
+	"""
+	Ne=len(Lij)
+	if isinstance(Lij,SparseLij):
+		pairs=Lij.pairs()
+	else:
+		pairs=((i,j,Lij[i][j]) for i in range(Ne) for j in range(Ne))
+
+	rows=[[] for i in range(Ne)]; columns=[[] for j in range(Ne)]
+	for i,j,lasers in pairs:
+		if len(lasers)>0:
+			rows[i]+=[j]; columns[j]+=[i]
+	return rows,columns
+
+phase_transformations={}
+
 def find_phase_transformation(Ne,Nl,r,Lij,verbose=0,return_equations=False,**kwds):
 	"""This function returns a phase transformation specified as a list of lenght Ne
 	whose elements correspond to each theta_i. Each element is a list of length Nl
@@ -214,52 +1206,64 @@ def find_phase_transformation(Ne,Nl,r,Lij,verbose=0,return_equations=False,**kwd
 
 	theta_1=omega^1+omega^2
 	theta_2=omega^1
-	theta_3=0."""
-
-	#We first define the needed variables
-	_omega_laser=[Symbol('omega_laser'+str(l+1)) for l in range(Nl)]
-	_theta=[Symbol('theta'+str(i+1)) for i in range(Ne)]
-
-	#We find all the equations that the specified problem has to fulfil.
-	eqs=[]
+	theta_3=0.
+
+	Each pair of states i<j coupled by laser l requires theta_i=theta_j+omega^l, so
+	the phases are propagated along the coupling graph from the highest state of each
+	connected component, which is given theta=0. The result is cached for each
+	coupling structure.
+
+	>>> r=[[[0,1,0],[1,0,1],[0,1,0]] for p in range(3)]
+	>>> find_phase_transformation(3,2,r,formatLij([[1,2,[1]],[2,3,[2]]],3))
+	[[1, 1], [0, 1], [0, 0]]
+	"""
+
+	#We find the pairs of states coupled by each laser.
+	rows,columns=coupled_indices(Lij)
+	if type(r[0])==list:
+		coupled=lambda i,j: (r[0][i][j] != 0) or (r[1][i][j] != 0) or (r[2][i][j] != 0)
+	else:
+		coupled=lambda i,j: (r[0][i,j] != 0) or (r[1][i,j] != 0) or (r[2][i,j] != 0)
+	edges=[]
 	for i in range(Ne):
-		for j in range(i+1,Ne):
-			if type(r[0])==list:
-				if (r[0][i][j] != 0) or (r[1][i][j] != 0) or (r[2][i][j] != 0):
-					for l in range(Nl):
-						if l+1 in Lij[i][j]:
-							eqs+=[_omega_laser[l] + _theta[j] - _theta[i] ]
-			else:
-				if (r[0][i,j] != 0) or (r[1][i,j] != 0) or (r[2][i,j] != 0):
-					for l in range(Nl):
-						if l+1 in Lij[i][j]:
-							eqs+=[_omega_laser[l] + _theta[j] - _theta[i] ]
-
+		for j in rows[i]:
+			if j>i and coupled(i,j):
+				for l in range(Nl):
+					if l+1 in Lij[i][j]:
+						edges+=[(i,j,l)]
 
 	if return_equations:
-		return eqs
-
-	#~ print _theta
-	sol=solve(eqs,_theta,dict=True)[0]
-	for i in range(Ne):
-		if _theta[i] not in sol.keys():
-			sol.update({_theta[i]:_theta[i]})
-	#~ print sol.keys()
-	#~ print len(sol)
-	#~ print sol[_theta[23]]
-	sol_simple={_theta[i]:sol[_theta[i]]-sol[_theta[-1]] for i in range(Ne)}
-	#~ print sol
-	#~ for i in range(Ne):
-		#~ print i+1,sol_simple[_theta[i]]
-
-	sol=[]
-	for i in range(Ne):
-		soli=[]
-		for l in range(Nl):
-			soli+=[diff(sol_simple[_theta[i]] ,_omega_laser[l])]
-		sol+=[soli]
-
-	return sol
+		_omega_laser=[Symbol('omega_laser'+str(l+1)) for l in range(Nl)]
+		_theta=[Symbol('theta'+str(i+1)) for i in range(Ne)]
+		return [_omega_laser[l] + _theta[j] - _theta[i] for i,j,l in edges]
+
+	key=(Ne,Nl,tuple(edges))
+	if key not in phase_transformations:
+		#theta_i - theta_j = omega^l for each edge, seen from both ends.
+		neighbours=[[] for i in range(Ne)]
+		for i,j,l in edges:
+			step=np.zeros(Nl,int); step[l]=1
+			neighbours[j]+=[(i,step)]
+			neighbours[i]+=[(j,-step)]
+
+		theta=[None for i in range(Ne)]
+		for root in range(Ne-1,-1,-1):
+			if theta[root] is not None: continue
+			theta[root]=np.zeros(Nl,int)
+			queue=[root]
+			while queue:
+				i=queue.pop()
+				for j,step in neighbours[i]:
+					if theta[j] is None:
+						theta[j]=theta[i]+step
+						queue+=[j]
+					elif (theta[j]!=theta[i]+step).any():
+						s ='The couplings of states '+str(i+1)+' and '+str(j+1)+' form a loop,'
+						s+=' so there is no phase transformation that eliminates the explicit time dependance.'
+						raise ValueError,s
+		phase_transformations[key]=[theta_i.tolist() for theta_i in theta]
+
+	return [theta_i[:] for theta_i in phase_transformations[key]]
 
 def calculate_iI_correspondence(omega):
 	Ne=len(omega[0])
@@ -312,11 +1316,12 @@ def laser_detunings(Lij,Nl,i_d,I_nd,Nnd):
 	but as pairs if ij. The indices in it start from 0.
 	'''
 	Ne=len(Lij)
+	rows=coupled_indices(Lij)[0]
 	detunings=[[] for i in range(Nl)]
 	detuningsij=[[] for i in range(Nl)]
 	detuning=[0 for i in range(Nnd)]
 	for i in range(1,Ne):
-		for j in range(i):
+		for j in [j for j in rows[i] if j<i]:
 			for l in Lij[i][j]:
 				det=detuning[:]
 				det[I_nd(i+1)-1]+=1;det[I_nd(j+1)-1]-=1
@@ -326,15 +1331,96 @@ def laser_detunings(Lij,Nl,i_d,I_nd,Nnd):
 
 	return detunings,detuningsij
 
+class DetuningTable(object):
+	r"""The lookups that Theta needs, built once for each experiment.
+
+	For each vector of laser coefficients the (the difference theta_j-theta_i) it
+	maps the non-degenerate frequency differences that the detunings can reduce to,
+	to the first combination of detunings (in the order of detuning_combinations)
+	that does so. It also maps each frequency omega_ab to the first pair a>b coupled
+	by some laser.
+
+	>>> Lij=formatLij([[1,2,[1]],[1,3,[2]]],3)
+	>>> detunings,detuningsij=laser_detunings(Lij,2,None,lambda i: i,3)
+	>>> table=DetuningTable(detunings,[[0,-1,-2],[1,0,-1],[2,1,0]],Lij)
+	>>> table.combination([1,-1],[0,1,-1])
+	[0, 0]
+	>>> table.transition(2)
+	(3, 1)
+	>>> table.common_neighbours(3,2)
+	[1]
+	"""
+	def __init__(self,detunings,omega,Lij):
+		self.Nl=len(detunings)
+		self.detunings=[np.array(detunings[l],int) for l in range(self.Nl)]
+		self.tables={}
+
+		rows=coupled_indices(Lij)[0]
+		self.neighbours=[set(row) for row in rows]
+		self.transitions={}
+		for a in range(len(Lij)):
+			for b in [b for b in rows[a] if b<a]:
+				omega_ab=omega[a][b]
+				if omega_ab not in self.transitions:
+					self.transitions[omega_ab]=(a+1,b+1)
+
+	def combination(self,the,omegaij):
+		r"""The combination of detunings whose sum weighted by the equals omegaij, or None."""
+		key=tuple(the)
+		if key not in self.tables:
+			self.tables[key]=self._table(the)
+		return self.tables[key].get(tuple(omegaij))
+
+	def _table(self,the):
+		table={}
+		if [d for d in self.detunings if len(d)==0]: return table
+
+		#Only the lasers with nonzero coefficients change the sum.
+		active=[l for l in range(self.Nl) if the[l]!=0]
+		if active==[]:
+			table[tuple([0]*self.detunings[0].shape[1])]=[0]*self.Nl
+			return table
+
+		shape=[len(self.detunings[l]) for l in active]
+		index=np.indices(shape).reshape(len(active),-1).T
+		sums=0
+		for k,l in enumerate(active):
+			sums=sums+the[l]*self.detunings[l][index[:,k]]
+
+		for c,s in zip(index.tolist(),sums.tolist()):
+			s=tuple(s)
+			if s not in table:
+				comb=[0]*self.Nl
+				for k,l in enumerate(active): comb[l]=c[k]
+				table[s]=comb
+		return table
+
+	def common_neighbours(self,i,j):
+		r"""The states k (starting from 1) coupled by some laser to both i and j."""
+		return sorted([k+1 for k in self.neighbours[i-1] & self.neighbours[j-1]])
+
+	def transition(self,omega_ij):
+		r"""The first pair a,b (starting from 1) coupled by some laser with omega_ab=omega_ij, or None."""
+		return self.transitions.get(omega_ij)
+
 def Theta(i,j,theta,omega_rescaled,omega_min,
-			detunings,detuningsij,combinations,detuning_indices,
+			detunings,detuningsij,detuning_table,detuning_indices,
 			Lij,i_d,I_nd,Nnd,
-			states=None,verbose=1,other_the=None):
+			states=None,verbose=1,other_the=None,coefficients=False):
 	"""This function returns code for Theta_i j as defined in the equation labeled Theta. in terms
-	of detunings. It recieves indexes i,j starting from 1."""
+	of detunings. It recieves indexes i,j starting from 1.
+
+	If coefficients=True it also returns the same expression as a dictionary of the coefficients
+	of ('detuning',k), ('detuning_knob',l) and ('constant',0)."""
+	combination={}
+	def result(The):
+		if coefficients: return The,combination
+		return The
+	def add(key,c):
+		combination[key]=combination.get(key,0)+c
 
 	if i==j:
-		return ''
+		return result('')
 	elif j>i:
 		raise ValueError,'i should never be less than j.'
 
@@ -348,7 +1434,7 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 	#This part is about finding detunings that reduce to -omega_ij
 	if the==[0 for l in range(Nl)]:
 		if omega_rescaled[i-1][j-1]==0:
-			return ''
+			return result('')
 		#We need a combination of detunings that yields -omega_i,j.
 		#According to equation labeled "detuning-exception1"
 		#-omega_ij= delta^l_ik - delta^l_jk
@@ -358,7 +1444,8 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 		ii=min(i,j)
 		band1=False
 		band2=False
-		for k in range(1,ii):
+		neighbours=detuning_table.common_neighbours(i,j)
+		for k in [k for k in neighbours if k<ii]:
 			for l in range(1,Nl+1):
 				if l in Lij[i-1][k-1] and l in Lij[j-1][k-1]:
 					s   ='I found that -omega_'+str(i)+','+str(j)
@@ -379,7 +1466,7 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 			#-omega_ij= delta^l_kj - delta^l_ki
 			#to look for a k greater than i and j
 			#and an l such that l is in L_ik and in L_jk
-			for k in range(ii+1,Ne+1):
+			for k in [k for k in neighbours if k>ii]:
 				for l in range(1,Nl+1):
 					if l in Lij[i-1][k-1] and l in Lij[j-1][k-1]:
 						s   ='I found that -omega_'+str(i)+','+str(j)
@@ -404,10 +1491,10 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 			#We test the indices of all detunings of laser l to find the ones we need.
 			for kk in range(detuning_indices[l-1]):
 				if detuningsij[l-1][kk][0]+1==I_nd(i) and detuningsij[l-1][kk][1]+1==I_nd(k):
-					The+='+detuning('+str(acum+kk+1)+')'
+					The+='+detuning('+str(acum+kk+1)+')'; add(('detuning',acum+kk+1),1)
 				if detuningsij[l-1][kk][0]+1==I_nd(j) and detuningsij[l-1][kk][1]+1==I_nd(k):
-					The+='-detuning('+str(acum+kk+1)+')'
-			return The
+					The+='-detuning('+str(acum+kk+1)+')'; add(('detuning',acum+kk+1),-1)
+			return result(The)
 		elif band2:
 			The=''
 			#We need to find which detunings are delta^l_k,j and delta^l_k,i.
@@ -417,13 +1504,14 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 			#We test the indices of all detunings of laser l to find the ones we need.
 			for kk in range(detuning_indices[l-1]):
 				if detuningsij[l-1][kk][0]+1==I_nd(k) and detuningsij[l-1][kk][1]+1==I_nd(j):
-					The+='+detuning('+str(acum+kk+1)+')'
+					The+='+detuning('+str(acum+kk+1)+')'; add(('detuning',acum+kk+1),1)
 				if detuningsij[l-1][kk][0]+1==I_nd(k) and detuningsij[l-1][kk][1]+1==I_nd(i):
-					The+='-detuning('+str(acum+kk+1)+')'
-			return The
+					The+='-detuning('+str(acum+kk+1)+')'; add(('detuning',acum+kk+1),-1)
+			return result(The)
 		else:
 			if verbose>1: print 'WARNING: Optical frequencies will be used instead for -omega_',i,j,'=',omega_rescaled[i-1][j-1],'\n'
-			return format_double(-omega_rescaled[i-1][j-1])
+			add(('constant',0),-omega_rescaled[i-1][j-1])
+			return result(format_double(-omega_rescaled[i-1][j-1]))
 	###########################################################################################
 	#This part is about finding detunings that reduce to (theta_j -theta_i -omega_ij)
 
@@ -434,12 +1522,8 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 	#We search for a combination of detunings that reduces to omegaij
 	#That is a linear combination of detunings with coefficients the
 	#that reduces to omegaij. Here
-	detuning_failure=True
-	for comb in combinations:
-		suma=[sum([the[l]*detunings[l][comb[l]][ii] for l in range(Nl)])  for ii in range(Nnd)]
-		if suma==omegaij:
-			detuning_failure=False
-			break
+	comb=detuning_table.combination(the,omegaij)
+	detuning_failure=comb==None
 
 	#We stop if no combination reduces to the needed expression.
 	if detuning_failure:
@@ -447,23 +1531,19 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 		if verbose>1: print 'We will see if it is possible to express Theta_'+str(i)+','+str(j)+'=theta_'+str(j)+'-theta_'+str(i)+'-omega_'+str(i)+','+str(j)
 		if verbose>1: print 'in terms of other indices a,b such that omega_ab=omega_ij and transition i -> j is allowed by Lij.'
 
-		band3=False
-		for a in range(Ne):
-			for b in range(a):
-				if omega_rescaled[a][b]==omega_rescaled[i-1][j-1] and Lij[a][b]!=[]:
-					band3=True
-					break
-			if band3: break
-		if verbose>1: print band3,a,b,i,j
+		ab=detuning_table.transition(omega_rescaled[i-1][j-1])
+		band3=ab!=None
+		if verbose>1: print band3,ab,i,j
 
-		a=a+1; b=b+1
-		if band3 and (i!=a or j!=b):
+		if band3 and ab!=(i,j):
+			a,b=ab
 			if verbose>1: print omega_rescaled[i-1][j-1],omega_rescaled[a-1][b-1]
 			if verbose>1: print the
 			if verbose>1: print 'This was possible for omega_'+str(a)+','+str(b)
 			return Theta(a,b,theta,omega_rescaled,omega_min,
-					detunings,detuningsij,combinations,detuning_indices
-					,Lij,other_the=the,verbose=verbose,states=states)
+					detunings,detuningsij,detuning_table,detuning_indices,
+					Lij,i_d,I_nd,Nnd,other_the=the,verbose=verbose,states=states,
+					coefficients=coefficients)
 		else:
 			#verbose=2
 			#print 111
@@ -483,20 +1563,25 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 				a=the[l]
 				if a==1:
 					The+='+'+format_double(omega_min[l])+'+detuning_knob('+str(l+1)+')'
+					add(('constant',0),omega_min[l]); add(('detuning_knob',l+1),1)
 				elif a==-1:
 					The+='-('+format_double(omega_min[l])+'+detuning_knob('+str(l+1)+'))'
+					add(('constant',0),-omega_min[l]); add(('detuning_knob',l+1),-1)
 				elif a==0:
 					The+=''
 				elif a>0:
 					The+='+'+str(a)+'*'+format_double(omega_min[l])+'+detuning_knob('+str(l+1)+')'
+					add(('constant',0),a*omega_min[l]); add(('detuning_knob',l+1),1)
 				else:
 					The+=    str(a)+'*('+format_double(omega_min[l])+'+detuning_knob('+str(l+1)+'))'
+					add(('constant',0),a*omega_min[l]); add(('detuning_knob',l+1),a)
 
 			#We substract omega_ij
 			The+=format_double(-omega_rescaled[i-1][j-1])
+			add(('constant',0),-omega_rescaled[i-1][j-1])
 			if verbose>1: print The
 			if verbose>1: print
-			return The
+			return result(The)
 
 	#For each optical frequency in the, we write the corresponding detuning.
 	#This way of assigining a global index ll to the detunings ammounts to
@@ -517,6 +1602,7 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 			The+='+'+str(the[l])+'*detuning('+str(acum+comb[l]+1)+')'
 		else:
 			The+= str(the[l])+'*detuning('+str(acum+comb[l]+1)+')'
+		if the[l]!=0: add(('detuning',acum+comb[l]+1),the[l])
 		acum+=detuning_indices[l]
 
 	if The[:1]=='+':
@@ -524,7 +1610,173 @@ def Theta(i,j,theta,omega_rescaled,omega_min,
 
 	####################################################################
 	#print 'The',The
-	return The
+	return result(The)
+
+class PolarizationTerm(object):
+	r"""A linear combination of the parameters polarization(k,l) that programs
+	written with runtime_polarization=True read at runtime. It supports the
+	arithmetic that dot_product and part apply to the coefficients, and
+	format_double writes it as Fortran code.
+
+	>>> x=PolarizationTerm({(1,1):1.0,(4,1):1j})
+	>>> print format_double((0.5*x).real), format_double((-x).imag)
+	0.5d0*polarization(1,1) -1.0d0*polarization(4,1)
+	>>> x.real-x.real==0
+	True
+	"""
+	def __init__(self,coefficients):
+		self.coefficients=dict([(k,c) for k,c in coefficients.items() if c!=0])
+
+	def _map(self,f):
+		return PolarizationTerm(dict([(k,f(c)) for k,c in self.coefficients.items()]))
+
+	@property
+	def real(self):
+		return self._map(lambda c: complex(c).real)
+
+	@property
+	def imag(self):
+		return self._map(lambda c: complex(c).imag)
+
+	def __mul__(self,a):
+		if isinstance(a,np.generic): a=a.item()
+		return self._map(lambda c: c*a)
+
+	__rmul__=__mul__
+
+	def __neg__(self):
+		return self._map(lambda c: -c)
+
+	def __pos__(self):
+		return self
+
+	def __add__(self,other):
+		if not isinstance(other,PolarizationTerm):
+			if other==0: return self
+			raise ValueError,'Only polarization terms can be added to polarization terms.'
+		coefficients=self.coefficients.copy()
+		for k,c in other.coefficients.items():
+			coefficients[k]=coefficients.get(k,0)+c
+		return PolarizationTerm(coefficients)
+
+	__radd__=__add__
+
+	def __sub__(self,other):
+		return self+(-other)
+
+	def __rsub__(self,other):
+		return (-self)+other
+
+	def __eq__(self,other):
+		if isinstance(other,PolarizationTerm): return (self-other).coefficients=={}
+		return other==0 and self.coefficients=={}
+
+	def __ne__(self,other):
+		return not self==other
+
+	def code(self):
+		r"""The Fortran expression, with a continuation line for each term."""
+		terms=[]
+		for (k,l),c in sorted(self.coefficients.items(),key=lambda kc: (kc[0][1],kc[0][0])):
+			term=format_double(c)+'*polarization('+str(k)+','+str(l)+')'
+			if terms!=[] and c>0: term='+'+term
+			terms+=[term]
+		if terms==[]: return '0.0d0'
+		return '&\n\t\t&'.join(terms)
+
+class RuntimePolarization(object):
+	r"""Stands for laser l in write_equations_code and write_rk4 when the polarization
+	is given at runtime. The parameters polarization(1:3,l) are the real parts of the
+	helicity components Yp of epsilon^(+), and polarization(4:6,l) their imaginary parts.
+	The components Ym of epsilon^(-)=conjugate(epsilon^(+)) follow from them."""
+	def __init__(self,l):
+		self.Yp=[PolarizationTerm({(k+1,l):1,(k+4,l):1j}) for k in range(3)]
+		self.Ym=[(-1)**(k-1)*PolarizationTerm({(3-k,l):1,(6-k,l):-1j}) for k in range(3)]
+
+def polarization_parameters(polarization):
+	r"""The runtime polarization parameters of a list of lasers (PlaneWave or MotField),
+	or of a list of the helicity components Yp of their polarizations, in the order
+	in which they are read by the programs written with runtime_polarization=True.
+
+	>>> polarization_parameters([[0.5,1j,0]])
+	[0.5, 0.0, 0.0, 0.0, 1.0, 0.0]
+	"""
+	parameters=[]
+	for Yp in polarization:
+		if hasattr(Yp,'Yp'): Yp=Yp.Yp
+		Yp=[complex(Yp[k]) for k in range(3)]
+		parameters+=[Yp[k].real for k in range(3)]+[Yp[k].imag for k in range(3)]
+	return parameters
+
+def decay_manifolds(states,Ne,manifolds=None):
+	r"""The manifold (counting from 1) of each state whose decay and dephasing rates
+	are scaled together in programs written with runtime_decay=True. Unless the
+	manifolds are given, the states with the same fine structure quantum numbers
+	form a manifold, and states that are not State objects form a single one.
+
+	>>> decay_manifolds(None,3)
+	[1, 1, 1]
+	"""
+	if manifolds!=None:
+		if len(manifolds)!=Ne:
+			raise ValueError,'There must be a manifold for each of the '+str(Ne)+' states.'
+		return list(manifolds)
+	if states==None or not all([hasattr(s,'quantum_numbers') for s in states]):
+		return [1]*Ne
+	fine=[]; manifolds=[]
+	for s in states:
+		key=(s.element,)+tuple(s.quantum_numbers[:4])
+		if key not in fine: fine+=[key]
+		manifolds+=[fine.index(key)+1]
+	return manifolds
+
+def decay_parameters(decay_factors,decay_scale=1.0,dephasing=None):
+	r"""The runtime decay parameters in the order in which they are read by the programs
+	written with runtime_decay=True: a global scale of the decay rates, the factors that
+	scale the decay rates of each manifold, and the matrix of extra pure dephasing rates
+	of the coherences between manifolds (zero by default), one line each. The dephasing
+	rates can be calculated for instance from collision_rate, the transit time or the
+	linewidth of the lasers.
+
+	>>> print decay_parameters([1.0,2.0],0.5,[[0.0,0.1],[0.1,0.0]]),
+	0.5
+	1.0 2.0 
+	0.0 0.1 0.1 0.0 
+	"""
+	Nm=len(decay_factors)
+	if dephasing is None: dephasing=np.zeros((Nm,Nm))
+	dephasing=np.asarray(dephasing,dtype=float)
+	if dephasing.shape!=(Nm,Nm):
+		raise ValueError,'The dephasing rates must be a '+str(Nm)+'x'+str(Nm)+' matrix.'
+	params =str(decay_scale)+'\n'
+	params+=''.join([str(i)+' ' for i in decay_factors])+'\n'
+	params+=''.join([str(i)+' ' for i in dephasing.flatten('F')])+'\n'
+	return params
+
+def runtime_code(Nl,runtime_polarization=False,Nm=0):
+	r"""The pieces of Fortran code that pass the parameters read at runtime along with E0:
+	the polarization parameters in programs written with runtime_polarization=True, and
+	the decay parameters of Nm manifolds in programs written with runtime_decay=True.
+	These are the arguments, the declarations in the main program and in the subroutines,
+	and the lines that read them. They are empty otherwise."""
+	E0_args='E0'; declaration=''; argument=''; read=''
+	if runtime_polarization:
+		E0_args+=',polarization'
+		declaration+='    real*8, dimension(6,'+str(Nl)+') :: polarization\n'
+		argument+='\treal*8, dimension(6,'+str(Nl)+'), intent(in) :: polarization\n'
+		read+='    read(2,*) polarization\n'
+	if Nm>0:
+		E0_args+=',decay_scale,decay_factors,dephasing'
+		declaration+='    real*8 :: decay_scale\n'
+		declaration+='    real*8, dimension('+str(Nm)+') :: decay_factors\n'
+		declaration+='    real*8, dimension('+str(Nm)+','+str(Nm)+') :: dephasing\n'
+		argument+='\treal*8, intent(in) :: decay_scale\n'
+		argument+='\treal*8, dimension('+str(Nm)+'), intent(in) :: decay_factors\n'
+		argument+='\treal*8, dimension('+str(Nm)+','+str(Nm)+'), intent(in) :: dephasing\n'
+		read+='    read(2,*) decay_scale\n'
+		read+='    read(2,*) decay_factors\n'
+		read+='    read(2,*) dephasing\n'
+	return E0_args,declaration,argument,read
 
 def dot_product(laserl,sign,r,i,j):
 	"This function calculates the dot product epsilon^(l(+-)) . vec(r_ij)."
@@ -539,7 +1791,9 @@ def dot_product(laserl,sign,r,i,j):
 		#~ print [(laserl.Yp[1-p],r[p+1][i-1][j-1]) for p in range(-1,2)]
 
 
-	if not sage_included:
+	if isinstance(dp,PolarizationTerm):
+		return dp
+	elif not sage_included:
 		return complex(dp)
 	else:
 		return dp
@@ -556,15 +1810,80 @@ def find_omega_min(omega,Nl,detuningsij,i_d,I_nd):
 	return omega_min,omega_min_indices
 
 def write_equations_code(path,name,laser,omega,gamma,r,Lij,
-				states=None,excluded_mu=[],verbose=1):
+				states=None,excluded_mu=[],verbose=1,runtime_polarization=False,
+				runtime_decay=False,manifolds=None,split_detunings=False,terms=None,
+				sparse_index=None):
+	r"""This function writes the Fortran code that calculates the matrix A and the vector B
+	of the equations. If split_detunings=True, the code is returned as a pair: the code of the
+	terms that do not depend on the detunings, and the code that calculates the detunings and
+	adds the terms that depend on them.
+
+	If a list terms is given, a tuple (mu,nu,coefficients) is appended to it for each term added
+	to A(mu,nu), or to B(mu,1) with nu=0, where coefficients is the vector of the coefficients
+	of 1, E0(1), ... E0(Nl), detuning_knob(1), ... detuning_knob(Nl) in the term.
+
+	If a dictionary sparse_index is given, A is written as a vector of its nonzero elements, and
+	the position of each element (mu,nu) in that vector is added to sparse_index as it is found."""
 	Ne=len(omega[0])
 	Nl=len(laser)
+	if terms!=None and (runtime_polarization or runtime_decay):
+		raise ValueError,'The terms can only be given for polarizations and decay rates written into the code.'
+
+	def record(mu,nu,coefficients):
+		if terms!=None:
+			vector=np.zeros(2*Nl+1)
+			for k,c in coefficients.items(): vector[k]+=c
+			terms.append((mu,nu,vector))
+
+	def element(mu,nu):
+		if sparse_index==None: return 'A('+str(mu)+','+str(nu)+')'
+		if (mu,nu) not in sparse_index: sparse_index[(mu,nu)]=len(sparse_index)+1
+		return 'A('+str(sparse_index[(mu,nu)])+')'
+
+	def term(mu,nu,value,coefficients):
+		record(mu,nu,coefficients)
+		return '    '+element(mu,nu)+'='+element(mu,nu)+value+'\n'
+
+	def laser_term(mu,nu,l,coefficient):
+		#These terms are halved by A=A/2.0d0.
+		if terms!=None: record(mu,nu,{l:coefficient/2.0})
+		return '\t'+element(mu,nu)+'='+element(mu,nu)+'+E0('+str(l)+')*('+format_double(coefficient)+')\n'
+
+	def phase_coefficients(combination):
+		coefficients={}
+		for (kind,k),c in combination.items():
+			if kind=='detuning':
+				for kk,cc in detuning_coefficients[k].items():
+					coefficients[kk]=coefficients.get(kk,0)+c*cc
+			elif kind=='detuning_knob':
+				coefficients[Nl+k]=coefficients.get(Nl+k,0)+c
+			else:
+				coefficients[0]=coefficients.get(0,0)+c
+		return coefficients
+
+	#The coefficients are written in terms of the polarization parameters if
+	#they are given at runtime.
+	if runtime_polarization:
+		laser=[RuntimePolarization(l+1) for l in range(Nl)]
 	N_excluded_mu=len(excluded_mu)
 
 	if states==None: states=range(1,Ne+1)
 
+	#The decay rates of each manifold are scaled by parameters read at runtime.
+	if runtime_decay:
+		manifold=decay_manifolds(states,Ne,manifolds)
+		rate=lambda i: '*decay_scale*decay_factors('+str(manifold[i-1])+')'
+	else:
+		rate=lambda i: ''
+
 	omega_rescaled=omega[:]
 
+	#We only visit the pairs of states coupled by some laser, and the
+	#nonzero decay rates.
+	rows,columns=coupled_indices(Lij)
+	gamma_array=np.asarray(gamma,dtype=float)
+	mu_index=mu_table(Ne,excluded_mu).mu
+
 	#We determine whether it is possible to eliminate explicit time-dependance
 	theta=find_phase_transformation(Ne,Nl,r,Lij)
 
@@ -576,7 +1895,7 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 
 	detuning_indices=[len(detunings[i]) for i in range(Nl)]
 	Nd=sum([len(detunings[l]) for l in range(Nl)])
-	combinations=detuning_combinations(detuning_indices)
+	detuning_table=DetuningTable(detunings,omega_rescaled,Lij)
 
 	####################################################################
 
@@ -599,6 +1918,7 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 				code0+='	!detuning('+str(conta)+')= delta^'+str(ll+1)+'_'+state_i+','+state_j+'\n'
 
 	det_index=1
+	detuning_coefficients={}
 	for l in range(Nl):
 		omega0=omega_min[l]
 		i_min,j_min=omega_min_indices[l]
@@ -608,6 +1928,8 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 			code0+='detuning_knob('+str(l+1)+') '
 			code0+='-('+format_double(omega_rescaled[i_d(ii+1)-1][i_d(i_min+1)-1])+')'
 			code0+='-('+format_double(omega_rescaled[i_d(j_min+1)-1][i_d(jj+1)-1])+')\n'
+			detuning_coefficients[det_index]={Nl+l+1:1.0,
+				0:-omega_rescaled[i_d(ii+1)-1][i_d(i_min+1)-1]-omega_rescaled[i_d(j_min+1)-1][i_d(jj+1)-1]}
 			det_index+=1
 	code0+='\n'
 
@@ -635,7 +1957,7 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 	code+='	!We calculate the independent vector.\n'
 	for i in range(2,Ne+1-N_excluded_mu):
 		for s in [1,-1]:
-			nu=Mu(i,1,s,Ne,excluded_mu)
+			nu=mu_index(i,1,s)
 			#print 'There is an independent term with nu=',nu
 			rhs_check[nu-1]=True
 
@@ -644,6 +1966,7 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 				dp= s*part(dp,-s)
 				if dp!=0:
 					code+='	B('+str(nu)+',1)=B('+str(nu)+',1) +E0('+str(l)+')*('+format_double(dp)+')\n'
+					if terms!=None: record(nu,0,{l:dp/2.0})
 
 	code+='\n'
 	code+='	B=B/2.0d0\n\n'#+str(1/sqrt(2.0))+'d0\n\n'
@@ -652,9 +1975,9 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 	#We give the code to calculate the equations for populations.
 	code+='	!We calculate the equations for populations.\n'
 	for i in range(2,Ne+1):
-		mu=Mu(i,i,1,Ne,excluded_mu)
+		mu=mu_index(i,i,1)
 
-		for k in range(1,Ne+1):
+		for k in [k+1 for k in columns[i-1]]:
 			if k<i:
 				for l in Lij[k-1][i-1]:
 					dp1=dot_product(laser[l-1],-1,r,k,i)
@@ -664,15 +1987,13 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 					imag_coef= part(dp1+dp2, 1)
 
 					if real_coef!=0:
-						nu=Mu(i,k, 1,Ne,excluded_mu)
-						code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-						code+='+E0('+str(l)+')*('+format_double(real_coef)+')\n'
+						nu=mu_index(i,k, 1)
+						code+=laser_term(mu,nu,l,real_coef)
 						row_check[mu-1]=True; col_check[nu-1]=True
 
 					if imag_coef!=0:
-						nu=Mu(i,k,-1,Ne,excluded_mu)
-						code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-						code+='+E0('+str(l)+')*('+format_double(imag_coef)+')\n'
+						nu=mu_index(i,k,-1)
+						code+=laser_term(mu,nu,l,imag_coef)
 						row_check[mu-1]=True; col_check[nu-1]=True
 
 			if k>i:
@@ -685,15 +2006,13 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 					imag_coef=-part(dp1+dp2, 1)
 
 					if real_coef!=0:
-						nu=Mu(k,i, 1,Ne,excluded_mu)
-						code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-						code+='+E0('+str(l)+')*('+format_double(real_coef)+')\n'
+						nu=mu_index(k,i, 1)
+						code+=laser_term(mu,nu,l,real_coef)
 						row_check[mu-1]=True; col_check[nu-1]=True
 
 					if imag_coef!=0:
-						nu=Mu(k,i,-1,Ne,excluded_mu)
-						code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-						code+='+E0('+str(l)+')*('+format_double(imag_coef)+')\n'
+						nu=mu_index(k,i,-1)
+						code+=laser_term(mu,nu,l,imag_coef)
 						row_check[mu-1]=True; col_check[nu-1]=True
 
 	code+='\n'
@@ -707,9 +2026,9 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 		for j in range(1,i):
 
 			for s in [1,-1]:
-				mu=Mu(i,j,s,Ne,excluded_mu)
+				mu=mu_index(i,j,s)
 				#print '................ mu=',mu
-				for k in range(1,Ne+1):
+				for k in [k+1 for k in sorted(set(columns[j-1]+rows[i-1]))]:
 					for l in Lij[k-1][j-1]:
 						if k<i:
 							if k<j:
@@ -717,45 +2036,39 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 								dp=s*dot_product(laser[l-1],-1,r,k,j)
 								dp1=part(  dp,-s)
 								dp2=part(s*dp,+s)
-								nu=Mu(i,k,+1,Ne,excluded_mu)
+								nu=mu_index(i,k,+1)
 								if dp1!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp1)+')\n'
+									code+=laser_term(mu,nu,l,dp1)
 									row_check[mu-1]=True; col_check[nu-1]=True
-								nu=Mu(i,k,-1,Ne,excluded_mu)
+								nu=mu_index(i,k,-1)
 								if dp2!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp2)+')\n'
+									code+=laser_term(mu,nu,l,dp2)
 									row_check[mu-1]=True; col_check[nu-1]=True
 							elif k>j:
 								#print 222#Row 2
 								dp=s*dot_product(laser[l-1],+1,r,k,j)
 								dp1=part(  dp,-s)
 								dp2=part(s*dp,+s)
-								nu=Mu(i,k,+1,Ne,excluded_mu)
+								nu=mu_index(i,k,+1)
 								if dp1!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp1)+')\n'
+									code+=laser_term(mu,nu,l,dp1)
 									row_check[mu-1]=True; col_check[nu-1]=True
-								nu=Mu(i,k,-1,Ne,excluded_mu)
+								nu=mu_index(i,k,-1)
 								if dp2!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp2)+')\n'
+									code+=laser_term(mu,nu,l,dp2)
 									row_check[mu-1]=True; col_check[nu-1]=True
 						elif k>i:
 							#print 333#Row 3
 							dp=s*dot_product(laser[l-1],+1,r,k,j)
 							dp1=part(   dp,-s)
 							dp2=part(-s*dp,+s)
-							nu=Mu(k,i,+1,Ne,excluded_mu)
+							nu=mu_index(k,i,+1)
 							if dp1!=0:
-								code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-								code+='+E0('+str(l)+')*('+format_double(dp1)+')\n'
+								code+=laser_term(mu,nu,l,dp1)
 								row_check[mu-1]=True; col_check[nu-1]=True
-							nu=Mu(k,i,-1,Ne,excluded_mu)
+							nu=mu_index(k,i,-1)
 							if dp2!=0:
-								code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-								code+='+E0('+str(l)+')*('+format_double(dp2)+')\n'
+								code+=laser_term(mu,nu,l,dp2)
 								row_check[mu-1]=True; col_check[nu-1]=True
 					for l in Lij[i-1][k-1]:
 						if k>j:
@@ -764,162 +2077,167 @@ def write_equations_code(path,name,laser,omega,gamma,r,Lij,
 								dp=-s*dot_product(laser[l-1],-1,r,i,k)
 								dp1=part(  dp,-s)
 								dp2=part(s*dp,+s)
-								nu=Mu(k,j,+1,Ne,excluded_mu)
+								nu=mu_index(k,j,+1)
 								if dp1!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp1)+')\n'
+									code+=laser_term(mu,nu,l,dp1)
 									row_check[mu-1]=True; col_check[nu-1]=True
-								nu=Mu(k,j,-1,Ne,excluded_mu)
+								nu=mu_index(k,j,-1)
 								if dp2!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp2)+')\n'
+									code+=laser_term(mu,nu,l,dp2)
 									row_check[mu-1]=True; col_check[nu-1]=True
 							elif k<i:
 								#print 555#Row 5
 								dp=-s*dot_product(laser[l-1],+1,r,i,k)
 								dp1=part(  dp,-s)
 								dp2=part(s*dp,+s)
-								nu=Mu(k,j,+1,Ne,excluded_mu)
+								nu=mu_index(k,j,+1)
 								if dp1!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp1)+')\n'
+									code+=laser_term(mu,nu,l,dp1)
 									row_check[mu-1]=True; col_check[nu-1]=True
-								nu=Mu(k,j,-1,Ne,excluded_mu)
+								nu=mu_index(k,j,-1)
 								if dp2!=0:
-									code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-									code+='+E0('+str(l)+')*('+format_double(dp2)+')\n'
+									code+=laser_term(mu,nu,l,dp2)
 									row_check[mu-1]=True; col_check[nu-1]=True
 						elif k<j:
 							#print 666#Row 6
 							dp=-s*dot_product(laser[l-1],+1,r,i,k)
 							dp1=part(   dp,-s)
 							dp2=part(-s*dp,+s)
-							nu=Mu(j,k,+1,Ne,excluded_mu)
+							nu=mu_index(j,k,+1)
 							if dp1!=0:
-								code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-								code+='+E0('+str(l)+')*('+format_double(dp1)+')\n'
+								code+=laser_term(mu,nu,l,dp1)
 								row_check[mu-1]=True; col_check[nu-1]=True
-							nu=Mu(j,k,-1,Ne,excluded_mu)
+							nu=mu_index(j,k,-1)
 							if dp2!=0:
-								code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-								code+='+E0('+str(l)+')*('+format_double(dp2)+')\n'
+								code+=laser_term(mu,nu,l,dp2)
 								row_check[mu-1]=True; col_check[nu-1]=True
 				for l in Lij[i-1][j-1]:
 					#print 777#Row 7
 					dp=s*part(dot_product(laser[l-1],+1,r,i,j),-s)
-					nu=Mu(i,i,+1,Ne,excluded_mu)
+					nu=mu_index(i,i,+1)
 					if dp!=0:
-						code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-						code+='+E0('+str(l)+')*('+format_double( dp )+')\n'
+						code+=laser_term(mu,nu,l,dp)
 						row_check[mu-1]=True; col_check[nu-1]=True
-						nu=Mu(j,j,+1,Ne,excluded_mu)
+						nu=mu_index(j,j,+1)
 						if nu==0:
 							for n in range(1,Ne):
-								code+='	A('+str(mu)+','+str(n)+')=A('+str(mu)+','+str(n)+')'
-								code+='+E0('+str(l)+')*('+format_double( +dp )+')\n'
+								code+=laser_term(mu,n,l,+dp)
 								row_check[mu-1]=True; col_check[n-1]=True
 						else:
-							code+='	A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-							code+='+E0('+str(l)+')*('+format_double(-dp )+')\n'
+							code+=laser_term(mu,nu,l,-dp)
 							row_check[mu-1]=True; col_check[nu-1]=True
 
 	code+='\n'
 	code+='	A=A/2.0d0\n\n'#+str(1/sqrt(2.0))+'d0\n\n'
 	####################################################################
 	#We add the terms associated with the phase transformation.
+	phase_start=len(code)
 	code+='	!We calculate the terms associated with the phase transformation.\n'
 
 	for i in range(2,Ne+1):
 	#for i in range(2,10):
 		for j in range(1,i):
-			extra=Theta(i,j,theta,omega_rescaled,omega_min,detunings,detuningsij,
-			combinations,detuning_indices,Lij,i_d,I_nd,Nnd,
-			verbose=verbose,states=states)
+			extra,combination=Theta(i,j,theta,omega_rescaled,omega_min,detunings,detuningsij,
+			detuning_table,detuning_indices,Lij,i_d,I_nd,Nnd,
+			verbose=verbose,states=states,coefficients=True)
+			phase=phase_coefficients(combination)
 
 			#print i,j,[extra]
 
 			if extra!='':
 				for s in [1,-1]:
-					mu=Mu(i,j, s,Ne,excluded_mu)
-					nu=Mu(i,j,-s,Ne,excluded_mu)
+					mu=mu_index(i,j, s)
+					nu=mu_index(i,j,-s)
 
-					code+='    A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
 					if s==1:
-						code+='-('+str(extra)+')\n'
+						code+=term(mu,nu,'-('+str(extra)+')',dict([(k,-c) for k,c in phase.items()]))
 					elif s==-1:
-						code+='+('+str(extra)+')\n'
+						code+=term(mu,nu,'+('+str(extra)+')',phase)
 
 					row_check[mu-1]=True; col_check[nu-1]=True
 
 	code+='\n'
 	####################################################################
 	#We add the terms associated with spontaneous decay.
+	phase_end=len(code)
 	code+='	!We calculate the terms associated with spontaneous decay.\n'
 	#First for populations.
 	for i in range(2,Ne+1):
-		mu=Mu(i,i,1,Ne,excluded_mu)
-		for k in range(1,Ne+1):
+		mu=mu_index(i,i,1)
+		for k in [int(k)+1 for k in np.flatnonzero(gamma_array[i-1])]:
 			gams=0
 			if k<i:
 				gams+=gamma[i-1][k-1]
 			elif k>i:
-				nu=Mu(k,k,1,Ne,excluded_mu)
+				nu=mu_index(k,k,1)
 				ga=gamma[i-1][k-1]
 				if ga != 0:
-					code+='    A('+str(mu)+','+str(nu)+')=A('+str(mu)+','+str(nu)+')'
-					code+='-('+format_double(ga)+')\n'
+					code+=term(mu,nu,'-('+format_double(ga)+')'+rate(k),{0:-ga})
 					row_check[mu-1]=True; col_check[nu-1]=True
 			if gams!=0:
-				code+='    A('+str(mu)+','+str(mu)+')=A('+str(mu)+','+str(mu)+')'
-				code+='-('+format_double(gams)+')\n'
+				code+=term(mu,mu,'-('+format_double(gams)+')'+rate(i),{0:-gams})
 				row_check[mu-1]=True; col_check[mu-1]=True
 
 	#And now for coherences
 	for i in range(1,Ne+1):
-		for j in range(1,i):
+		for j in [int(j)+1 for j in np.flatnonzero(gamma_array[i-1][:i-1])]:
 			gams=gamma[i-1][j-1]/2
 			if gams!=0:
 				for a in range(i+1,Ne+1):
-					mu=Mu(a,i,+1,Ne,excluded_mu)
-					code+='    A('+str(mu)+','+str(mu)+')=A('+str(mu)+','+str(mu)+')'
-					code+='-('+format_double(gams)+')\n'
+					mu=mu_index(a,i,+1)
+					code+=term(mu,mu,'-('+format_double(gams)+')'+rate(i),{0:-gams})
 					row_check[mu-1]=True; col_check[mu-1]=True
-					mu=Mu(a,i,-1,Ne,excluded_mu)
-					code+='    A('+str(mu)+','+str(mu)+')=A('+str(mu)+','+str(mu)+')'
-					code+='-('+format_double(gams)+')\n'
+					mu=mu_index(a,i,-1)
+					code+=term(mu,mu,'-('+format_double(gams)+')'+rate(i),{0:-gams})
 					row_check[mu-1]=True; col_check[mu-1]=True
 
 				for b in range(1,i):
-					mu=Mu(i,b,+1,Ne,excluded_mu)
-					code+='    A('+str(mu)+','+str(mu)+')=A('+str(mu)+','+str(mu)+')'
-					code+='-('+format_double(gams)+')\n'
+					mu=mu_index(i,b,+1)
+					code+=term(mu,mu,'-('+format_double(gams)+')'+rate(i),{0:-gams})
 					row_check[mu-1]=True; col_check[mu-1]=True
-					mu=Mu(i,b,-1,Ne,excluded_mu)
-					code+='    A('+str(mu)+','+str(mu)+')=A('+str(mu)+','+str(mu)+')'
-					code+='-('+format_double(gams)+')\n'
+					mu=mu_index(i,b,-1)
+					code+=term(mu,mu,'-('+format_double(gams)+')'+rate(i),{0:-gams})
 					row_check[mu-1]=True; col_check[mu-1]=True
 
+	#And the pure dephasing of coherences, which might be zero at runtime.
+	if runtime_decay:
+		full_mu=mu_table(Ne).mu
+		for i in range(2,Ne+1):
+			for j in range(1,i):
+				for s in [1,-1]:
+					if full_mu(i,j,s) in excluded_mu: continue
+					mu=mu_index(i,j,s)
+					code+=term(mu,mu,'-dephasing('+str(manifold[i-1])+','+str(manifold[j-1])+')',{})
+
 
 #	for i in range(2,Ne+1):
 #		for j in range(1,i):
 #			gams=gamma[i-1][j-1]/2
 #			if gams!=0:
-#				mu=Mu(i,j,+1,Ne,excluded_mu)
+#				mu=mu_index(i,j,+1)
 #				code+='    A('+str(mu)+','+str(mu)+')=A('+str(mu)+','+str(mu)+')'
 #				code+='-('+format_double(gams)+')\n'
 #				row_check[mu-1]=True; col_check[mu-1]=True
-#				mu=Mu(i,j,-1,Ne,excluded_mu)
+#				mu=mu_index(i,j,-1)
 #				code+='    A('+str(mu)+','+str(mu)+')=A('+str(mu)+','+str(mu)+')'
 #				code+='-('+format_double(gams)+')\n'
 #				row_check[mu-1]=True; col_check[mu-1]=True
 
 
 	code+='\n'
-	code=code0+code
+	if split_detunings:
+		code=(code[:phase_start]+code[phase_end:],code0+code[phase_start:phase_end])
+	else:
+		code=code0+code
 	Nd=sum([len(detunings[l]) for l in range(Nl)])
 	return code,Nd,row_check,col_check,rhs_check,Ne,N_excluded_mu,states,omega_min,detuningsij,omega_rescaled
 
-def compile_code(path,name,optimization_flag=' -O3',lapack=False,parallel=True,clone=None):
+def compile_code(path,name,optimization_flag=' -O3',lapack=False,parallel=True,clone=None,
+				netcdf_deflate_level=0,netcdf_shuffle=False,netcdf_single_precision=False):
+	r"""This function compiles the code written by write_stationary, write_evolution or write_rk4.
+
+	The results saved as netCDF files can be compressed with the given deflate level (1 to 9)
+	and shuffle filter, and the density matrix components can be stored in single precision."""
 	from config import use_netcdf
 	t0=time()
 	parallel_flag=''; end_flags=''
@@ -939,6 +2257,9 @@ def compile_code(path,name,optimization_flag=' -O3',lapack=False,parallel=True,c
 	f.close()
 	code=code.replace('.dat',clone+'.dat')
 	code=code.replace('.nc' ,clone+'.nc' )
+	code=code.replace('.npy',clone+'.npy')
+	code=code.replace(netcdf_storage_code(),netcdf_storage_code(netcdf_deflate_level,
+						netcdf_shuffle,netcdf_single_precision))
 
 	#We save the code in a clone file.
 	f=file(path+name+clone+'.f90','w')
@@ -27,10 +27,13 @@ if not sage_included:
 	from misc import Mu,IJ,find_phase_transformation, format_double
 	from misc import calculate_iI_correspondence
 	from misc import Theta,dot_product,find_omega_min,laser_detunings
-	from misc import detuning_combinations
+	from misc import DetuningTable, coupled_indices
+	from misc import PolarizationTerm, RuntimePolarization, runtime_code, polarization_parameters
+	from misc import decay_manifolds, decay_parameters
 	import os
 
 from time import time
+import numpy as np
 
 def add_line(Ne,mu,musign,laser,l,epsilonsign,r,ir,jr,irho,jrho,conj=False):
 	dp=dot_product(laser[l-1],epsilonsign,r,ir,jr)
@@ -39,6 +42,8 @@ def add_line(Ne,mu,musign,laser,l,epsilonsign,r,ir,jr,irho,jrho,conj=False):
 	line+='E0('+str(l)+')*'
 	if sage_included:
 		line+='('+format_double(real(dp))+','+format_double(imag(dp))+')*'
+	elif isinstance(dp,PolarizationTerm):
+		line+='dcmplx('+format_double(dp.real)+','+format_double(dp.imag)+')*'
 	else:
 		line+='('+format_double(dp.real)+','+format_double(dp.imag)+')*'
 	
@@ -53,7 +58,8 @@ def add_line(Ne,mu,musign,laser,l,epsilonsign,r,ir,jr,irho,jrho,conj=False):
 	
 	return line+'\n'
 
-def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
+def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1,runtime_polarization=False,
+				runtime_decay=False,manifolds=None):
 	r"""
     This function writes the Fortran code needed to calculate the time evolution of the density matrix elements
     `\rho_{ij}` using the Runge-Kutta method of order 4.
@@ -76,6 +82,12 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
     
     - ``Omega`` - A floating point number indicating the frequency scale for the equations. The frequencies ``omega`` and ``gamma`` are divided by this number. If ``None`` the equations and the input are taken in SI units.
 
+    - ``runtime_polarization`` - If ``True`` the polarizations of the lasers are read by the program instead of being written into it (see the ``polarization`` argument of ``run_rk4``).
+
+    - ``runtime_decay`` - If ``True`` the decay rates of each manifold are scaled, and pure dephasing rates are added, by parameters read by the program (see the ``decay_factors`` argument of ``run_rk4``).
+
+    - ``manifolds`` - A list with the manifold (counting from 1) of each state for ``runtime_decay``. By default the states with the same fine structure quantum numbers form a manifold (see ``decay_manifolds``).
+
     OUTPUT:
     
     - A file ``name.f90`` is created in ``path``.
@@ -86,9 +98,21 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
 	t0=time()
 	Ne=len(omega[0])
 	Nl=len(laser)
+	if runtime_polarization:
+		laser=[RuntimePolarization(l+1) for l in range(Nl)]
 
 	if states==None: states=range(1,Ne+1)
 
+	#The decay rates of each manifold are scaled by parameters read at runtime.
+	Nm=0
+	if runtime_decay:
+		manifold=decay_manifolds(states,Ne,manifolds)
+		Nm=max(manifold)
+		rate=lambda i: '*decay_scale*decay_factors('+str(manifold[i-1])+')'
+	else:
+		rate=lambda i: ''
+	E0_args,runtime_declaration,runtime_argument,runtime_read=runtime_code(Nl,runtime_polarization,Nm)
+
 	#We make some checks
 	for i in range(Ne):
 		for j in range(Ne):
@@ -104,7 +128,11 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
 	#~ else:
 		#~ omega_rescaled=omega[:]
 	omega_rescaled=omega[:]
-		
+
+	#We only visit the pairs of states coupled by some laser, and the
+	#nonzero decay rates.
+	rows,columns=coupled_indices(Lij)
+	gamma_array=np.asarray(gamma,dtype=float)
 
 	#We determine wether it is possible to eliminate explicit time-dependance
 	theta=find_phase_transformation(Ne,Nl,r,Lij)
@@ -120,7 +148,7 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
 	
 	#The number of detunings
 	Nd=sum([len(detunings[l]) for l in range(Nl)])
-	combinations=detuning_combinations(detuning_indices)	
+	detuning_table=DetuningTable(detunings,omega_rescaled,Lij)
 
 	code0='''program evolution_rk4
 	implicit none
@@ -130,6 +158,7 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
 
 	logical :: print_steps,run_spectrum\n'''
 	code0+='    real*8, dimension('+str(Nl)+') :: E0,detuning_knob\n'
+	code0+=runtime_declaration
 	code0+='    real*8, dimension('+str(Nd)+') :: detuning\n\n'
 
 	code0+="    open(unit=1,file='"+path+name+".dat',status='unknown')\n\n"
@@ -141,6 +170,7 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
     read(2,*) print_steps
     read(2,*) x
     read(2,*) E0\n'''
+	code0+=runtime_read
 
 	code0+='    read(2,*) detuning_knob\n'
 	code0+='    read(2,*) run_spectrum\n\n'
@@ -182,10 +212,10 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
 		t=0.0
 		do i=1,n-1\n'''
 
-	code0+='            call f(x          , t       , k1,   E0, detuning, detuning_knob)\n'
-	code0+='            call f(x+0.5*k1*dt, t+dt*0.5, k2,   E0, detuning, detuning_knob)\n'
-	code0+='            call f(x+0.5*k2*dt, t+dt*0.5, k3,   E0, detuning, detuning_knob)\n'
-	code0+='            call f(x    +k3*dt, t+dt    , k4,   E0, detuning, detuning_knob)\n'
+	code0+='            call f(x          , t       , k1,   '+E0_args+', detuning, detuning_knob)\n'
+	code0+='            call f(x+0.5*k1*dt, t+dt*0.5, k2,   '+E0_args+', detuning, detuning_knob)\n'
+	code0+='            call f(x+0.5*k2*dt, t+dt*0.5, k3,   '+E0_args+', detuning, detuning_knob)\n'
+	code0+='            call f(x    +k3*dt, t+dt    , k4,   '+E0_args+', detuning, detuning_knob)\n'
 
 	code0+='''			x= x+(k1+2*k2+2*k3+k4)*dt/6
 			if (print_steps.and. .not. run_spectrum) print*,'t=',t,'delta=',delta
@@ -238,13 +268,14 @@ def write_rk4(path,name,laser,omega,gamma,r,Lij,states=None,verbose=1):
 end program\n\n'''
 
 
-	code0+='subroutine f(x,t,y,    E0, detuning,detuning_knob)\n'
+	code0+='subroutine f(x,t,y,    '+E0_args+', detuning,detuning_knob)\n'
 	
 	code0+='''    implicit none
     real*8, intent(in) :: t\n'''
 	code0+='    complex*16, dimension('+str(Ne*(Ne+1)/2-1)+'), intent(in)  :: x\n'
 	code0+='    complex*16, dimension('+str(Ne*(Ne+1)/2-1)+'), intent(out) :: y\n'
 	code0+='    real*8, dimension('+str(Nl)+'), intent(in) :: E0,detuning_knob\n'
+	code0+=runtime_argument
 	code0+='    real*8, dimension('+str(Nd)+'), intent(in) :: detuning\n\n'
 
 	code0+='    complex*16 :: I,fact,aux\n'
@@ -282,7 +313,7 @@ end program\n\n'''
 			#We add the terms associated with the effective hamiltonian
 			#other than those associated with the phase transformation.
 			
-			for k in range(1,Ne+1):
+			for k in [k+1 for k in sorted(set(rows[i-1]+columns[j-1]))]:
 				#Case 1
 				if k>=j:
 					for l in Lij[i-1][k-1]:
@@ -327,7 +358,7 @@ end program\n\n'''
 			#We add the terms associated with the phase transformation.
 
 			extra=Theta(i,j,theta,omega_rescaled,omega_min,detunings,detuningsij,
-						combinations,detuning_indices,Lij,i_d,I_nd,Nnd,
+						detuning_table,detuning_indices,Lij,i_d,I_nd,Nnd,
 						verbose=verbose,states=states)
 
 			if extra!='':
@@ -355,7 +386,7 @@ end program\n\n'''
 		#First for populations.
 		for i in range(2,Ne+1):
 			mu=Mu(i,i,1,Ne)
-			for k in range(1,Ne+1):
+			for k in [int(k)+1 for k in np.flatnonzero(gamma_array[i-1])]:
 				gams=0
 				if k<i:
 					gams+=gamma[i-1][k-1]
@@ -364,20 +395,20 @@ end program\n\n'''
 					ga=gamma[i-1][k-1]
 					if ga != 0:
 						code+='    y('+str(mu)+')=y('+str(mu)+')'
-						code+='-('+format_double(ga)+')*x('+str(nu)+')\n'
+						code+='-('+format_double(ga)+')'+rate(k)+'*x('+str(nu)+')\n'
 				if gams!=0:
 					code+='    y('+str(mu)+')=y('+str(mu)+')'
-					code+='-('+format_double(gams)+')*x('+str(mu)+')\n'
+					code+='-('+format_double(gams)+')'+rate(i)+'*x('+str(mu)+')\n'
 
 		#And now for coherences	
 		for i in range(1,Ne+1):
-			for j in range(1,i):
+			for j in [int(j)+1 for j in np.flatnonzero(gamma_array[i-1][:i-1])]:
 				gams=gamma[i-1][j-1]/2
 				if gams!=0:
 					for a in range(i+1,Ne+1):
 						mu=Mu(a,i,+1,Ne)
 						code+='    y('+str(mu)+')=y('+str(mu)+')'
-						code+='-('+format_double(gams)+')*x('+str(mu)+')\n'
+						code+='-('+format_double(gams)+')'+rate(i)+'*x('+str(mu)+')\n'
 
 						#~ mu=Mu(a,i,-1,Ne)
 						#~ code+='    y('+str(mu)+')=y('+str(mu)+')'
@@ -386,12 +417,20 @@ end program\n\n'''
 					for b in range(1,i):
 						mu=Mu(i,b,+1,Ne)
 						code+='    y('+str(mu)+')=y('+str(mu)+')'
-						code+='-('+format_double(gams)+')*x('+str(mu)+')\n'
+						code+='-('+format_double(gams)+')'+rate(i)+'*x('+str(mu)+')\n'
 
 						#~ mu=Mu(i,b,-1,Ne)
 						#~ code+='    y('+str(mu)+')=y('+str(mu)+')'
 						#~ code+='-('+format_double(gams)+')*x('+str(mu)+')\n'
 
+		#And the pure dephasing of coherences, which might be zero at runtime.
+		if runtime_decay:
+			for i in range(2,Ne+1):
+				for j in range(1,i):
+					mu=Mu(i,j,+1,Ne)
+					code+='    y('+str(mu)+')=y('+str(mu)+')'
+					code+='-dephasing('+str(manifold[i-1])+','+str(manifold[j-1])+')*x('+str(mu)+')\n'
+
 
 
 
@@ -413,8 +452,14 @@ end program\n\n'''
 def run_rk4(path,name,E0,laser_frequencies,  N_iter,dt,N_states,
 				spectrum_of_laser=None,N_delta=None,frequency_step=None,frequency_end=None,
 				rho0=None,print_steps=False,integrate=False,
-				save_systems=False):
-	"""This function runs the Runge-Kutta method compiled in path+name..."""
+				save_systems=False,polarization=None,
+				decay_factors=None,decay_scale=1.0,dephasing=None):
+	"""This function runs the Runge-Kutta method compiled in path+name...
+
+	The programs written with runtime_polarization=True also need the polarization of each laser
+	(see polarization_parameters). The programs written with runtime_decay=True also need the
+	factors that scale the decay rates of each manifold, and optionally a global scale and the
+	pure dephasing rates between manifolds (see decay_parameters)."""
 
 	t0=time()
 	params =str(N_iter)+'\n'
@@ -441,6 +486,10 @@ def run_rk4(path,name,E0,laser_frequencies,  N_iter,dt,N_states,
 	params+='\n'
 	#We give the amplitude of the electrical fields.
 	params+=''.join([str(i)+' ' for i in E0])+'\n'
+	if polarization!=None:
+		params+=''.join([str(i)+' ' for i in polarization_parameters(polarization)])+'\n'
+	if decay_factors is not None:
+		params+=decay_parameters(decay_factors,decay_scale,dephasing)
 	
 	#We give the detuning of each laser (taken from the lowest frequency transition).
 	params+=''.join([str(i)+' ' for i in laser_frequencies])+'\n'
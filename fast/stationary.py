@@ -24,9 +24,17 @@
 #from all import sage_included
 sage_included = 'sage' in globals().keys()
 if not sage_included:
-	from misc import write_equations_code
+	from misc import write_equations_code, npy_subroutine_code, netcdf_subroutine_code
+	from misc import npy_chunks_subroutine_code, follow_stream, polarization_parameters
+	from misc import runtime_code, decay_manifolds, decay_parameters, Result, Mu, read_result
+	from misc import hyperfine_blocks, krylov_module_code
 	from time import time
+	from subprocess import Popen
 	import os
+	import numpy as np
+	from scipy import sparse
+	from scipy.sparse.linalg import spsolve
+	from scipy.linalg import lu_factor, lu_solve, schur, solve_triangular
 else:
 	from time import time
 
@@ -76,24 +84,71 @@ def analyze_zeros(row_check,col_check,rhs_check,Ne,N_excluded_mu,states):
 	return excluded_mu
 
 def write_stationary(path,name,laser,omega,gamma,r,Lij,
-				states=None,excluded_mu=[],verbose=1):
+				states=None,excluded_mu=[],verbose=1,use_npy=False,stream=False,
+				runtime_polarization=False,runtime_decay=False,manifolds=None,
+				solver='dgesv',tolerance=1e-10,max_iterations=1000,restart=30,boundaries=None):
+	r"""This function writes the Fortran code to calculate the stationary state of the density
+	matrix for a spectrum of detunings.
+
+	If stream=True, the program also appends each point to the file name_stream.npy as soon as it
+	is calculated, so that the results can be used while the program is still running (see
+	iterate_stationary).
+
+	If runtime_polarization=True, the polarizations of the lasers are read by the program
+	instead of being written into it, so that they can be changed without writing and compiling
+	the program again (see the polarization argument of run_stationary).
+
+	If runtime_decay=True, the decay rates of each manifold of states are scaled, and pure
+	dephasing rates between manifolds are added, by parameters read by the program (see the
+	decay_factors argument of run_stationary), so that for instance the temperature of a vapour
+	cell can be scanned. The manifolds are those of decay_manifolds unless they are given.
+
+	The equations are solved with LAPACK's dgesv, or with solver='gmres' or solver='bicgstab'
+	the matrix is stored as a sparse matrix and the equations are solved with GMRES (restarted
+	every restart iterations) or BiCGSTAB(2), preconditioned with the diagonal blocks of each pair
+	of hyperfine manifolds (see hyperfine_blocks), so that the memory used scales with the
+	number of nonzero elements. The solvers stop when the residual of the equations, each divided
+	by its largest coefficient, is below tolerance times the norm of their right hand side, and
+	if this does not happen in max_iterations iterations the equations are solved with dgesv. The
+	program counts these points and prints how many there were. Optically pumped systems of
+	degenerate states have very slow modes, with which restarted GMRES tends to stagnate, so
+	solver='bicgstab' is the recommended one for them."""
+	if solver not in ['dgesv','gmres','bicgstab']:
+		raise ValueError,'The solver must be dgesv, gmres or bicgstab.'
+	sparse=solver!='dgesv'
 	t0=time()
 	Ne=len(omega[0])
 	Nl=len(laser)
 	N_excluded_mu=len(excluded_mu)
 
 	from config import use_netcdf
+	N=str(Ne**2-1-N_excluded_mu)
+	if sparse:
+		matrix_shape='nnz,1'; matrix_dimension='nnz'; use_module='\tuse sparse_pattern\n'
+		solve_arguments='save_systems,converged'; private=',converged'
+	else:
+		matrix_shape=N+','+N; matrix_dimension=N+','+N; use_module=''
+		solve_arguments='save_systems'; private=''
+
+	#The polarization and decay parameters are passed along with E0 if they are read at runtime.
+	Nm=0
+	if runtime_decay: Nm=max(decay_manifolds(states,Ne,manifolds))
+	E0_args,runtime_declaration,runtime_argument,runtime_read=runtime_code(Nl,runtime_polarization,Nm)
 	
 	code0="""program stationary_rho
-    implicit none
+"""
+	if sparse: code0+='    use sparse_pattern, only: nnz\n'
+	code0+="""    implicit none
     real*8, dimension("""+str(Nl)+""") :: E0,detuning_knob,detuning_knobi
-    real*8, allocatable, dimension(:,:) :: rho
+"""+runtime_declaration+"""    real*8, allocatable, dimension(:,:) :: rho,A0,B0
     real*8, allocatable, dimension(:) :: delta
-    integer :: i,ldelta,ndelta,nerrors,info
+    integer :: i,ldelta,ndelta,nerrors,info,n_written
     real*8 :: ddelta
     logical :: print_steps,save_systems,specific_deltas,use_netcdf
     real*4 :: start_time, end_time
-    
+"""
+	if sparse: code0+='    logical :: converged\n'
+	code0+="""    
     !We load the parameters\n"""
 	# We break the path name into several lines if it is needed.
 	long_line="""open(unit=2,file='"""+path+name+"""_params.dat',status='unknown')\n"""
@@ -102,7 +157,7 @@ def write_stationary(path,name,laser,omega,gamma,r,Lij,
 	code0+=long_line
 	code0+="""
     read(2,*) E0
-    read(2,*) detuning_knob
+"""+runtime_read+"""    read(2,*) detuning_knob
 	read(2,*) ldelta
 	read(2,*) ndelta
 	read(2,*) ddelta
@@ -127,31 +182,68 @@ def write_stationary(path,name,laser,omega,gamma,r,Lij,
 
 	allocate(rho(ndelta,"""+str(Ne**2-1)+"""),stat=info)
 
+	!The terms that do not depend on the detunings are calculated only once.
+	allocate(A0("""+matrix_shape+"""),stat=info)
+	allocate(B0("""+str(Ne**2-1-N_excluded_mu)+""",1),stat=info)
+	call assemble("""+E0_args+""",A0,B0)
+
 	nerrors=0	
 
 	call cpu_time(start_time)
-
-	!$OMP PARALLEL PRIVATE(detuning_knobi)
+"""
+	if stream:
+		code0+="""
+	!We open the file to which each point is appended as soon as it is calculated.
+	call open_npy_chunks('"""+path+name+"""_stream.npy',"""+str(Ne**2-1)+""")
+	n_written=0
+"""
+	code0+="""
+	!$OMP PARALLEL PRIVATE(detuning_knobi"""+private+""")
 	!$OMP DO
 	do i=1,ndelta
 		
 		detuning_knobi=detuning_knob
 		detuning_knobi(ldelta)=delta(i)
 		
-		call solve(E0,detuning_knobi,rho(i,:),save_systems)
-
+		call solve(detuning_knobi,A0,B0,rho(i,:),"""+solve_arguments+""")
+"""
+	if sparse:
+		code0+="""		if (.not. converged) then
+			!$OMP ATOMIC
+			nerrors=nerrors+1
+		end if
+"""
+	code0+="""
 		if (print_steps) print*,'delta=',detuning_knobi(ldelta)
-		
+"""
+	if stream:
+		code0+="""
+		!$OMP CRITICAL
+		call append_npy_chunk(1,"""+str(Ne**2-1)+""",n_written,rho(i:i,:),delta(i:i))
+		!$OMP END CRITICAL
+"""
+	code0+="""		
 	end do
 	!$OMP END DO
 	!$OMP END PARALLEL
-
+"""
+	if stream:
+		code0+="""	close(7)
+"""
+	code0+="""
 	call cpu_time(end_time)
 	if (print_steps) print*,'total time:',end_time-start_time
-
+"""
+	if sparse:
+		code0+="""	if (nerrors>0) print*,nerrors,'points did not converge and were solved with dgesv.'
+"""
+	code0+="""
 	!We write the result to a file.
 	"""
-	if use_netcdf:
+	if use_npy:
+		code0+="""call save_matrix_and_vector_npy('"""+path+name+""".npy',ndelta,"""+str(Ne**2-1)+""",rho,delta)
+"""
+	elif use_netcdf:
 		code0+="""call save_matrix_and_vector('"""+path+name+""".nc',ndelta,"""+str(Ne**2-1)+""",rho,delta)
 """
 	else:
@@ -163,72 +255,74 @@ def write_stationary(path,name,laser,omega,gamma,r,Lij,
 	"""
 	code0+="""
 
-	deallocate(rho,stat=info)
+	deallocate(rho,A0,B0,stat=info)
 
 end program
 """
 	
-	if use_netcdf:
-		code0+="""
-subroutine save_matrix_and_vector(file_name,m,n,matrix,vector)
-	use netcdf
-	implicit none
-	character (len = *), intent(in) :: file_name
-	integer, intent(in) :: m,n
-	real*8, dimension(m,n), intent(in) :: matrix
-	real*8, dimension(m), intent(in) :: vector
-	
-	integer :: ncid, varid_matrix, varid_vector, dimids(2)
-	integer :: x_dimid, y_dimid
-	
-	call check( nf90_create(file_name, NF90_CLOBBER, ncid) )
-	call check( nf90_def_dim(ncid, "x", n, x_dimid) )
-	call check( nf90_def_dim(ncid, "y", m, y_dimid) )
-	dimids =  (/ y_dimid, x_dimid /)
-	call check( nf90_def_var(ncid, "matrix", NF90_DOUBLE, dimids,  varid_matrix) )
-	call check( nf90_def_var(ncid, "vector", NF90_DOUBLE, y_dimid, varid_vector) )
-	call check( nf90_enddef(ncid) )
-	
-	call check( nf90_put_var(ncid, varid_matrix, matrix) )
-	call check( nf90_put_var(ncid, varid_vector, vector) )
-	call check( nf90_close(ncid) )
-end subroutine
-
-subroutine check(status)
-	use netcdf
-	implicit none
-	integer, intent ( in) :: status
-
-	if(status /= nf90_noerr) then 
-		print *, trim(nf90_strerror(status))
-		stop "Stopped"
-	end if
-end subroutine check
-"""
-	code0+="""
-subroutine solve(E0,detuning_knob,B,save_systems)
-	implicit none
-	
-	real*8, dimension("""+str(Nl)+"""), intent(in) :: E0,detuning_knob
-	real*8, dimension("""+str(Ne**2-1-N_excluded_mu)+""",1), intent(out) :: B
-	logical, intent(in) :: save_systems
-
-"""
+	if use_npy:
+		code0+=npy_subroutine_code
+	elif use_netcdf:
+		code0+=netcdf_subroutine_code
+	if stream:
+		code0+=npy_chunks_subroutine_code
 	####################################################################
 
+	if sparse: sparse_index={}
+	else: sparse_index=None
 	dummy=write_equations_code(path,name,laser,omega,gamma,r,Lij,
-				states=states,excluded_mu=excluded_mu,verbose=verbose)
+				states=states,excluded_mu=excluded_mu,verbose=verbose,
+				runtime_polarization=runtime_polarization,
+				runtime_decay=runtime_decay,manifolds=manifolds,split_detunings=True,
+				sparse_index=sparse_index)
 	code,Nd,row_check,col_check,rhs_check,Ne,N_excluded_mu,states,omega_min,detuningsij,omega_rescaled=dummy
+	constant_code,code=code
+	if sparse:
+		#A holds only its nonzero elements, and the whole diagonal.
+		for mu in range(1,Ne**2-N_excluded_mu):
+			if (mu,mu) not in sparse_index: sparse_index[(mu,mu)]=len(sparse_index)+1
+		pattern=sorted(sparse_index,key=sparse_index.get)
+		blocks=hyperfine_blocks(states,Ne,excluded_mu,boundaries)
+		code0=krylov_module_code(Ne**2-1-N_excluded_mu,pattern,blocks,tolerance,max_iterations,restart)+'\n'+code0
 	####################################################################
+	#The terms that do not depend on the detunings are calculated once by assemble, and
+	#solve adds those that do to a copy of them for each detuning.
 	code0+="""
-	real*8, dimension("""+str(Nd)+""") :: detuning
+subroutine assemble("""+E0_args+""",A,B)
+"""+use_module+"""	implicit none
 	
-	integer :: INFO,j
-	real*8, dimension("""+str(Ne**2-1-N_excluded_mu)+""","""+str(Ne**2-1-N_excluded_mu)+""") :: A
-	integer, dimension("""+str(Ne**2-1-N_excluded_mu)+""") :: IPIV
+	real*8, dimension("""+str(Nl)+"""), intent(in) :: E0
+"""+runtime_argument+"""	real*8, dimension("""+matrix_dimension+"""), intent(out) :: A
+	real*8, dimension("""+str(Ne**2-1-N_excluded_mu)+""",1), intent(out) :: B
 
 	A=0
 	B=0
+"""+constant_code+"""end subroutine
+
+subroutine solve(detuning_knob,A0,B0,B,"""+solve_arguments+""")
+"""+use_module+"""	implicit none
+	
+	real*8, dimension("""+str(Nl)+"""), intent(in) :: detuning_knob
+	real*8, dimension("""+matrix_dimension+"""), intent(in) :: A0
+	real*8, dimension("""+str(Ne**2-1-N_excluded_mu)+""",1), intent(in) :: B0
+	real*8, dimension("""+str(Ne**2-1-N_excluded_mu)+""",1), intent(out) :: B
+	logical, intent(in) :: save_systems
+"""
+	if sparse: code0+='\tlogical, intent(out) :: converged\n'
+	code0+="""
+	real*8, dimension("""+str(Nd)+""") :: detuning
+	
+	integer :: INFO,j
+	real*8, dimension("""+matrix_dimension+""") :: A
+	integer, dimension("""+str(Ne**2-1-N_excluded_mu)+""") :: IPIV
+"""
+	if sparse:
+		code0+="""	real*8, allocatable, dimension(:,:) :: A_dense
+	real*8, dimension("""+N+""") :: x
+"""
+	code0+="""
+	A=A0
+	B=B0
 	"""
 	#We make the program print A and B
 #	code+="""	do j=1,"""+str(Ne**2-1)+"""
@@ -243,13 +337,36 @@ subroutine solve(E0,detuning_knob,B,save_systems)
 	#We make LAPACK solve the damn thing.
 	code+="	if (save_systems) then\n"
 	code+="		open(file='"+path+name+"_AB.dat',unit=4,status='unknown')\n"
-	code+="		do j=1,"+str(Ne**2-1-N_excluded_mu)+'\n'
-	code+="			write(4,*) A(j,:),B(j,1)\n"
+	if sparse:
+		#The nonzero elements are written as rows of the form mu, nu, A(mu,nu), followed by B.
+		code+="		do j=1,nnz\n"
+		code+="			write(4,*) rows(j),cols(j),A(j)\n"
+		code+="		end do\n"
+		code+="		do j=1,"+N+"\n"
+		code+="			write(4,*) B(j,1)\n"
+	else:
+		code+="		do j=1,"+str(Ne**2-1-N_excluded_mu)+'\n'
+		code+="			write(4,*) A(j,:),B(j,1)\n"
 	code+="		end do\n"
 	code+="		close(4)\n"
 	code+="	end if\n\n"
-	
-	code+='	call dgesv('+str(Ne**2-1-N_excluded_mu)+', 1, A, '+str(Ne**2-1-N_excluded_mu)+', IPIV, B, '+str(Ne**2-1-N_excluded_mu)+', INFO)\n'
+
+	if sparse:
+		code+='	call '+solver+'(A,B(:,1),x,converged)\n'
+		code+='	if (converged) then\n'
+		code+='		B(:,1)=x\n'
+		code+='		return\n'
+		code+='	end if\n\n'
+		code+='	!If the solver did not converge we fall back to a direct solution.\n'
+		code+='	allocate(A_dense('+N+','+N+'))\n'
+		code+='	A_dense=0\n'
+		code+='	do j=1,nnz\n'
+		code+='		A_dense(rows(j),cols(j))=A(j)\n'
+		code+='	end do\n'
+		code+='	call dgesv('+N+', 1, A_dense, '+N+', IPIV, B, '+N+', INFO)\n'
+		code+='	deallocate(A_dense)\n'
+	else:
+		code+='	call dgesv('+str(Ne**2-1-N_excluded_mu)+', 1, A, '+str(Ne**2-1-N_excluded_mu)+', IPIV, B, '+str(Ne**2-1-N_excluded_mu)+', INFO)\n'
 	#code+="	print*,'INFO',INFO\n"
 	code+="""	if (INFO>0) B=-11\n"""
 	#code+="""	if (INFO>0) print*, 'For frequencies',detuning_knob,'The system could not be solved, exit code:',INFO\n"""
@@ -266,7 +383,10 @@ subroutine solve(E0,detuning_knob,B,save_systems)
 	if excluded_mu!=[]:
 		t0=time()-t0
 		t_extra=write_stationary(path,name,laser,omega,gamma,r,Lij,
-				use_symbolic_phase_transformation=True,states=states,excluded_mu=excluded_mu)
+				use_symbolic_phase_transformation=True,states=states,excluded_mu=excluded_mu,
+				use_npy=use_npy,stream=stream,runtime_polarization=runtime_polarization,
+				runtime_decay=runtime_decay,manifolds=manifolds,solver=solver,tolerance=tolerance,
+				max_iterations=max_iterations,restart=restart,boundaries=boundaries)
 		
 		return t_extra+t0
 	else:		
@@ -279,10 +399,29 @@ subroutine solve(E0,detuning_knob,B,save_systems)
 
 def run_stationary(path,name,E0,laser_frequencies, spectrum_of_laser,N_delta,
 				frequency_step=None,frequency_end=None,print_steps=False,
-				specific_deltas=None, save_systems=False,clone=None,use_netcdf=True):
+				specific_deltas=None, save_systems=False,clone=None,use_netcdf=True,
+				callback=None,background=False,polarization=None,
+				decay_factors=None,decay_scale=1.0,dephasing=None):
+	r"""This function runs a program written by write_stationary for the given electric field
+	amplitudes E0 and laser frequencies, varying the frequency of laser spectrum_of_laser.
+
+	For programs written with stream=True, callback(delta,rho) is called for each point as soon
+	as it is calculated, where rho is the vector of density matrix components (see Mu). Giving a
+	callback for a program written without stream=True raises an error (see check_stream). With
+	background=True the program is started and its process is returned without waiting for it.
+
+	The programs written with runtime_polarization=True also need the polarization of each laser,
+	given as a list of lasers or of the helicity components of their polarizations (see
+	polarization_parameters). The programs written with runtime_decay=True also need the factors
+	that scale the decay rates of each manifold, and optionally a global scale and the pure
+	dephasing rates between manifolds (see decay_parameters)."""
 	t0=time()
 	
 	params=''.join([str(i)+' ' for i in E0])+'\n'
+	if polarization!=None:
+		params+=''.join([str(i)+' ' for i in polarization_parameters(polarization)])+'\n'
+	if decay_factors is not None:
+		params+=decay_parameters(decay_factors,decay_scale,dephasing)
 	params+=''.join([str(i)+' ' for i in laser_frequencies])+'\n'
 	params+=str(spectrum_of_laser)+'\n'
 	params+=str(N_delta)+'\n'
@@ -328,9 +467,247 @@ def run_stationary(path,name,E0,laser_frequencies, spectrum_of_laser,N_delta,
 	
 	com=path+name+clone
 	#print 'running',com
-	exit_code=os.system(com)
+	if background or callback!=None:
+		if callback!=None: check_stream(path,name)
+		#We remove the results of previous runs before they can be read.
+		stream_name=path+name+'_stream'+clone+'.npy'
+		if os.path.exists(stream_name): os.remove(stream_name)
+		process=Popen(com)
+		if background: return process
+
+		for delta,rho in follow_stream(stream_name,process):
+			callback(delta,rho)
+		exit_code=process.returncode
+		if exit_code==0 and not os.path.exists(stream_name):
+			raise RuntimeError,com+' did not write '+stream_name+', was it written with stream=True?'
+	else:
+		exit_code=os.system(com)
 	if exit_code != 0:
 		s='command '+com+' returned exit code '+str(exit_code)
 		raise RuntimeError,s
 	return time()-t0
 
+def iterate_stationary(path,name,E0,laser_frequencies,spectrum_of_laser,N_delta,**kwds):
+	r"""This function runs a program written by write_stationary with stream=True in the
+	background, yielding (delta,rho) for each point as soon as it is calculated. The points
+	calculated in parallel might come out of order, and a program written without stream=True
+	raises an error. The arguments are those of run_stationary."""
+	clone=kwds.get('clone',None)
+	if clone!=None:
+		clone='_'+str(clone)
+	else:
+		clone=''
+
+	check_stream(path,name)
+	process=run_stationary(path,name,E0,laser_frequencies,spectrum_of_laser,N_delta,
+							background=True,**kwds)
+	stream_name=path+name+'_stream'+clone+'.npy'
+	for point in follow_stream(stream_name,process):
+		yield point
+	if process.returncode != 0:
+		s='command '+path+name+clone+' returned exit code '+str(process.returncode)
+		raise RuntimeError,s
+	if not os.path.exists(stream_name):
+		s=path+name+clone+' did not write '+stream_name+', was it written with stream=True?'
+		raise RuntimeError,s
+
+def check_stream(path,name):
+	r"""This function raises a ValueError if the program written by write_stationary in path
+	under name was not written with stream=True, so that its points can not be followed while
+	it runs. Nothing is checked if its source code is not there."""
+	file_name=path+name+'.f90'
+	if not os.path.exists(file_name): return
+	f=file(file_name,'r')
+	code=f.read()
+	f.close()
+	if name+'_stream.npy' not in code:
+		raise ValueError,'the program '+path+name+' was not written with stream=True.'
+
+def refinement_deltas(data,rows,tolerance,max_new):
+	r"""The new detunings calculated by adaptive_stationary for data sorted by detuning (row 0)
+	with the observables in the given rows: the midpoints of the intervals on both sides of the
+	points whose linear interpolation from their neighbours has an error above tolerance times
+	the range of an observable, worst points first, and at most max_new of them. With fewer than
+	three points all the midpoints are returned.
+
+	>>> x=np.linspace(-10,10,11)
+	>>> data=np.array([x,1/(1+(x/0.5)**2)])
+	>>> refinement_deltas(data,[1],1e-3,100)
+	[-1.0, 1.0, -3.0, 3.0, -5.0, 5.0, -7.0, 7.0]
+	>>> refinement_deltas(data,[1],1e-3,3)
+	[-1.0, 1.0, -3.0]
+	>>> refinement_deltas(data,[1],1.0,100)
+	[]
+	>>> refinement_deltas(data[:,5:7],[1],1e-3,100)
+	[1.0]
+	"""
+	x=data[0]; y=data[rows]
+	if len(x)<3:
+		return [(x[k]+x[k+1])/2 for k in range(len(x)-1)][:max_new]
+	scale=y.max(axis=1)-y.min(axis=1)
+	scale[scale==0]=1.0
+
+	#The error of interpolating each point from its neighbours.
+	w=((x[1:-1]-x[:-2])/(x[2:]-x[:-2]))
+	error=abs(y[:,1:-1]-y[:,:-2]-w*(y[:,2:]-y[:,:-2]))/scale[:,np.newaxis]
+	error=error.max(axis=0)
+
+	#We halve the intervals around the worst points first.
+	intervals=[]
+	for k in np.argsort(-error):
+		if error[k]<=tolerance or len(intervals)>=max_new: break
+		for interval in [k,k+1]:
+			if interval not in intervals: intervals+=[interval]
+	intervals=intervals[:max_new]
+	return [(x[k]+x[k+1])/2 for k in intervals]
+
+def adaptive_stationary(path,name,E0,laser_frequencies,spectrum_of_laser,N_delta,frequency_end,
+				observables=None,tolerance=1e-3,max_points=2000,use_netcdf=True,use_npy=False,
+				clone=None,states=None,**kwds):
+	r"""This function runs a program written by write_stationary on N_delta equally spaced
+	detunings of laser spectrum_of_laser up to frequency_end, and then again on the midpoints of
+	the intervals where the observables are not well interpolated, until the error of the linear
+	interpolation at every point is below tolerance times the range of each observable, or until
+	max_points points have been calculated (see refinement_deltas). N_delta must be at least 2.
+	It returns a Result with the resulting nonuniform points sorted by detuning.
+
+	The observables are a list of (i,j,s) elements of the density matrix (s=1 for the real part
+	and s=-1 for the imaginary part), by default the populations. Features narrower than the
+	initial grid spacing can be missed entirely. The other arguments are those of run_stationary.
+	"""
+	if N_delta<2:
+		raise ValueError,'adaptive_stationary needs N_delta>=2 initial detunings.'
+	run_stationary(path,name,E0,laser_frequencies,spectrum_of_laser,N_delta,
+					frequency_end=frequency_end,use_netcdf=use_netcdf,clone=clone,**kwds)
+	result=read_result(path,name,use_netcdf=use_netcdf,use_npy=use_npy,clone=clone,states=states)
+	data=result.chunk(slice(None)).data
+	Ne=result.Ne; result.close()
+	if observables==None:
+		observables=[(i,i,1) for i in range(2,Ne+1)]
+	rows=[Mu(i,j,s,Ne) for i,j,s in observables]
+
+	while data.shape[1]<max_points:
+		data=data[:,np.argsort(data[0])]
+		deltas=refinement_deltas(data,rows,tolerance,max_points-data.shape[1])
+		if deltas==[]: break
+
+		run_stationary(path,name,E0,laser_frequencies,spectrum_of_laser,len(deltas),
+					frequency_step=0.0,specific_deltas=deltas,use_netcdf=use_netcdf,clone=clone,**kwds)
+		result=read_result(path,name,use_netcdf=use_netcdf,use_npy=use_npy,clone=clone)
+		data=np.concatenate([data,result.chunk(slice(None)).data],axis=1)
+		result.close()
+
+	data=data[:,np.argsort(data[0])]
+	return Result(data,Ne,states=states)
+
+class AffineOperator(object):
+	r"""The stationary equations A rho = B as affine functions of the electric field amplitudes
+	E0 and the detuning knobs (the laser frequencies given to run_stationary):
+
+		A = A0 + sum_l E0[l] A[l] + sum_l detuning_knob[l] D[l],	B = B0 + sum_l E0[l] B[l],
+
+	where A0, A[l] and D[l] are scipy.sparse matrices and B0 and B[l] are vectors."""
+	def __init__(self,A0,A,D,B0,B,Ne=None,excluded_mu=[]):
+		self.A0=A0; self.A=A; self.D=D; self.B0=B0; self.B=B
+		self.Nl=len(A)
+		self.Ne=Ne; self.excluded_mu=excluded_mu
+
+	def matrix(self,E0,detuning_knob):
+		r"""The matrix A for the given E0 and detuning knobs."""
+		A=self.A0.copy()
+		for l in range(self.Nl):
+			if E0[l]!=0: A=A+E0[l]*self.A[l]
+			if detuning_knob[l]!=0: A=A+detuning_knob[l]*self.D[l]
+		return A.tocsc()
+
+	def rhs(self,E0):
+		r"""The vector B for the given E0."""
+		return self.B0+sum([E0[l]*self.B[l] for l in range(self.Nl)])
+
+	def solve(self,E0,detuning_knob):
+		r"""The stationary density matrix vector (see Mu) for the given E0 and detuning knobs."""
+		return spsolve(self.matrix(E0,detuning_knob),self.rhs(E0))
+
+	def spectrum(self,E0,detuning_knob,spectrum_of_laser,deltas,amplitude=False,refine=False):
+		r"""The stationary states for each of the given values of the detuning knob of laser
+		spectrum_of_laser (counting from 1), or of its amplitude if amplitude=True, as a Result
+		like those of run_stationary. Along one parameter the equations are a matrix pencil
+		(M+e P) rho = b+e c, with e the distance to the middle of the values. M^-1 P is
+		reduced once to the Schur form U T U^H, so that each value only takes a triangular
+		solve of (1+e T), O(N^2) operations instead of O(N^3). For ill-conditioned equations,
+		refine=True adds a step of iterative refinement with the sparse matrices to each value."""
+		l=spectrum_of_laser-1
+		E0=list(E0); detuning_knob=list(detuning_knob)
+		N=self.A0.shape[0]
+		sigma=(min(deltas)+max(deltas))/2.0
+		if amplitude:
+			E0[l]=sigma; P=self.A[l]; c=self.B[l]
+		else:
+			detuning_knob[l]=sigma; P=self.D[l]; c=np.zeros(N)
+		M=self.matrix(E0,detuning_knob); P=P.tocsc(); b0=self.rhs(E0); c0=c
+		lu=lu_factor(M.toarray())
+		T,U=schur(lu_solve(lu,P.toarray()),output='complex')
+		UH=U.conj().T
+		b=np.dot(UH,lu_solve(lu,b0))
+		c=np.dot(UH,lu_solve(lu,c0))
+
+		#(1+e T) y = r is solved as (T+1/e) y = r/e, so that only the diagonal changes.
+		T=np.asfortranarray(T)
+		diagonal=np.diag_indices(N); T_diagonal=T[diagonal].copy()
+		def triangular_solve(e,r):
+			if e==0: return r
+			T[diagonal]=T_diagonal+1/e
+			return solve_triangular(T,r/e,check_finite=False)
+
+		data=np.zeros((N+1,len(deltas)))
+		data[0]=deltas
+		for n,delta in enumerate(deltas):
+			e=delta-sigma
+			rho=np.dot(U,triangular_solve(e,b+e*c)).real
+			if refine:
+				residual=b0+e*c0-M.dot(rho)-e*P.dot(rho)
+				rho+=np.dot(U,triangular_solve(e,np.dot(UH,lu_solve(lu,residual)))).real
+			data[1:,n]=rho
+		return Result(data,self.Ne,self.excluded_mu)
+
+def affine_operator(laser,omega,gamma,r,Lij,states=None,excluded_mu=[],verbose=0):
+	r"""This function returns the stationary equations for the same arguments as write_stationary
+	as an AffineOperator, so that they can be evaluated at any E0 and detuning knobs without
+	writing and compiling a program, or given to other solvers. The terms are those recorded by
+	write_equations_code as it writes the code of the programs.
+
+	>>> from electric_field import PlaneWave
+	>>> from misc import formatLij
+	>>> from math import pi
+	>>> omega=[[0.0,-100.0],[100.0,0.0]]; gamma=[[0.0,-1.0],[1.0,0.0]]
+	>>> r=[[[0,1],[1,0]] for p in range(3)]
+	>>> op=affine_operator([PlaneWave(0,pi/2,0,0)],omega,gamma,r,formatLij([[1,2,[1]]],2))
+	>>> print op.matrix([1.0],[0.5]).toarray()
+	[[-1.   0.  -1. ]
+	 [ 0.  -0.5 -0.5]
+	 [ 1.   0.5 -0.5]]
+	>>> print op.rhs([1.0])
+	[0.  0.  0.5]
+	>>> np.allclose(op.spectrum([1.0],[0.0],1,[-1.0,0.5]).data[1:,1],op.solve([1.0],[0.5]))
+	True
+	"""
+	terms=[]
+	dummy=write_equations_code('','',laser,omega,gamma,r,Lij,
+				states=states,excluded_mu=excluded_mu,verbose=verbose,terms=terms)
+	code,Nd,row_check,col_check,rhs_check,Ne,N_excluded_mu,states,omega_min,detuningsij,omega_rescaled=dummy
+	Nl=len(laser)
+	N=Ne**2-1-N_excluded_mu
+
+	A=[(mu-1,nu-1,coefficients) for mu,nu,coefficients in terms if nu!=0]
+	B=[(mu-1,coefficients) for mu,nu,coefficients in terms if nu==0]
+
+	#We build a sparse matrix and a vector for each coefficient, adding up repeated terms.
+	rows=np.array([term[0] for term in A],int)
+	cols=np.array([term[1] for term in A],int)
+	values=np.array([term[2] for term in A]).reshape(len(A),2*Nl+1)
+	matrices=[sparse.csr_matrix((values[:,k],(rows,cols)),shape=(N,N)) for k in range(2*Nl+1)]
+	for matrix in matrices: matrix.eliminate_zeros()
+	vectors=np.zeros((2*Nl+1,N))
+	for mu,coefficients in B: vectors[:,mu]+=coefficients
+	return AffineOperator(matrices[0],matrices[1:Nl+1],matrices[Nl+1:],vectors[0],list(vectors[1:Nl+1]),
+							Ne,excluded_mu)